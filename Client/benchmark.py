@@ -0,0 +1,400 @@
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tkinter as tk
+import tracemalloc
+from pathlib import Path
+
+
+def crea_client(args):
+    # un MessengerClient senza login né rete, solo con la GUI
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import client
+
+    c = client.MessengerClient.__new__(client.MessengerClient)
+    c.nickname = 'bench'
+    c.connesso = False
+    c.utenti_online = []
+    c.max_righe_chat = args.max_righe
+    c.pagina_chat = 200
+    c.root = tk.Tk()
+    c.setup_gui()
+    c.root.update()
+    return c
+
+
+def messaggio_finto(i):
+    return {
+        'mittente': f"utente{i % 50}",
+        'messaggio': f"messaggio di prova numero {i}",
+        'timestamp': time.strftime("%H:%M:%S"),
+        'tipo': 'ricevuto'
+    }
+
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, int(len(ordinati) * p / 100))]
+
+
+def riassunto(tempi):
+    return {
+        'messaggi': len(tempi),
+        'media_us': round(1e6 * sum(tempi) / len(tempi), 1),
+        'p99_us': round(1e6 * percentile(tempi, 99), 1),
+        'ultimi_1000_media_us': round(1e6 * sum(tempi[-1000:]) / len(tempi[-1000:]), 1)
+    }
+
+
+def rendering_completo(c):
+    # il vecchio aggiorna_chat: cancella tutto e reinserisce ogni messaggio
+    import client
+    c.tutti.text.config(state='normal')
+    c.tutti.text.delete(1.0, tk.END)
+    for msg in c.tutti.messaggi:
+        testo, tag = client.formatta_riga(msg)
+        c.tutti.text.insert(tk.END, testo, tag)
+    c.tutti.text.config(state='disabled')
+    c.tutti.text.see(tk.END)
+
+
+def bench_chat(args):
+    # tempo di aggiornamento della chat per ogni messaggio ricevuto, uno alla volta
+    c = crea_client(args)
+    risultati = {}
+
+    tempi = []
+    for i in range(args.messaggi):
+        c.tutti.messaggi.append(messaggio_finto(i))
+        inizio = time.perf_counter()
+        c.tutti.aggiorna()
+        c.root.update_idletasks()
+        tempi.append(time.perf_counter() - inizio)
+    risultati['incrementale'] = riassunto(tempi)
+    risultati['incrementale']['righe_nel_widget'] = int(c.tutti.text.index('end-1c').split('.')[0]) - 1
+
+    c.tutti.messaggi = []
+    tempi = []
+    # il rendering completo è O(storia) per messaggio: si misura solo su un prefisso
+    for i in range(min(args.messaggi, args.messaggi_completo)):
+        c.tutti.messaggi.append(messaggio_finto(i))
+        inizio = time.perf_counter()
+        rendering_completo(c)
+        c.root.update_idletasks()
+        tempi.append(time.perf_counter() - inizio)
+    risultati['completo'] = riassunto(tempi)
+
+    c.root.destroy()
+    return risultati
+
+
+def carica_client():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import client
+    return client
+
+
+def simula_popolazione(politica, args, client):
+    # args.client client in long-poll /sync, tutti partiti allo stesso istante, in tempo simulato.
+    # 'fissa' è la vecchia pianificazione: long-poll di 25 s rifatto subito, 2 s dopo un errore, keepalive ogni 30 s.
+    # 'adattiva' usa Pianificatore. i client in conversazione si scrivono tra loro, gli altri ricevono di rado;
+    # da args.inizio_guasto per args.durata_guasto secondi il server non risponde
+    casuale = random.Random(args.seme)
+    eventi = []
+    ordine = itertools.count()
+
+    def programma(istante, tipo, indice=None, dato=None):
+        heapq.heappush(eventi, (istante, next(ordine), tipo, indice, dato))
+
+    attivi = casuale.sample(range(args.client), int(args.client * args.attivi))
+    fine_guasto = args.inizio_guasto + args.durata_guasto
+    richieste = [0] * (int(args.durata) + 1)
+    ritardi = {'attivi': [], 'inattivi': []}
+    insieme_attivi = set(attivi)
+    stati = []
+    for indice in range(args.client):
+        stati.append({
+            'pianificatore': client.Pianificatore(random.Random(casuale.random())),
+            # token del long-poll aperto e del prossimo poll programmato: gli eventi con token vecchi si ignorano
+            'poll_aperto': None,
+            'prossimo_poll': None,
+            'in_attesa': [],
+            'ultimo_contatto': 0.0,
+            'ripreso': None
+        })
+    guasto = [False]
+    silenzi_troppo_lunghi = [0]
+
+    def conta_richiesta(istante):
+        if istante <= args.durata:
+            richieste[int(istante)] += 1
+
+    def contatto(indice, istante):
+        stato = stati[indice]
+        # il server scollega chi tace per più di 90 s; il guasto non conta
+        if istante - stato['ultimo_contatto'] > 90 and not (stato['ultimo_contatto'] < fine_guasto
+                                                              and istante > args.inizio_guasto):
+            silenzi_troppo_lunghi[0] += 1
+        stato['ultimo_contatto'] = istante
+
+    def programma_poll(indice, istante):
+        token = next(ordine)
+        stati[indice]['prossimo_poll'] = token
+        programma(istante, 'poll', indice, token)
+
+    def dopo_poll(indice, istante, riuscito):
+        pianificatore = stati[indice]['pianificatore']
+        if politica == 'fissa':
+            attesa = 0 if riuscito else 2
+        else:
+            attesa = pianificatore.dopo_successo(istante) if riuscito else pianificatore.dopo_errore()
+        programma_poll(indice, istante + attesa)
+
+    def consegna(indice, istante):
+        stato = stati[indice]
+        gruppo = 'attivi' if indice in insieme_attivi else 'inattivi'
+        for arrivo in stato['in_attesa']:
+            ritardi[gruppo].append(istante - arrivo)
+        stato['in_attesa'] = []
+        stato['pianificatore'].attivita(istante)
+
+    for indice in range(args.client):
+        programma_poll(indice, 0.0)
+        if politica == 'fissa':
+            programma(30.0, 'keepalive', indice)
+        else:
+            programma(stati[indice]['pianificatore'].intervallo_keepalive(), 'keepalive', indice)
+    for indice in attivi:
+        programma(casuale.expovariate(args.ritmo_attivi), 'invio', indice)
+    programma(casuale.expovariate(args.client * args.ritmo_inattivi), 'raro')
+    programma(args.inizio_guasto, 'guasto')
+    programma(fine_guasto, 'ripresa')
+
+    while eventi:
+        istante, _, tipo, indice, dato = heapq.heappop(eventi)
+        if istante > args.durata:
+            break
+        stato = stati[indice] if indice is not None else None
+
+        if tipo == 'poll':
+            if dato != stato['prossimo_poll']:
+                continue
+            stato['prossimo_poll'] = None
+            conta_richiesta(istante)
+            if guasto[0]:
+                dopo_poll(indice, istante, False)
+            elif stato['in_attesa']:
+                contatto(indice, istante)
+                consegna(indice, istante)
+                dopo_poll(indice, istante, True)
+            else:
+                if stato['ripreso'] is None and istante >= fine_guasto:
+                    stato['ripreso'] = istante - fine_guasto
+                attesa = 25 if politica == 'fissa' else stato['pianificatore'].attesa_poll(25)
+                stato['poll_aperto'] = next(ordine)
+                programma(istante + attesa, 'scadenza', indice, stato['poll_aperto'])
+
+        elif tipo == 'scadenza':
+            if dato != stato['poll_aperto']:
+                continue
+            stato['poll_aperto'] = None
+            contatto(indice, istante)
+            dopo_poll(indice, istante, True)
+
+        elif tipo in ('invio', 'raro'):
+            if tipo == 'invio':
+                programma(istante + casuale.expovariate(args.ritmo_attivi), 'invio', indice)
+                mittente = stato
+                destinatario = casuale.choice(attivi)
+                if politica == 'adattiva':
+                    # chi scrive sveglia il proprio polling
+                    mittente['pianificatore'].attivita(istante)
+                    if mittente['prossimo_poll'] is not None:
+                        programma_poll(indice, istante)
+            else:
+                programma(istante + casuale.expovariate(args.client * args.ritmo_inattivi), 'raro')
+                destinatario = casuale.randrange(args.client)
+            if guasto[0]:
+                continue
+            stati[destinatario]['in_attesa'].append(istante)
+            if stati[destinatario]['poll_aperto'] is not None:
+                stati[destinatario]['poll_aperto'] = None
+                contatto(destinatario, istante)
+                consegna(destinatario, istante)
+                dopo_poll(destinatario, istante, True)
+
+        elif tipo == 'keepalive':
+            if politica == 'fissa':
+                programma(istante + 30, 'keepalive', indice)
+                soglia = 30
+            else:
+                programma(istante + stato['pianificatore'].intervallo_keepalive(), 'keepalive', indice)
+                soglia = client.MAX_SILENZIO
+            if istante - stato['ultimo_contatto'] >= soglia:
+                conta_richiesta(istante)
+                if not guasto[0]:
+                    contatto(indice, istante)
+
+        elif tipo == 'guasto':
+            guasto[0] = True
+            # i long-poll aperti cadono tutti insieme
+            for indice, stato in enumerate(stati):
+                if stato['poll_aperto'] is not None:
+                    stato['poll_aperto'] = None
+                    dopo_poll(indice, istante, False)
+
+        elif tipo == 'ripresa':
+            guasto[0] = False
+
+    def percentile(valori, p):
+        return round(sorted(valori)[min(len(valori) - 1, int(len(valori) * p / 100))], 2) if valori else None
+
+    # "a regime" esclude il primo minuto (partono tutti insieme), il guasto e il minuto dopo
+    a_regime = [n for secondo, n in enumerate(richieste)
+                if secondo >= 60 and not args.inizio_guasto <= secondo < fine_guasto + 60]
+    ripresi = [stato['ripreso'] for stato in stati if stato['ripreso'] is not None]
+    return {
+        'richieste_al_secondo': round(sum(richieste) / args.durata, 1),
+        'picco_al_secondo_a_regime': max(a_regime),
+        'p99_al_secondo_a_regime': percentile(a_regime, 99),
+        'richieste_durante_guasto': sum(richieste[args.inizio_guasto:fine_guasto]),
+        'picco_al_secondo_dopo_guasto': max(richieste[fine_guasto:fine_guasto + 60]),
+        'ritardo_consegna_attivi_s': {'p50': percentile(ritardi['attivi'], 50), 'p99': percentile(ritardi['attivi'], 99)},
+        'ritardo_consegna_inattivi_s': {'p50': percentile(ritardi['inattivi'], 50),
+                                        'p99': percentile(ritardi['inattivi'], 99)},
+        'ripresa_dopo_guasto_s': {'p50': percentile(ripresi, 50), 'p99': percentile(ripresi, 99)},
+        'silenzi_oltre_timeout_presenza': silenzi_troppo_lunghi[0]
+    }
+
+
+def bench_pianificazione(args):
+    # effetto della pianificazione del polling sul carico del server, con una popolazione simulata
+    client = carica_client()
+    return {politica: simula_popolazione(politica, args, client) for politica in ('fissa', 'adattiva')}
+
+
+def testo_casuale(casuale, vocabolario, parole):
+    # le parole più frequenti all'inizio del vocabolario, come in una lingua vera
+    return ' '.join(vocabolario[int(len(vocabolario) * casuale.random() ** 3)] for _ in range(parole))
+
+
+def riga_finta(casuale, vocabolario, i):
+    testo = testo_casuale(casuale, vocabolario, casuale.randint(3, 15))
+    if i % 2:
+        return {'tipo': 'ricevuto', 'mittente': f"utente{i % 50}", 'messaggio': testo,
+                'timestamp': time.strftime("%H:%M:%S")}
+    return {'tipo': 'inviato', 'destinatari': [f"utente{i % 50}"], 'destinatario': f"utente{i % 50}",
+            'messaggio': testo, 'timestamp': time.strftime("%H:%M:%S"), 'stato': 'inviato'}
+
+
+def misura(funzione, ripetizioni):
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        risultato = funzione()
+        tempi.append(time.perf_counter() - inizio)
+    return {'p50_ms': round(1e3 * percentile(tempi, 50), 2), 'p99_ms': round(1e3 * percentile(tempi, 99), 2),
+            'righe': len(risultato)}
+
+
+def bench_storia(args):
+    # storia locale con args.messaggi messaggi: scrittura, pagina iniziale, pagine precedenti, conversazione
+    # con un utente e ricerca. per confronto, la memoria che avrebbe occupato la stessa storia nella vecchia
+    # lista self.messaggi, e quanto ci si metteva a filtrarla per aprire la conversazione con un utente
+    client = carica_client()
+    casuale = random.Random(args.seme)
+    sillabe = [c + v for c in 'bcdfglmnprstvz' for v in 'aeiou']
+    vocabolario = sorted({''.join(casuale.choice(sillabe) for _ in range(casuale.randint(2, 4)))
+                          for _ in range(args.vocabolario)})
+    casuale.shuffle(vocabolario)
+    risultati = {'messaggi': args.messaggi, 'parole_nel_vocabolario': len(vocabolario)}
+
+    with tempfile.TemporaryDirectory() as cartella:
+        percorso = Path(cartella) / 'bench.db'
+        storia = client.Storia(percorso)
+        inizio = time.perf_counter()
+        for primo in range(0, args.messaggi, 1000):
+            storia.aggiungi([riga_finta(casuale, vocabolario, i) for i in range(primo, min(primo + 1000, args.messaggi))])
+        durata = time.perf_counter() - inizio
+        risultati['scrittura_messaggi_al_secondo'] = round(args.messaggi / durata)
+        # il singolo messaggio inviato, con il suo commit
+        risultati['scrittura_singola'] = misura(lambda: storia.aggiungi([riga_finta(casuale, vocabolario, 0)]) or [0], 200)
+        risultati['byte_su_disco_per_messaggio'] = round(sum(f.stat().st_size for f in Path(cartella).iterdir())
+                                                         / args.messaggi)
+
+        risultati['pagina_iniziale'] = misura(lambda: storia.precedenti(None, 200), 50)
+        ultimo = storia.precedenti(None, 1)[0]['id']
+        risultati['pagina_precedente_a_meta'] = misura(
+            lambda: storia.precedenti(casuale.randint(200, ultimo), 200), 50)
+        # riga_finta scrive con 50 utenti: un utente ha il 2% della storia
+        risultati['conversazione_pagina_iniziale'] = misura(
+            lambda: storia.precedenti(None, 200, f"utente{casuale.randrange(50)}"), 50)
+        risultati['conversazione_pagina_a_meta'] = misura(
+            lambda: storia.precedenti(casuale.randint(200, ultimo), 200, f"utente{casuale.randrange(50)}"), 50)
+
+        ricerche = {
+            'parola_comune': vocabolario[0],
+            'parola_media': vocabolario[len(vocabolario) // 10],
+            'parola_rara': vocabolario[-1],
+            'due_parole': f"{vocabolario[1]} {vocabolario[len(vocabolario) // 20]}",
+            'prefisso': vocabolario[len(vocabolario) // 5][:3] + '*',
+            'assente': 'qqqq'
+        }
+        risultati['ricerca'] = {}
+        for nome, testo in ricerche.items():
+            risultati['ricerca'][nome] = dict(misura(lambda: storia.cerca(testo), 20), testo=testo)
+
+    # la vecchia lista: un dizionario per messaggio, tutti in memoria
+    campione = min(args.messaggi, 100000)
+    tracemalloc.start()
+    vecchia = [{'mittente': 'x', 'messaggio': testo_casuale(casuale, vocabolario, casuale.randint(3, 15)),
+                'timestamp': time.strftime("%H:%M:%S"), 'tipo': 'ricevuto'} for _ in range(campione)]
+    occupata = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    risultati['vecchia_lista_in_memoria_mb'] = round(occupata * args.messaggi / campione / 2 ** 20)
+    filtro = misura(lambda: [msg for msg in vecchia if msg['mittente'] == 'utente7'], 10)
+    risultati['vecchio_filtro_conversazione_ms'] = round(filtro['p50_ms'] * args.messaggi / campione, 1)
+    del vecchia
+    return risultati
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del client Messenger")
+    sotto = parser.add_subparsers(dest='comando', required=True)
+
+    p_chat = sotto.add_parser('chat', help="tempo di aggiornamento della chat per messaggio")
+    p_chat.add_argument('--messaggi', type=int, default=50000)
+    p_chat.add_argument('--messaggi-completo', type=int, default=5000,
+                        help="messaggi misurati con il vecchio rendering completo")
+    p_chat.add_argument('--max-righe', type=int, default=2000)
+    p_chat.set_defaults(funzione=bench_chat)
+
+    p_pian = sotto.add_parser('pianificazione', help="richieste al server per secondo con molti client simulati")
+    p_pian.add_argument('--client', type=int, default=1000)
+    p_pian.add_argument('--durata', type=int, default=900, help="secondi simulati")
+    p_pian.add_argument('--attivi', type=float, default=0.1, help="frazione di client in conversazione")
+    p_pian.add_argument('--ritmo-attivi', type=float, default=0.05, help="messaggi al secondo scritti da un attivo")
+    p_pian.add_argument('--ritmo-inattivi', type=float, default=1 / 600, help="messaggi al secondo ricevuti da ognuno")
+    p_pian.add_argument('--inizio-guasto', type=int, default=450)
+    p_pian.add_argument('--durata-guasto', type=int, default=30)
+    p_pian.add_argument('--seme', type=int, default=1)
+    p_pian.set_defaults(funzione=bench_pianificazione)
+
+    p_storia = sotto.add_parser('storia', help="storia locale: scrittura, pagine e ricerca")
+    p_storia.add_argument('--messaggi', type=int, default=1000000)
+    p_storia.add_argument('--vocabolario', type=int, default=20000)
+    p_storia.add_argument('--seme', type=int, default=1)
+    p_storia.set_defaults(funzione=bench_storia)
+
+    args = parser.parse_args()
+    print(json.dumps(args.funzione(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
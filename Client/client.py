@@ -7,17 +7,493 @@ import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 import socket
 import hashlib
+import random
+import queue
+import heapq
+import itertools
+import sqlite3
+import uuid
+import tempfile
+import re
+from pathlib import Path
+
+SEGNAPOSTO_LISTA_UTENTI = "(Nessun altro utente online)"
+
+# pianificazione di polling e keepalive, in secondi.
+# per FINESTRA_CONVERSAZIONE dopo un messaggio inviato o ricevuto il long-poll riparte subito;
+# da fermi tra un long-poll e il successivo si aspetta sempre di più, fino ad ATTESA_INATTIVO_MAX
+FINESTRA_CONVERSAZIONE = 120
+ATTESA_INATTIVO_MIN = 1
+ATTESA_INATTIVO_MAX = 20
+# dopo un errore: backoff esponenziale con jitter pieno, tra 0 e il limite che raddoppia a ogni errore
+BACKOFF_ERRORI_MIN = 1
+BACKOFF_ERRORI_MAX = 60
+# variazione casuale relativa di attese e intervalli, così i client partiti insieme non restano sincronizzati
+JITTER = 0.2
+# il keepalive controlla ogni INTERVALLO_KEEPALIVE (con jitter) e fa ping se dal server non arriva niente da
+# MAX_SILENZIO: deve restare ben sotto il TIMEOUT_PRESENZA del server (90)
+INTERVALLO_KEEPALIVE = 20
+MAX_SILENZIO = 50
+# i messaggi arrivati con lo stream si confermano al server con un ping, al più uno ogni tanti secondi
+RITARDO_CONFERMA_STREAM = 1
+
+class Pianificatore:
+    # quando rifare il long-poll e il keepalive. gli istanti si passano da fuori (time.time() nel client,
+    # il tempo simulato nel benchmark)
+    def __init__(self, casuale=None):
+        self.casuale = casuale or random.Random()
+        self.ultima_attivita = float('-inf')
+        self.attesa_inattivo = 0
+        self.errori = 0
+    
+    def attivita(self, adesso):
+        # un messaggio inviato o ricevuto: si torna al polling veloce
+        self.ultima_attivita = adesso
+        self.attesa_inattivo = 0
+    
+    def con_jitter(self, secondi):
+        return secondi * self.casuale.uniform(1 - JITTER, 1 + JITTER)
+    
+    def attesa_poll(self, massima):
+        # quanto chiedere al server di tenere aperto il long-poll: mai tutti la stessa durata
+        return massima * self.casuale.uniform(1 - JITTER, 1)
+    
+    def dopo_successo(self, adesso, suggerita=None):
+        # secondi prima del prossimo long-poll
+        self.errori = 0
+        if suggerita is not None:
+            return self.con_jitter(suggerita)
+        if adesso - self.ultima_attivita < FINESTRA_CONVERSAZIONE:
+            return 0
+        self.attesa_inattivo = min(max(2 * self.attesa_inattivo, ATTESA_INATTIVO_MIN), ATTESA_INATTIVO_MAX)
+        return self.con_jitter(self.attesa_inattivo)
+    
+    def dopo_stream(self):
+        # lo stream non costa niente da fermo: finito bene si riapre subito
+        self.azzera_errori()
+        return 0
+    
+    def azzera_errori(self):
+        self.errori = 0
+    
+    def dopo_errore(self, suggerita=None):
+        # suggerita: Retry-After o riprova_tra del server, che vale come minimo
+        self.errori += 1
+        limite = min(BACKOFF_ERRORI_MIN * 2 ** (self.errori - 1), BACKOFF_ERRORI_MAX)
+        return max(self.casuale.uniform(0, limite), suggerita or 0)
+    
+    def intervallo_keepalive(self):
+        return self.con_jitter(INTERVALLO_KEEPALIVE)
+
+# lavori in attesa nel thread di rete: oltre, i nuovi vengono scartati invece di accumularsi
+MAX_CODA_IO = 100
+# posta in uscita: consegne (messaggi x destinatari) per richiesta, come MAX_CONSEGNE_BATCH del server
+MAX_CONSEGNE_INVIO = 500
+# risultati mostrati da una ricerca nella storia, i più recenti
+MAX_RISULTATI_RICERCA = 200
+
+class LavoratoreIO:
+    # un solo thread per le richieste brevi (connessione, invii, lista utenti, keepalive, disconnessione),
+    # eseguite in ordine una alla volta con la Session condivisa. il long-poll resta nel suo thread:
+    # tiene la richiesta aperta per decine di secondi e fermerebbe tutto il resto
+    def __init__(self, periodica, intervallo):
+        self.coda = queue.Queue(MAX_CODA_IO)
+        # chiavi dei lavori accodati e non ancora partiti: un secondo lavoro con la stessa chiave è superfluo
+        self.in_coda = set()
+        self.lock = threading.Lock()
+        # lavori da fare più tardi (i tentativi dopo un errore): heap di (istante, ordine, funzione, chiave)
+        self.rinviati = []
+        self.ordine = itertools.count()
+        # periodica() gira ogni intervallo() secondi tra un lavoro e l'altro (il keepalive)
+        self.periodica = periodica
+        self.intervallo = intervallo
+        self.thread = threading.Thread(target=self.ciclo, daemon=True)
+        self.thread.start()
+    
+    def sottometti(self, funzione, chiave=None):
+        # False se la coda è piena o un lavoro con la stessa chiave aspetta già di partire
+        with self.lock:
+            if chiave is not None and chiave in self.in_coda:
+                return False
+            try:
+                self.coda.put_nowait((funzione, chiave))
+            except queue.Full:
+                return False
+            if chiave is not None:
+                self.in_coda.add(chiave)
+        return True
+    
+    def sottometti_tra(self, secondi, funzione, chiave=None):
+        # come sottometti, ma parte tra tanti secondi; fino ad allora la chiave conta come già in coda
+        with self.lock:
+            if chiave is not None and chiave in self.in_coda:
+                return False
+            ordine = next(self.ordine)
+            heapq.heappush(self.rinviati, (time.monotonic() + secondi, ordine, funzione, chiave))
+            if chiave is not None:
+                self.in_coda.add(chiave)
+            primo = self.rinviati[0][1] == ordine
+        if primo:
+            # il ciclo aspetta sulla coda fino alla scadenza che conosceva: un lavoro vuoto gli fa ricalcolare
+            try:
+                self.coda.put_nowait((lambda: None, None))
+            except queue.Full:
+                pass
+        return True
+    
+    def anticipa(self, chiave):
+        # il lavoro rinviato con questa chiave parte subito
+        with self.lock:
+            for indice, (_, _, funzione, chiave_rinviato) in enumerate(self.rinviati):
+                if chiave_rinviato == chiave:
+                    self.rinviati.pop(indice)
+                    heapq.heapify(self.rinviati)
+                    break
+            else:
+                return
+            try:
+                self.coda.put_nowait((funzione, chiave))
+            except queue.Full:
+                self.in_coda.discard(chiave)
+    
+    def ciclo(self):
+        prossima = time.monotonic() + self.intervallo()
+        while True:
+            adesso = time.monotonic()
+            if adesso >= prossima:
+                self.esegui(self.periodica)
+                prossima = time.monotonic() + self.intervallo()
+                continue
+            with self.lock:
+                scaduto = self.rinviati and self.rinviati[0][0] <= adesso
+                if scaduto:
+                    _, _, funzione, chiave = heapq.heappop(self.rinviati)
+                limite = min(prossima, self.rinviati[0][0]) if self.rinviati else prossima
+            if scaduto:
+                lavoro = (funzione, chiave)
+            else:
+                try:
+                    lavoro = self.coda.get(timeout=limite - adesso)
+                except queue.Empty:
+                    continue
+            if lavoro is None:
+                return
+            funzione, chiave = lavoro
+            if chiave is not None:
+                # tolta prima di partire: quello che arriva da adesso serve un altro giro
+                with self.lock:
+                    self.in_coda.discard(chiave)
+            self.esegui(funzione)
+    
+    def esegui(self, funzione):
+        try:
+            funzione()
+        except Exception:
+            # un lavoro che fallisce non deve fermare il thread
+            pass
+    
+    def chiudi(self, attesa):
+        # in uscita: finisce i lavori già accodati (la disconnessione) per al massimo attesa secondi
+        try:
+            self.coda.put(None, timeout=attesa)
+        except queue.Full:
+            return
+        self.thread.join(attesa)
+
+class PostaInUscita:
+    # messaggi scritti e non ancora accettati dal server, in un database SQLite locale: restano anche con il server
+    # irraggiungibile e dopo la chiusura del client. l'id lo sceglie il client e il server lo usa per non
+    # consegnare due volte un messaggio rispedito
+    def __init__(self, percorso):
+        # la usano il thread di Tk (aggiungi) e quello di rete (il resto)
+        self.db = apri_database(percorso)
+        self.lock = threading.Lock()
+        self.db.execute("""CREATE TABLE IF NOT EXISTS uscita (
+            ordine INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            destinatari TEXT NOT NULL,
+            messaggio TEXT NOT NULL,
+            creato REAL NOT NULL
+        )""")
+    
+    def aggiungi(self, destinatari, messaggio):
+        voce = {'id': uuid.uuid4().hex, 'destinatari': destinatari, 'messaggio': messaggio, 'creato': time.time()}
+        with self.lock:
+            self.db.execute('INSERT INTO uscita (id, destinatari, messaggio, creato) VALUES (?, ?, ?, ?)',
+                            (voce['id'], json.dumps(destinatari), messaggio, voce['creato']))
+        return voce
+    
+    def voci(self, max_consegne=None):
+        # in ordine di scrittura; con max_consegne quelle che stanno in una richiesta (almeno una)
+        with self.lock:
+            righe = self.db.execute('SELECT id, destinatari, messaggio, creato FROM uscita ORDER BY ordine').fetchall()
+        voci = []
+        consegne = 0
+        for id_messaggio, destinatari, messaggio, creato in righe:
+            destinatari = json.loads(destinatari)
+            consegne += len(destinatari)
+            if max_consegne is not None and voci and consegne > max_consegne:
+                break
+            voci.append({'id': id_messaggio, 'destinatari': destinatari, 'messaggio': messaggio, 'creato': creato})
+        return voci
+    
+    def aggiorna(self, id_messaggio, destinatari):
+        # restano da consegnare solo questi destinatari
+        with self.lock:
+            self.db.execute('UPDATE uscita SET destinatari = ? WHERE id = ?', (json.dumps(destinatari), id_messaggio))
+    
+    def rimuovi(self, id_messaggio):
+        with self.lock:
+            self.db.execute('DELETE FROM uscita WHERE id = ?', (id_messaggio,))
+    
+    def vuota(self):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM uscita LIMIT 1').fetchone() is None
+
+class Storia:
+    # tutti i messaggi inviati e ricevuti, su disco: la chat tiene in memoria solo quelli nel widget e scorrendo
+    # in alto legge le pagine precedenti. id cresce nell'ordine di arrivo; la ricerca usa un indice FTS5 sul testo.
+    # storia_interlocutori ha una riga per ogni utente di ogni messaggio (più d'una se inviato a più destinatari):
+    # le pagine della conversazione con un utente si leggono da lì
+    def __init__(self, percorso):
+        # la usano il thread di Tk, quello del polling (messaggi ricevuti) e quello di rete (esiti degli invii)
+        self.db = apri_database(percorso)
+        self.lock = threading.Lock()
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS storia (
+                id INTEGER PRIMARY KEY,
+                tipo TEXT NOT NULL,
+                interlocutore TEXT NOT NULL,
+                destinatario TEXT,
+                messaggio TEXT NOT NULL,
+                creato REAL NOT NULL,
+                ora TEXT NOT NULL,
+                stato TEXT,
+                id_invio TEXT
+            );
+            DROP INDEX IF EXISTS storia_interlocutore;
+            CREATE INDEX IF NOT EXISTS storia_id_invio ON storia(id_invio) WHERE id_invio IS NOT NULL;
+            CREATE VIRTUAL TABLE IF NOT EXISTS storia_testo USING fts5(
+                messaggio, content='storia', content_rowid='id', prefix='2 3', detail='none'
+            );
+            CREATE TRIGGER IF NOT EXISTS storia_inserita AFTER INSERT ON storia BEGIN
+                INSERT INTO storia_testo (rowid, messaggio) VALUES (new.id, new.messaggio);
+            END;
+            CREATE TABLE IF NOT EXISTS storia_interlocutori (
+                interlocutore TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                PRIMARY KEY (interlocutore, id)
+            ) WITHOUT ROWID;
+        """)
+        # storia scritta da una versione senza storia_interlocutori: si riempie una volta sola
+        if (self.db.execute('SELECT 1 FROM storia_interlocutori LIMIT 1').fetchone() is None
+                and self.db.execute('SELECT 1 FROM storia LIMIT 1').fetchone() is not None):
+            self.db.execute('BEGIN')
+            try:
+                for id_riga, tipo, interlocutore in self.db.execute(
+                        'SELECT id, tipo, interlocutore FROM storia').fetchall():
+                    utenti = [interlocutore] if tipo == 'ricevuto' else interlocutore.split(', ')
+                    self.db.executemany('INSERT OR IGNORE INTO storia_interlocutori VALUES (?, ?)',
+                                        [(utente, id_riga) for utente in utenti])
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+    
+    def aggiungi(self, righe):
+        # righe della chat ('ricevuto' o 'inviato'), in una sola transazione; a ognuna viene dato il suo id
+        adesso = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                for riga in righe:
+                    utenti = interlocutori(riga)
+                    riga['id'] = self.db.execute(
+                        'INSERT INTO storia (tipo, interlocutore, destinatario, messaggio, creato, ora, stato, '
+                        'id_invio) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (riga['tipo'], ', '.join(utenti), riga.get('destinatario'), riga['messaggio'],
+                         riga.get('creato', adesso), riga['timestamp'], riga.get('stato'), riga.get('id_invio'))
+                    ).lastrowid
+                    self.db.executemany('INSERT OR IGNORE INTO storia_interlocutori VALUES (?, ?)',
+                                        [(utente, riga['id']) for utente in utenti])
+                self.db.execute('COMMIT')
+            except BaseException:
+                # senza, la transazione resterebbe aperta e il BEGIN successivo fallirebbe per sempre
+                self.db.execute('ROLLBACK')
+                raise
+    
+    def precedenti(self, prima_di=None, limite=200, interlocutore=None):
+        # le ultime righe con id minore di prima_di (tutte se None), dalla più vecchia; con interlocutore
+        # solo quelle della conversazione con lui, lette dal suo tratto di storia_interlocutori
+        if prima_di is None:
+            prima_di = 2 ** 63 - 1
+        with self.lock:
+            if interlocutore is None:
+                righe = self.db.execute(SELEZIONE_STORIA + ' WHERE id < ? ORDER BY id DESC LIMIT ?',
+                                        (prima_di, limite)).fetchall()
+            else:
+                righe = self.db.execute(
+                    SELEZIONE_STORIA + ' WHERE id IN (SELECT id FROM storia_interlocutori WHERE interlocutore = ? '
+                    'AND id < ? ORDER BY id DESC LIMIT ?) ORDER BY id DESC', (interlocutore, prima_di, limite)
+                ).fetchall()
+        return [riga_da_storia(riga) for riga in reversed(righe)]
+    
+    def cerca(self, testo, limite=MAX_RISULTATI_RICERCA):
+        # righe che contengono tutte le parole di testo, dalla più recente; "parola*" cerca l'inizio di parola.
+        # una parola intera legge dall'indice solo la sua lista, anche se è in metà dei messaggi; un inizio
+        # di 2 o 3 lettere ha il suo indice, uno più lungo unisce le liste di tutte le parole che iniziano così
+        parole = re.findall(r'([^\W_]+)(\*?)', testo)
+        if not parole:
+            return []
+        espressione = ' '.join(f'"{parola}"{asterisco}' for parola, asterisco in parole)
+        with self.lock:
+            righe = self.db.execute(
+                SELEZIONE_STORIA + ' WHERE id IN (SELECT rowid FROM storia_testo WHERE storia_testo MATCH ? '
+                'ORDER BY rowid DESC LIMIT ?) ORDER BY id DESC', (espressione, limite)
+            ).fetchall()
+        return [riga_da_storia(riga) for riga in righe]
+    
+    def id_invio_presenti(self, ids):
+        if not ids:
+            return set()
+        with self.lock:
+            return {id_invio for (id_invio,) in self.db.execute(
+                'SELECT id_invio FROM storia WHERE id_invio IN (%s)' % ','.join('?' * len(ids)), ids)}
+    
+    def aggiorna_invio(self, id_invio, destinatario, stato):
+        # restituisce gli utenti a cui era stato inviato, tutti anche se l'ultimo tentativo era solo per alcuni
+        with self.lock:
+            if destinatario is None:
+                self.db.execute('UPDATE storia SET stato = ? WHERE id_invio = ?', (stato, id_invio))
+            else:
+                self.db.execute('UPDATE storia SET destinatario = ?, stato = ? WHERE id_invio = ?',
+                                (destinatario, stato, id_invio))
+            return [utente for (utente,) in self.db.execute(
+                'SELECT interlocutore FROM storia_interlocutori WHERE id IN (SELECT id FROM storia WHERE id_invio = ?)',
+                (id_invio,))]
+    
+    def svuota(self, fatto=None):
+        # il testo si toglie dall'indice tutto insieme: righe della storia si cancellano solo qui.
+        # fatto() gira ancora con il lock preso: una riga scritta dopo la pulizia arriva a Tk dopo di lui
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('DELETE FROM storia')
+                self.db.execute('DELETE FROM storia_interlocutori')
+                self.db.execute("INSERT INTO storia_testo (storia_testo) VALUES ('delete-all')")
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            if fatto is not None:
+                fatto()
+
+SELEZIONE_STORIA = 'SELECT id, tipo, interlocutore, destinatario, messaggio, creato, ora, stato, id_invio FROM storia'
+
+def riga_da_storia(riga):
+    id_riga, tipo, interlocutore, destinatario, messaggio, creato, ora, stato, id_invio = riga
+    return {
+        'id': id_riga,
+        'tipo': tipo,
+        'mittente': interlocutore if tipo == 'ricevuto' else 'Tu',
+        'destinatari': interlocutore.split(', ') if tipo == 'inviato' else [],
+        'destinatario': destinatario,
+        'messaggio': messaggio,
+        'creato': creato,
+        'timestamp': ora,
+        'stato': stato,
+        'id_invio': id_invio
+    }
+
+def interlocutori(riga):
+    # gli utenti nella cui conversazione va la riga: chi l'ha mandata o a chi è stata inviata
+    if riga['tipo'] == 'ricevuto':
+        return [riga['mittente']]
+    if riga['tipo'] == 'inviato':
+        return riga['destinatari']
+    return []
+
+def apri_database(percorso):
+    percorso.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(percorso, check_same_thread=False, isolation_level=None)
+    # NORMAL in WAL: quello che è scritto sopravvive al crash del client, non a quello della macchina
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+def cartella_dati_client():
+    # come il server: nella home se si può, altrimenti nella cartella temporanea
+    cartella = Path.home() / '.messenger_client'
+    try:
+        cartella.mkdir(parents=True, exist_ok=True)
+        return cartella
+    except OSError:
+        return Path(tempfile.gettempdir()) / 'messenger_client'
+
+def file_dati_utente(nickname):
+    # il nickname può contenere qualsiasi carattere (anche / o ..), il nome del file no: come le caselle del server
+    cartella = cartella_dati_client()
+    percorso = cartella / (hashlib.sha1(nickname.encode('utf-8')).hexdigest() + '.db')
+    # il database di prima, con il nickname come nome: si sposta solo se quel nome restava nella cartella
+    if not percorso.exists() and nickname not in ('.', '..') and '/' not in nickname and '\\' not in nickname:
+        vecchio = cartella / f"{nickname}.db"
+        if vecchio.is_file():
+            # con i file del WAL, che possono contenere le ultime scritture
+            for suffisso in ('-wal', '-shm', ''):
+                origine = vecchio.with_name(vecchio.name + suffisso)
+                if origine.exists():
+                    origine.replace(percorso.with_name(percorso.name + suffisso))
+    return percorso
+
+def riga_in_uscita(voce):
+    # la riga della chat di un messaggio appena messo nella posta in uscita
+    return {
+        'mittente': 'Tu',
+        'destinatari': voce['destinatari'],
+        'destinatario': ', '.join(voce['destinatari']),
+        'messaggio': voce['messaggio'],
+        'creato': voce['creato'],
+        'timestamp': time.strftime("%H:%M:%S", time.localtime(voce['creato'])),
+        'tipo': 'inviato',
+        'stato': 'in_attesa',
+        'id_invio': voce['id']
+    }
+
+def suggerimento_server(response):
+    # Retry-After (solo in secondi) o riprova_tra nel corpo JSON, None se il server non dice niente
+    valore = response.headers.get('Retry-After')
+    if valore is None and response.headers.get('Content-Type', '').startswith('application/json'):
+        try:
+            valore = response.json().get('riprova_tra')
+        except ValueError:
+            valore = None
+    try:
+        return max(float(valore), 0) if valore is not None else None
+    except (TypeError, ValueError):
+        return None
 
 class LoginWindow:
-    def __init__(self):
-        self.window = tk.Tk()
+    def __init__(self, genitore=None, nickname=None):
+        # con genitore si riapre sopra la chat quando il token scade: modale e con il nickname della sessione
+        self.window = tk.Tk() if genitore is None else tk.Toplevel(genitore)
         self.window.title("Login Messenger")
         self.window.geometry("300x200")
         self.window.resizable(False, False)
         self.success = False
         self.nickname = None
+        # token di sessione rilasciato dal server al login, con la sua scadenza
+        self.token = None
+        self.scadenza_token = 0
         
         self.setup_gui()
+        if genitore is not None:
+            self.nickname_entry.insert(0, nickname)
+            self.nickname_entry.config(state='disabled')
+            self.window.transient(genitore)
+            # chiudere la finestra annulla il login, la chat resta disconnessa
+            self.window.protocol("WM_DELETE_WINDOW", self.window.quit)
+            self.window.grab_set()
+            self.password_entry.focus_set()
         
     def setup_gui(self):
         # main frame
@@ -73,8 +549,11 @@ class LoginWindow:
             response = requests.post(url, json=payload)
             
             if response.status_code == 200:
+                data = response.json()
                 self.success = True
                 self.nickname = nickname
+                self.token = data.get('token')
+                self.scadenza_token = data.get('scadenza', 0)
                 self.window.quit()  
             else:
                 messagebox.showerror("Errore", "Credenziali non valide!")
@@ -122,6 +601,147 @@ class LoginWindow:
         self.window.mainloop()
         return self.success, self.nickname
 
+def formatta_riga(msg):
+    # una riga per messaggio, così righe del widget e indici dei messaggi della conversazione restano allineati
+    testo_msg = msg['messaggio'].replace('\n', ' ')
+    if msg['tipo'] == 'inviato':
+        stato = {'in_attesa': " (in attesa)", 'non_consegnato': " (non consegnato)"}.get(msg.get('stato'), '')
+        return f"[{msg['timestamp']}] Tu → {msg['destinatario']}: {testo_msg}{stato}\n", 'inviato'
+    elif msg['tipo'] == 'ricevuto':
+        return f"[{msg['timestamp']}] {msg['mittente']}: {testo_msg}\n", 'ricevuto'
+    else:
+        return f"[{msg['timestamp']}] {testo_msg}\n", 'sistema'
+
+class Conversazione:
+    # una conversazione della chat: "Tutti" (interlocutore None) o quella con un utente. ogni conversazione
+    # ha il suo widget, che resta disegnato anche quando non si vede: tornarci non ridisegna niente.
+    # nel widget ci sono messaggi[:renderizzati_fino], una riga ciascuno; altri_precedenti se nella storia
+    # ce ne sono di più vecchi
+    def __init__(self, contenitore, interlocutore, leggi, max_righe, pagina):
+        self.interlocutore = interlocutore
+        # leggi(prima_di, limite): le righe della conversazione dalla storia
+        self.leggi = leggi
+        self.max_righe = max_righe
+        self.pagina = pagina
+        self.messaggi = []
+        self.renderizzati_fino = 0
+        self.altri_precedenti = False
+        # la prima pagina si legge quando la conversazione si apre la prima volta: fino ad allora
+        # i messaggi nuovi sono solo nella storia e nel conteggio dei non letti
+        self.caricata = False
+        self.caricata_fino = 0
+        self.non_letti = 0
+        
+        self.text = scrolledtext.ScrolledText(contenitore, state='disabled', height=15, font=('Arial', 9))
+        self.text.tag_config('inviato', foreground='blue')
+        self.text.tag_config('ricevuto', foreground='green')
+        self.text.tag_config('sistema', foreground='gray', font=('Arial', 8, 'italic'))
+        self.text.config(yscrollcommand=self.scroll)
+    
+    def titolo(self):
+        nome = self.interlocutore if self.interlocutore is not None else "Tutti"
+        return f"{nome} ({self.non_letti})" if self.non_letti else nome
+    
+    def carica(self):
+        self.caricata = True
+        self.messaggi = self.leggi(None, self.pagina)
+        self.altri_precedenti = len(self.messaggi) == self.pagina
+        self.caricata_fino = self.messaggi[-1]['id'] if self.messaggi else 0
+        self.aggiorna()
+    
+    def aggiungi(self, righe):
+        if not self.caricata:
+            return
+        # una riga già letta con la prima pagina può arrivare anche dal thread del polling: si salta. dopo
+        # ogni riga arriva una volta sola, ma non in ordine di id (un invio può passare davanti a un ricevuto)
+        self.messaggi.extend(riga for riga in righe if riga.get('id') is None or riga['id'] > self.caricata_fino)
+        self.aggiorna()
+    
+    def aggiorna(self):
+        # inserisce solo i messaggi nuovi, in coda
+        nuovi = self.messaggi[self.renderizzati_fino:]
+        if not nuovi:
+            return
+        
+        in_fondo = self.text.yview()[1] >= 0.999
+        
+        self.text.config(state='normal')
+        argomenti = []
+        for msg in nuovi:
+            argomenti.extend(formatta_riga(msg))
+        self.text.insert(tk.END, *argomenti)
+        self.renderizzati_fino += len(nuovi)
+        
+        # chi sta leggendo la storia non viene spostato: si taglia e si scorre solo se era in fondo.
+        # le righe tagliate escono anche dalla memoria, restano nella storia
+        if in_fondo:
+            eccesso = self.renderizzati_fino - self.max_righe
+            if eccesso > 0:
+                self.text.delete('1.0', f'{eccesso + 1}.0')
+                del self.messaggi[:eccesso]
+                self.renderizzati_fino -= eccesso
+                self.altri_precedenti = True
+            self.text.see(tk.END)
+        
+        self.text.config(state='disabled')
+    
+    def scroll(self, primo, ultimo):
+        self.text.vbar.set(primo, ultimo)
+        # un widget nascosto non si scorre: niente pagine lette per chi non guarda
+        if float(primo) <= 0.0 and self.altri_precedenti and self.text.winfo_ismapped():
+            self.text.after_idle(self.carica_precedenti)
+    
+    def carica_precedenti(self):
+        # scorrendo in cima si legge dalla storia la pagina prima della prima riga nel widget
+        if not self.altri_precedenti or self.text.yview()[0] > 0.0:
+            return
+        
+        prima_di = next((msg['id'] for msg in self.messaggi if msg.get('id') is not None), None)
+        precedenti = self.leggi(prima_di, self.pagina)
+        self.altri_precedenti = len(precedenti) == self.pagina
+        if not precedenti:
+            return
+        argomenti = []
+        for msg in precedenti:
+            argomenti.extend(formatta_riga(msg))
+        
+        self.text.config(state='normal')
+        self.text.insert('1.0', *argomenti)
+        self.text.config(state='disabled')
+        self.messaggi[:0] = precedenti
+        self.renderizzati_fino += len(precedenti)
+        
+        # la riga che era in cima resta in cima
+        self.text.yview(f'{len(precedenti) + 1}.0')
+    
+    def esito(self, id_messaggio, destinatario, stato):
+        # si cerca dal fondo, i messaggi in uscita sono recenti; se non è più nel widget basta la storia
+        for indice in range(len(self.messaggi) - 1, -1, -1):
+            riga = self.messaggi[indice]
+            if riga.get('id_invio') == id_messaggio:
+                break
+        else:
+            return
+        if destinatario is not None:
+            riga['destinatario'] = destinatario
+        riga['stato'] = stato
+        if indice < self.renderizzati_fino:
+            self.text.config(state='normal')
+            self.text.delete(f'{indice + 1}.0', f'{indice + 2}.0')
+            self.text.insert(f'{indice + 1}.0', *formatta_riga(riga))
+            self.text.config(state='disabled')
+    
+    def svuota(self):
+        self.messaggi = []
+        self.renderizzati_fino = 0
+        self.altri_precedenti = False
+        self.non_letti = 0
+        # la storia vuota riparte dagli id bassi (id senza AUTOINCREMENT)
+        self.caricata_fino = 0
+        self.text.config(state='normal')
+        self.text.delete('1.0', tk.END)
+        self.text.config(state='disabled')
+
 class MessengerClient:
     def __init__(self):
         # mostra prima la finestra di login (senza si romperebbe tutto)
@@ -135,12 +755,49 @@ class MessengerClient:
         login_window.window.destroy()
         
         self.nickname = nickname
+        self.token = login_window.token
+        self.scadenza_token = login_window.scadenza_token
+        # il server ha rifiutato il token: niente rinnovi finché non si rifà il login
+        self.token_scaduto = False
+        self.login_aperto = False
         self.porta_locale = 5000
         self.server_ip = "127.0.0.1"
         self.server_porta = 5001
-        self.messaggi = []
         self.connesso = False
         self.utenti_online = []
+        # long-poll: il server tiene aperta la richiesta finché arriva un messaggio
+        self.attesa_polling = 25
+        # stream SSE: se il server lo supporta sostituisce sia il polling che il keepalive
+        self.usa_stream = True
+        # stream e /sync rinnovano già il ping: il keepalive parte solo se tacciono da troppo
+        self.ultimo_contatto = 0
+        # attese tra un long-poll e l'altro e tra i keepalive; inviare un messaggio sveglia subito il polling
+        self.pianificatore = Pianificatore()
+        self.sveglia_polling = threading.Event()
+        # ultimo Retry-After/riprova_tra ricevuto dal polling
+        self.suggerimento = None
+        self.versione_presenza = None
+        # seq dell'ultimo messaggio ricevuto: con /sync vale da conferma, il server tiene il resto
+        # finché non lo confermiamo, così una risposta persa non perde messaggi
+        self.ultimo_seq = 0
+        # connessioni keep-alive riusate da tutte le richieste, tutte con il token di sessione
+        self.sessione = requests.Session()
+        self.sessione.headers['Authorization'] = f"Bearer {self.token}"
+        # messaggi in uscita non ancora accettati dal server, su disco; partono insieme in un solo batch.
+        # nello stesso database c'è la storia della chat
+        percorso_dati = file_dati_utente(self.nickname)
+        self.uscita = PostaInUscita(percorso_dati)
+        self.storia = Storia(percorso_dati)
+        # dopo un errore di rete gli invii aspettano il backoff, ma ripartono appena il polling torna a rispondere
+        self.pianificatore_invio = Pianificatore()
+        self.invio_fermo_per_rete = False
+        # funzioni da eseguire nel thread di Tk, nell'ordine in cui i thread di rete le hanno passate
+        self.da_applicare = []
+        self.lock_tk = threading.Lock()
+        self.applicazione_programmata = False
+        # righe tenute nel widget di ogni conversazione, le più vecchie si rileggono dalla storia scorrendo in alto
+        self.max_righe_chat = 2000
+        self.pagina_chat = 200
         
         self.root = tk.Tk()
         self.root.title(f"Messenger Chat - {self.nickname}")
@@ -148,8 +805,9 @@ class MessengerClient:
         self.root.minsize(700, 750)
         
         self.setup_gui()
+        self.lavoratore = LavoratoreIO(self.controlla_keepalive, self.pianificatore.intervallo_keepalive)
+        self.carica_storia()
         self.avvia_thread_polling()
-        self.avvia_thread_keepalive()
         
         self.trova_porta_libera_automatica()
         
@@ -209,11 +867,30 @@ class MessengerClient:
         ttk.Button(btn_frame, text="Aggiorna Lista", command=self.aggiorna_utenti_online).pack(side='left')
         ttk.Button(btn_frame, text="Seleziona per Chat", command=self.seleziona_da_lista).pack(side='left', padx=10)
         
-        frame_chat = ttk.LabelFrame(self.root, text="Conversazione")
+        frame_chat = ttk.LabelFrame(self.root, text="Conversazioni")
         frame_chat.pack(fill='both', expand=True, padx=10, pady=5)
         
-        self.text_chat = scrolledtext.ScrolledText(frame_chat, state='disabled', height=15, font=('Arial', 9))
-        self.text_chat.pack(fill='both', expand=True, padx=5, pady=5)
+        # a sinistra le conversazioni, dalla più recente, con i messaggi non letti; a destra quella aperta
+        self.listbox_conversazioni = tk.Listbox(frame_chat, width=18, font=('Arial', 9), exportselection=False)
+        self.listbox_conversazioni.pack(side='left', fill='y', padx=(5, 0), pady=5)
+        self.listbox_conversazioni.bind('<<ListboxSelect>>', self.seleziona_conversazione)
+        
+        self.frame_conversazione = ttk.Frame(frame_chat)
+        self.frame_conversazione.pack(side='left', fill='both', expand=True, padx=5, pady=5)
+        self.frame_conversazione.rowconfigure(0, weight=1)
+        self.frame_conversazione.columnconfigure(0, weight=1)
+        
+        # interlocutore -> Conversazione; elenco_conversazioni segue le righe della Listbox (None è "Tutti")
+        self.tutti = Conversazione(self.frame_conversazione, None,
+                                   lambda prima_di, limite: self.storia.precedenti(prima_di, limite),
+                                   self.max_righe_chat, self.pagina_chat)
+        self.conversazioni = {}
+        self.elenco_conversazioni = [None]
+        self.listbox_conversazioni.insert(tk.END, self.tutti.titolo())
+        # "Tutti" è aperta fin dall'inizio, la riempie carica_storia
+        self.attiva = self.tutti
+        self.tutti.text.grid(row=0, column=0, sticky='nsew')
+        self.seleziona_voce_attiva()
         
         frame_invio = ttk.LabelFrame(self.root, text="Invia Messaggio")
         frame_invio.pack(fill='x', padx=10, pady=5)
@@ -221,7 +898,7 @@ class MessengerClient:
         row_dest = ttk.Frame(frame_invio)
         row_dest.pack(fill='x', padx=5, pady=5)
         
-        ttk.Label(row_dest, text="A:").pack(side='left', padx=(0, 5))
+        ttk.Label(row_dest, text="A (separati da virgola):").pack(side='left', padx=(0, 5))
         self.entry_destinatario = ttk.Entry(row_dest, width=20, font=('Arial', 9))
         self.entry_destinatario.pack(side='left', padx=(0, 10), fill='x', expand=True)
         
@@ -239,7 +916,14 @@ class MessengerClient:
         frame_buttons = ttk.Frame(self.root)
         frame_buttons.pack(fill='x', padx=10, pady=10)
         
-        ttk.Button(frame_buttons, text="Pulisci Chat", command=self.pulisci_chat).pack(side='left')
+        self.btn_pulisci = ttk.Button(frame_buttons, text="Pulisci Chat", command=self.pulisci_chat)
+        self.btn_pulisci.pack(side='left')
+        
+        ttk.Button(frame_buttons, text="Cerca", command=self.cerca_nella_storia).pack(side='right')
+        self.entry_cerca = ttk.Entry(frame_buttons, width=25, font=('Arial', 9))
+        self.entry_cerca.pack(side='right', padx=5)
+        self.entry_cerca.bind('<Return>', lambda e: self.cerca_nella_storia())
+        ttk.Label(frame_buttons, text="Cerca nella storia:").pack(side='right')
 
     def connetti_chat(self):
         if self.connesso:
@@ -259,34 +943,40 @@ class MessengerClient:
                         'porta': self.porta_locale
                     }
                     
-                    response = requests.post(url, json=payload, timeout=10)
+                    response = self.sessione.post(url, json=payload, timeout=10)
                     
                     if response.status_code == 200:
                         data = response.json()
+                        # i seq valgono per la sessione appena aperta
+                        self.ultimo_seq = 0
                         self.connesso = True
-                        self.root.after(0, lambda: self.connessione_riuscita(data))
+                        self.in_tk(self.connessione_riuscita, data)
+                        break
+                    elif response.status_code == 401:
+                        # token scaduto: riprovare non serve, si torna al login
+                        self.token_scaduto = True
+                        self.in_tk(self.sessione_scaduta, True)
                         break
                     else:
                         data = response.json()
                         messaggio_errore = data.get('messaggio', 'Errore sconosciuto')
                         if tentativo == MAX_TENTATIVI - 1:
-                            self.root.after(0, lambda: self.connessione_fallita(f"Errore: {messaggio_errore}"))
+                            self.in_tk(self.connessione_fallita, f"Errore: {messaggio_errore}")
                         
                 except requests.exceptions.Timeout:
                     if tentativo == MAX_TENTATIVI - 1:
-                        self.root.after(0, lambda: self.connessione_fallita("Timeout: il server non risponde."))
+                        self.in_tk(self.connessione_fallita, "Timeout: il server non risponde.")
                 except requests.exceptions.ConnectionError as e:
                     if tentativo == MAX_TENTATIVI - 1:
-                        self.root.after(0, lambda: self.connessione_fallita("Impossibile connettersi al server."))
+                        self.in_tk(self.connessione_fallita, "Impossibile connettersi al server.")
                 except Exception as e:
                     if tentativo == MAX_TENTATIVI - 1:
-                        self.root.after(0, lambda: self.connessione_fallita(f"Errore di connessione: {str(e)}"))
+                        self.in_tk(self.connessione_fallita, f"Errore di connessione: {str(e)}")
                 
                 if tentativo < MAX_TENTATIVI - 1:
                     time.sleep(2)
         
-        thread = threading.Thread(target=connetti, daemon=True)
-        thread.start()
+        self.lavoratore.sottometti(connetti, 'connetti')
     
     def connessione_riuscita(self, data):
         utenti_count = data.get('utenti_online', 0)
@@ -299,8 +989,13 @@ class MessengerClient:
         self.btn_connetti.config(state='disabled')
         self.btn_disconnetti.config(state='normal')
         
+        # la lista degli utenti arriva con il primo evento dello stream o il primo /sync
         self.aggiungi_messaggio_sistema(f"✓ Connesso alla chat come '{self.nickname}'")
-        self.aggiorna_utenti_online()
+        arretrati = data.get('arretrati', 0)
+        if arretrati:
+            self.aggiungi_messaggio_sistema(f"{arretrati} messaggi ricevuti mentre eri offline")
+        # quello che è rimasto in uscita parte adesso, tutto insieme
+        self.riprendi_invii()
         
         messagebox.showinfo("Connesso", f"Benvenuto nella chat, {self.nickname}!")
     
@@ -309,19 +1004,16 @@ class MessengerClient:
         self.btn_connetti.config(state='normal')
         messagebox.showerror("Errore di Connessione", messaggio)
     
-    def disconnetti_server(self):
+    def disconnetti_server(self, avvisa_server=True):
         if not self.connesso:
             return
         
-        try:
-            url = f"http://{self.server_ip}:{self.server_porta}/disconnetti"
-            payload = {'nickname': self.nickname}
-            requests.post(url, json=payload, timeout=3)
-        except Exception as e:
-            pass
-        
+        # la finestra si aggiorna subito, la richiesta parte dopo quelle già in coda
+        if avvisa_server:
+            self.lavoratore.sottometti(self.avvisa_disconnessione)
         self.connesso = False
         self.utenti_online = []
+        self.versione_presenza = None
         
         self.btn_connetti.config(state='normal')
         self.btn_disconnetti.config(state='disabled')
@@ -330,72 +1022,299 @@ class MessengerClient:
         self.listbox_utenti.delete(0, tk.END)
         self.entry_destinatario.delete(0, tk.END)
         self.aggiungi_messaggio_sistema("✗ Disconnesso dalla chat")
+    
+    def avvisa_disconnessione(self):
+        try:
+            url = f"http://{self.server_ip}:{self.server_porta}/disconnetti"
+            payload = {'nickname': self.nickname}
+            self.sessione.post(url, json=payload, timeout=3)
+        except Exception as e:
+            pass
 
     def avvia_thread_polling(self):
         def polling_loop():
             while True:
-                time.sleep(2)
-                if self.connesso:
-                    self.recupera_messaggi()
+                if not self.connesso:
+                    time.sleep(1)
+                    continue
+                self.suggerimento = None
+                if self.usa_stream:
+                    riuscito = self.ascolta_stream()
+                    attesa = self.pianificatore.dopo_stream() if riuscito else self.pianificatore.dopo_errore(self.suggerimento)
+                elif self.sincronizza():
+                    attesa = self.pianificatore.dopo_successo(time.time(), self.suggerimento)
+                else:
+                    attesa = self.pianificatore.dopo_errore(self.suggerimento)
+                if attesa > 0:
+                    self.sveglia_polling.wait(attesa)
+                    self.sveglia_polling.clear()
         
         polling_thread = threading.Thread(target=polling_loop, daemon=True)
         polling_thread.start()
     
-    def avvia_thread_keepalive(self):
-        def keepalive_loop():
-            while True:
-                time.sleep(30)
-                if self.connesso:
-                    self.invia_keepalive()
-        
-        keepalive_thread = threading.Thread(target=keepalive_loop, daemon=True)
-        keepalive_thread.start()
+    def controlla_keepalive(self):
+        # nel thread di rete, ogni intervallo_keepalive()
+        # il token si rinnova nell'ultima ora di validità, anche da disconnessi
+        if not self.token_scaduto and self.scadenza_token - time.time() < 3600:
+            self.rinnova_token()
+        if self.connesso and time.time() - self.ultimo_contatto >= MAX_SILENZIO:
+            self.invia_keepalive()
+    
+    def in_tk(self, funzione, *argomenti):
+        # da qualsiasi thread: funzione(*argomenti) gira nel thread di Tk, in ordine di arrivo.
+        # un solo after per gruppo di risultati, anche se ne arrivano molti insieme
+        with self.lock_tk:
+            self.da_applicare.append((funzione, argomenti))
+            if self.applicazione_programmata:
+                return
+            self.applicazione_programmata = True
+        self.root.after(0, self.applica_in_tk)
+    
+    def applica_in_tk(self):
+        with self.lock_tk:
+            lavori = self.da_applicare
+            self.da_applicare = []
+            self.applicazione_programmata = False
+        for funzione, argomenti in lavori:
+            funzione(*argomenti)
     
     def invia_keepalive(self):
         try:
             url = f"http://{self.server_ip}:{self.server_porta}/ping"
-            payload = {'nickname': self.nickname}
-            response = requests.post(url, json=payload, timeout=5)
+            # con la conferma di quello che è già in storia: lo stream non ha altre richieste per farla
+            payload = {'nickname': self.nickname, 'after': self.ultimo_seq}
+            response = self.sessione.post(url, json=payload, timeout=5)
             
             if response.status_code == 200:
+                self.ultimo_contatto = time.time()
                 data = response.json()
-                utenti_count = data.get('utenti_online', 0)
-                
-                self.root.after(0, lambda: self.label_stato.config(
-                    text=f"Connesso come '{self.nickname}' - {utenti_count} utenti online"
-                ))
+                self.aggiorna_conteggio_utenti(data.get('utenti_online', 0))
             else:
-                self.root.after(0, self.disconnetti_server)
+                self.in_tk(self.disconnetti_server)
                 
         except Exception:
             pass
     
-    def recupera_messaggi(self):
+    def rinnova_token(self):
         try:
-            url = f"http://{self.server_ip}:{self.server_porta}/messaggi/{self.nickname}"
-            response = requests.get(url, timeout=5)
+            url = f"http://{self.server_ip}:{self.server_porta}/rinnova_token"
+            response = self.sessione.post(url, timeout=5)
             
             if response.status_code == 200:
                 data = response.json()
-                messaggi = data.get('messaggi', [])
+                self.scadenza_token = data['scadenza']
+                self.sessione.headers['Authorization'] = f"Bearer {data['token']}"
+            elif response.status_code == 401:
+                self.token_scaduto = True
+                self.in_tk(self.sessione_scaduta, self.connesso)
                 
-                for msg in messaggi:
-                    nuovo_msg = {
-                        'mittente': msg['mittente'],
-                        'messaggio': msg['messaggio'],
-                        'timestamp': msg['timestamp_str'],
-                        'tipo': 'ricevuto'
-                    }
-                    self.messaggi.append(nuovo_msg)
+        except Exception:
+            pass
+    
+    def sessione_scaduta(self, riconnetti):
+        # nel thread di Tk: il login si rifà con lo stesso nickname, poi si rientra in chat se lo eravamo
+        if self.login_aperto:
+            return
+        self.login_aperto = True
+        # con il token scaduto il server rifiuterebbe /disconnetti: lo si avvisa dopo il nuovo login
+        self.disconnetti_server(avvisa_server=False)
+        self.label_stato.config(text="Sessione scaduta, rifai il login", foreground="red")
+        self.btn_connetti.config(state='normal')
+        
+        login_window = LoginWindow(self.root, self.nickname)
+        success, _ = login_window.run()
+        login_window.window.destroy()
+        self.login_aperto = False
+        if not success:
+            return
+        
+        self.token = login_window.token
+        self.scadenza_token = login_window.scadenza_token
+        self.sessione.headers['Authorization'] = f"Bearer {self.token}"
+        self.token_scaduto = False
+        if riconnetti:
+            # il server può averci ancora online dalla sessione scaduta: prima si esce, poi si rientra
+            self.lavoratore.sottometti(self.avvisa_disconnessione)
+            self.connetti_chat()
+    
+    def aggiorna_conteggio_utenti(self, utenti_count):
+        self.in_tk(lambda: self.label_stato.config(
+            text=f"Connesso come '{self.nickname}' - {utenti_count} utenti online"
+        ))
+    
+    def ascolta_stream(self):
+        try:
+            url = f"http://{self.server_ip}:{self.server_porta}/stream/{self.nickname}"
+            # il timeout di lettura copre due keepalive persi. con Last-Event-ID il server conferma fin lì
+            # e manda solo i successivi, senza toglierli finché non arriva la conferma
+            intestazioni = {'Last-Event-ID': str(self.ultimo_seq)}
+            with self.sessione.get(url, stream=True, timeout=(5, 35), headers=intestazioni) as response:
+                if response.status_code == 404:
+                    # server senza stream, si torna al long-poll
+                    self.usa_stream = False
+                    return True
+                elif response.status_code == 401:
+                    self.in_tk(self.disconnetti_server)
+                    return False
+                elif response.status_code != 200:
+                    self.suggerimento = suggerimento_server(response)
+                    return False
+                self.rete_tornata()
                 
-                if messaggi:
-                    self.root.after(0, self.aggiorna_chat)
+                evento = None
+                for riga in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if not self.connesso:
+                        break
+                    self.ultimo_contatto = time.time()
+                    if riga.startswith('event:'):
+                        evento = riga[6:].strip()
+                    elif riga.startswith('data:'):
+                        self.gestisci_evento(evento, json.loads(riga[5:]))
+                    elif not riga:
+                        evento = None
+            return True
+            
+        except Exception:
+            return False
+    
+    def gestisci_evento(self, evento, data):
+        if evento == 'messaggi':
+            self.ricevi_messaggi(data.get('messaggi', []))
+            # ora sono in storia: una sola conferma per tutti quelli arrivati nel frattempo
+            self.lavoratore.sottometti_tra(RITARDO_CONFERMA_STREAM, self.invia_keepalive, 'conferma')
+        elif evento == 'utenti_online':
+            self.applica_presenza(data)
+        elif evento == 'disconnesso':
+            self.in_tk(self.disconnetti_server)
+    
+    def ricevi_messaggi(self, messaggi):
+        nuovi = []
+        for msg in messaggi:
+            # dopo una risposta persa il server rimanda anche quelli già visti
+            seq = msg.get('seq', 0)
+            if seq and seq <= self.ultimo_seq:
+                continue
+            self.ultimo_seq = max(self.ultimo_seq, seq)
+            self.pianificatore.attivita(time.time())
+            nuovo_msg = {
+                'mittente': msg['mittente'],
+                'messaggio': msg['messaggio'],
+                'timestamp': msg['timestamp_str'],
+                'tipo': 'ricevuto'
+            }
+            nuovi.append(nuovo_msg)
+        
+        if nuovi:
+            # su disco prima della prossima richiesta, che li conferma al server
+            self.storia.aggiungi(nuovi)
+            self.in_tk(self.mostra_nuovi, nuovi)
+    
+    def mostra_nuovi(self, righe):
+        # nel thread di Tk: ogni riga va in "Tutti" e nella conversazione del suo utente, le altre non si toccano
+        per_utente = {}
+        for riga in righe:
+            for utente in dict.fromkeys(interlocutori(riga)):
+                per_utente.setdefault(utente, []).append(riga)
+        self.aggiungi_a_conversazione(self.tutti, righe)
+        for utente, sue in per_utente.items():
+            self.aggiungi_a_conversazione(self.conversazione(utente), sue)
+    
+    def aggiungi_a_conversazione(self, conversazione, righe):
+        conversazione.aggiungi(righe)
+        if conversazione is not self.attiva:
+            conversazione.non_letti += sum(riga['tipo'] == 'ricevuto' for riga in righe)
+        # la conversazione con un utente sale in cima all'elenco, "Tutti" resta sempre la prima
+        self.aggiorna_voce(conversazione, conversazione is not self.tutti)
+    
+    def conversazione(self, utente):
+        # quella con utente, creata se non c'è ancora: vuota finché non si apre
+        conversazione = self.conversazioni.get(utente)
+        if conversazione is None:
+            conversazione = self.conversazioni[utente] = Conversazione(
+                self.frame_conversazione, utente,
+                lambda prima_di, limite: self.storia.precedenti(prima_di, limite, utente),
+                self.max_righe_chat, self.pagina_chat)
+            self.elenco_conversazioni.insert(1, utente)
+            self.listbox_conversazioni.insert(1, conversazione.titolo())
+            self.seleziona_voce_attiva()
+        return conversazione
+    
+    def aggiorna_voce(self, conversazione, in_cima=False):
+        # riscrive la riga della conversazione nell'elenco, spostandola in cima se serve
+        indice = self.elenco_conversazioni.index(conversazione.interlocutore)
+        nuovo = 1 if in_cima else indice
+        if nuovo == indice and self.listbox_conversazioni.get(indice) == conversazione.titolo():
+            return
+        self.listbox_conversazioni.delete(indice)
+        del self.elenco_conversazioni[indice]
+        self.listbox_conversazioni.insert(nuovo, conversazione.titolo())
+        self.elenco_conversazioni.insert(nuovo, conversazione.interlocutore)
+        self.seleziona_voce_attiva()
+    
+    def seleziona_voce_attiva(self):
+        # inserire e togliere righe nella Listbox sposta la selezione: si rimette su quella aperta
+        if self.attiva is None:
+            return
+        indice = self.elenco_conversazioni.index(self.attiva.interlocutore)
+        self.listbox_conversazioni.selection_clear(0, tk.END)
+        self.listbox_conversazioni.selection_set(indice)
+    
+    def seleziona_conversazione(self, event=None):
+        selection = self.listbox_conversazioni.curselection()
+        if selection:
+            utente = self.elenco_conversazioni[selection[0]]
+            self.apri_conversazione(self.tutti if utente is None else self.conversazioni[utente])
+    
+    def apri_conversazione(self, conversazione):
+        # cambiare conversazione mostra un widget già disegnato al posto di un altro: la prima volta
+        # legge solo l'ultima pagina della sua storia
+        if self.attiva is not None and self.attiva is not conversazione:
+            self.attiva.text.grid_remove()
+        self.attiva = conversazione
+        conversazione.text.grid(row=0, column=0, sticky='nsew')
+        if not conversazione.caricata:
+            conversazione.carica()
+        conversazione.non_letti = 0
+        self.aggiorna_voce(conversazione)
+        self.seleziona_voce_attiva()
+        if conversazione.interlocutore is not None:
+            self.entry_destinatario.delete(0, tk.END)
+            self.entry_destinatario.insert(0, conversazione.interlocutore)
+    
+    def applica_presenza(self, data):
+        self.aggiorna_conteggio_utenti(data.get('utenti_online', 0))
+        
+        # lista intera o entrati/usciti arrivano solo se qualcosa è cambiato dalla nostra versione
+        if 'utenti' in data or 'entrati' in data or 'usciti' in data:
+            self.in_tk(self.popola_lista_utenti, data)
+    
+    def sincronizza(self):
+        # un solo giro: ping, messaggi in long-poll e cambi di presenza
+        try:
+            url = f"http://{self.server_ip}:{self.server_porta}/sync"
+            payload = {
+                'nickname': self.nickname,
+                'wait': self.pianificatore.attesa_poll(self.attesa_polling),
+                'versione_presenza': self.versione_presenza,
+                'after': self.ultimo_seq
+            }
+            response = self.sessione.post(url, json=payload, timeout=self.attesa_polling + 5)
+            self.suggerimento = suggerimento_server(response)
+            
+            if response.status_code == 200:
+                self.ultimo_contatto = time.time()
+                self.rete_tornata()
+                data = response.json()
+                self.ricevi_messaggi(data.get('messaggi', []))
+                self.applica_presenza(data)
+                return True
                     
             elif response.status_code == 401:
-                self.root.after(0, self.disconnetti_server)
+                self.in_tk(self.disconnetti_server)
                 
         except Exception:
             pass
+        return False
     
     def aggiorna_utenti_online(self):
         if not self.connesso:
@@ -404,54 +1323,68 @@ class MessengerClient:
         def aggiorna():
             try:
                 url = f"http://{self.server_ip}:{self.server_porta}/utenti_online"
-                response = requests.get(url, timeout=5)
+                # con la versione che abbiamo il server manda solo entrati e usciti
+                params = {'since': self.versione_presenza} if self.versione_presenza is not None else {}
+                response = self.sessione.get(url, params=params, timeout=5)
                 
                 if response.status_code == 200:
-                    data = response.json()
-                    utenti = data.get('utenti', [])
-                    
-                    if self.nickname in utenti:
-                        utenti.remove(self.nickname)
-                    
-                    self.utenti_online = utenti
-                    self.root.after(0, self.popola_lista_utenti)
+                    self.applica_presenza(response.json())
                     
             except Exception:
                 pass
         
-        thread = threading.Thread(target=aggiorna, daemon=True)
-        thread.start()
+        # i clic ripetuti mentre una richiesta aspetta in coda ne fanno partire una sola
+        self.lavoratore.sottometti(aggiorna, 'utenti_online')
     
-    def popola_lista_utenti(self):
-        self.listbox_utenti.delete(0, tk.END)
+    def popola_lista_utenti(self, data):
+        # gira nel thread di Tk, così versione e Listbox cambiano sempre insieme e in ordine
+        versione = data.get('versione_presenza')
+        if versione is not None and self.versione_presenza is not None and versione <= self.versione_presenza:
+            return
         
-        if not self.utenti_online:
-            self.listbox_utenti.insert(tk.END, "(Nessun altro utente online)")
+        if 'utenti' in data:
+            self.utenti_online = [utente for utente in data['utenti'] if utente != self.nickname]
+            self.listbox_utenti.delete(0, tk.END)
+            if self.utenti_online:
+                self.listbox_utenti.insert(tk.END, *self.utenti_online)
         else:
-            for utente in self.utenti_online:
-                self.listbox_utenti.insert(tk.END, utente)
+            # solo le righe che cambiano, senza ricostruire la Listbox
+            for utente in data.get('usciti', []):
+                if utente in self.utenti_online:
+                    indice = self.utenti_online.index(utente)
+                    del self.utenti_online[indice]
+                    self.listbox_utenti.delete(indice)
+            
+            nuovi = [utente for utente in data.get('entrati', [])
+                     if utente != self.nickname and utente not in self.utenti_online]
+            if nuovi:
+                if not self.utenti_online:
+                    # toglie il segnaposto
+                    self.listbox_utenti.delete(0, tk.END)
+                self.utenti_online.extend(nuovi)
+                self.listbox_utenti.insert(tk.END, *nuovi)
+        
+        if not self.utenti_online and not self.listbox_utenti.size():
+            self.listbox_utenti.insert(tk.END, SEGNAPOSTO_LISTA_UTENTI)
+        self.versione_presenza = versione
     
     def seleziona_da_lista(self):
         selection = self.listbox_utenti.curselection()
         if selection:
             utente = self.listbox_utenti.get(selection[0])
-            if utente != "(Nessun altro utente online)":
-                self.entry_destinatario.delete(0, tk.END)
-                self.entry_destinatario.insert(0, utente)
+            if utente != SEGNAPOSTO_LISTA_UTENTI:
+                self.apri_conversazione(self.conversazione(utente))
                 self.entry_messaggio.focus()
     
     def seleziona_da_lista_doppio_click(self, event):
         self.seleziona_da_lista()
     
     def invia_messaggio(self):
-        if not self.connesso:
-            messagebox.showwarning("Avviso", "Non sei connesso alla chat!")
-            return
-        
-        destinatario = self.entry_destinatario.get().strip()
+        # più destinatari separati da virgola -> un solo messaggio multicast
+        destinatari = [d.strip() for d in self.entry_destinatario.get().split(',') if d.strip()]
         messaggio = self.entry_messaggio.get().strip()
         
-        if not destinatario:
+        if not destinatari:
             messagebox.showwarning("Avviso", "Seleziona un destinatario!")
             self.entry_destinatario.focus()
             return
@@ -462,64 +1395,139 @@ class MessengerClient:
             return
         
         self.entry_messaggio.delete(0, tk.END)
-        
-        def invia():
+        # conversazione attiva: il polling torna veloce, anche se stava aspettando da inattivo
+        self.pianificatore.attivita(time.time())
+        self.sveglia_polling.set()
+        
+        # prima su disco e in chat come "in attesa", poi in rete: la finestra non aspetta mai il server
+        voce = self.uscita.aggiungi(destinatari, messaggio)
+        riga = riga_in_uscita(voce)
+        self.storia.aggiungi([riga])
+        self.mostra_nuovi([riga])
+        # se un invio aspetta già nel thread di rete (anche per il backoff) partirà anche questo, nello stesso batch
+        self.lavoratore.sottometti(self.svuota_coda_invio, 'invio')
+    
+    def carica_storia(self):
+        # all'avvio: l'ultima pagina della storia in "Tutti", e nell'elenco gli utenti che vi compaiono.
+        # un messaggio in uscita che non è nella storia (il client si è chiuso tra le due scritture)
+        # ci viene aggiunto adesso
+        voci = self.uscita.voci()
+        presenti = self.storia.id_invio_presenti([voce['id'] for voce in voci])
+        mancanti = [riga_in_uscita(voce) for voce in voci if voce['id'] not in presenti]
+        if mancanti:
+            self.storia.aggiungi(mancanti)
+        self.tutti.carica()
+        for riga in self.tutti.messaggi:
+            for utente in interlocutori(riga):
+                self.aggiorna_voce(self.conversazione(utente), True)
+    
+    def riprendi_invii(self):
+        # quello che è in uscita parte subito, anche se stava aspettando il backoff
+        if not self.lavoratore.sottometti(self.svuota_coda_invio, 'invio'):
+            self.lavoratore.anticipa('invio')
+    
+    def rete_tornata(self):
+        # dal thread del polling, quando il server risponde di nuovo
+        if self.invio_fermo_per_rete:
+            self.invio_fermo_per_rete = False
+            self.riprendi_invii()
+    
+    def svuota_coda_invio(self):
+        # nel thread di rete: un batch dalla posta in uscita. se qualcosa resta da consegnare si riprova
+        # più tardi, sempre con un solo batch, così un server in difficoltà non riceve una raffica di tentativi
+        if not self.connesso:
+            # riparte con connessione_riuscita
+            return
+        voci = self.uscita.voci(MAX_CONSEGNE_INVIO)
+        if not voci:
+            return
+        attesa = self.invia_batch(voci)
+        if attesa is not None:
+            self.lavoratore.sottometti_tra(attesa, self.svuota_coda_invio, 'invio')
+        elif not self.uscita.vuota():
+            self.lavoratore.sottometti(self.svuota_coda_invio, 'invio')
+    
+    def invia_batch(self, voci):
+        # restituisce fra quanti secondi riprovare quello che resta in uscita, None se non c'è da riprovare
+        try:
+            url = f"http://{self.server_ip}:{self.server_porta}/invia_messaggi"
+            payload = {
+                'mittente': self.nickname,
+                'messaggi': [{'id': voce['id'], 'destinatari': voce['destinatari'], 'messaggio': voce['messaggio']}
+                             for voce in voci]
+            }
+            response = self.sessione.post(url, json=payload, timeout=5)
+        except requests.exceptions.RequestException:
+            self.invio_fermo_per_rete = True
+            return self.pianificatore_invio.dopo_errore()
+        
+        if response.status_code == 401:
+            # alla prossima connessione si riparte da dove si era rimasti
+            self.in_tk(self.disconnetti_server)
+            return None
+        if response.status_code == 429 or response.status_code >= 500:
+            self.invio_fermo_per_rete = response.status_code >= 500
+            return self.pianificatore_invio.dopo_errore(suggerimento_server(response))
+        if response.status_code != 200:
+            # richiesta rifiutata: rispedirla darebbe lo stesso errore
             try:
-                url = f"http://{self.server_ip}:{self.server_porta}/invia_messaggio"
-                payload = {
-                    'mittente': self.nickname,
-                    'destinatario': destinatario,
-                    'messaggio': messaggio
-                }
-                
-                response = requests.post(url, json=payload, timeout=5)
-                
-                if response.status_code == 200:
-                    nuovo_msg = {
-                        'mittente': 'Tu',
-                        'destinatario': destinatario,
-                        'messaggio': messaggio,
-                        'timestamp': time.strftime("%H:%M:%S"),
-                        'tipo': 'inviato'
-                    }
-                    
-                    self.messaggi.append(nuovo_msg)
-                    self.root.after(0, self.aggiorna_chat)
-                    
-                elif response.status_code == 404:
-                    self.root.after(0, lambda: messagebox.showerror("Errore", f"Utente '{destinatario}' non trovato o offline!"))
-                else:
-                    data = response.json()
-                    errore = data.get('messaggio', 'Errore sconosciuto')
-                    self.root.after(0, lambda: messagebox.showerror("Errore", f"Errore invio: {errore}"))
-                    
-            except Exception as e:
-                self.root.after(0, lambda: messagebox.showerror("Errore", f"Errore invio messaggio: {e}"))
-        
-        thread = threading.Thread(target=invia, daemon=True)
-        thread.start()
-    
-    def aggiorna_chat(self):
-        self.text_chat.config(state='normal')
-        self.text_chat.delete(1.0, tk.END)
-        
-        for msg in self.messaggi:
-            if msg['tipo'] == 'inviato':
-                testo = f"[{msg['timestamp']}] Tu → {msg['destinatario']}: {msg['messaggio']}\n"
-                self.text_chat.insert(tk.END, testo, 'inviato')
-            elif msg['tipo'] == 'ricevuto':
-                testo = f"[{msg['timestamp']}] {msg['mittente']}: {msg['messaggio']}\n"
-                self.text_chat.insert(tk.END, testo, 'ricevuto')
+                errore = response.json().get('messaggio', 'Errore sconosciuto')
+            except ValueError:
+                errore = f"HTTP {response.status_code}"
+            for voce in voci:
+                self.uscita.rimuovi(voce['id'])
+                self.registra_esito(voce['id'], [], [])
+            self.in_tk(messagebox.showerror, "Errore", f"Errore invio: {errore}")
+            return None
+        
+        self.pianificatore_invio.azzera_errori()
+        data = response.json()
+        non_trovati = []
+        da_riprovare = False
+        for voce, risultato in zip(voci, data.get('risultati', [])):
+            esiti = risultato.get('esiti', {})
+            # 'differito': destinatario offline, il server lo consegna al suo prossimo accesso
+            consegnati = [d if esiti.get(d) == 'ok' else f"{d} (offline)"
+                          for d in voce['destinatari'] if esiti.get(d) in ('ok', 'differito')]
+            non_trovati += [d for d in voce['destinatari'] if esiti.get(d) == 'non_trovato']
+            # 'piena' o 'in_corso' (lo sta consegnando una richiesta precedente): si riprova con lo stesso id
+            restano = [d for d in voce['destinatari'] if esiti.get(d) in ('piena', 'in_corso')]
+            
+            if restano:
+                self.uscita.aggiorna(voce['id'], restano)
+                da_riprovare = True
             else:
-                testo = f"[{msg['timestamp']}] {msg['messaggio']}\n"
-                self.text_chat.insert(tk.END, testo, 'sistema')
-        
-        self.text_chat.tag_config('inviato', foreground='blue')
-        self.text_chat.tag_config('ricevuto', foreground='green')
-        self.text_chat.tag_config('sistema', foreground='gray', font=('Arial', 8, 'italic'))
-        
-        self.text_chat.config(state='disabled')
-        self.text_chat.see(tk.END)
+                self.uscita.rimuovi(voce['id'])
+            self.registra_esito(voce['id'], consegnati, restano)
+        
+        if non_trovati:
+            elenco = ', '.join(dict.fromkeys(non_trovati))
+            self.in_tk(messagebox.showerror, "Errore", f"Utente '{elenco}' non trovato!")
+        if da_riprovare:
+            return self.pianificatore_invio.dopo_errore(data.get('riprova_tra'))
+        return None
+    
+    def registra_esito(self, id_messaggio, consegnati, restano):
+        # nel thread di rete: la riga del messaggio passa da "in attesa" a quello che ha detto il server,
+        # nella storia e nella chat
+        if restano and consegnati:
+            # in parte consegnato: cosa manca si legge nei destinatari
+            destinatario, stato = ', '.join(consegnati + [f"{d} (in attesa)" for d in restano]), 'parziale'
+        elif restano:
+            destinatario, stato = None, 'in_attesa'
+        elif consegnati:
+            destinatario, stato = ', '.join(consegnati), 'inviato'
+        else:
+            destinatario, stato = None, 'non_consegnato'
+        utenti = self.storia.aggiorna_invio(id_messaggio, destinatario, stato)
+        self.in_tk(self.esito_invio, id_messaggio, utenti, destinatario, stato)
+    
+    def esito_invio(self, id_messaggio, utenti, destinatario, stato):
+        # la riga cambia in "Tutti" e nelle conversazioni dei destinatari
+        self.tutti.esito(id_messaggio, destinatario, stato)
+        for utente in utenti:
+            if utente in self.conversazioni:
+                self.conversazioni[utente].esito(id_messaggio, destinatario, stato)
     
     def aggiungi_messaggio_sistema(self, messaggio):
         msg_sistema = {
@@ -527,13 +1535,68 @@ class MessengerClient:
             'timestamp': time.strftime("%H:%M:%S"),
             'tipo': 'sistema'
         }
-        self.messaggi.append(msg_sistema)
-        self.aggiorna_chat()
+        # in "Tutti" e, se è aperta un'altra conversazione, anche lì: non vanno nella storia
+        self.tutti.aggiungi([msg_sistema])
+        if self.attiva is not self.tutti:
+            self.attiva.aggiungi([msg_sistema])
     
     def pulisci_chat(self):
-        if messagebox.askyesno("Conferma", "Vuoi davvero pulire tutta la chat?"):
-            self.messaggi = []
-            self.aggiorna_chat()
+        if messagebox.askyesno("Conferma", "Vuoi davvero cancellare tutta la chat, anche dalla storia?"):
+            # con tanta storia ci vuole qualche secondo: la finestra non aspetta, e si svuota solo a storia
+            # pulita. le righe arrivate nel frattempo sono state cancellate anche dalla storia
+            self.btn_pulisci.config(state='disabled')
+            self.lavoratore.sottometti(self.svuota_storia)
+    
+    def svuota_storia(self):
+        # nel thread di rete
+        try:
+            self.storia.svuota(lambda: self.in_tk(self.chat_pulita))
+        except sqlite3.Error:
+            self.in_tk(lambda: self.btn_pulisci.config(state='normal'))
+    
+    def chat_pulita(self):
+        # restano solo "Tutti", vuota, e l'elenco senza le altre
+        self.apri_conversazione(self.tutti)
+        self.tutti.svuota()
+        for conversazione in self.conversazioni.values():
+            conversazione.text.destroy()
+        self.conversazioni = {}
+        self.elenco_conversazioni = [None]
+        self.listbox_conversazioni.delete(1, tk.END)
+        self.aggiorna_voce(self.tutti)
+        self.btn_pulisci.config(state='normal')
+    
+    def cerca_nella_storia(self):
+        testo = self.entry_cerca.get().strip()
+        if not testo:
+            return
+        inizio = time.perf_counter()
+        risultati = self.storia.cerca(testo)
+        durata = time.perf_counter() - inizio
+        
+        finestra = tk.Toplevel(self.root)
+        finestra.title(f"Cerca: {testo}")
+        finestra.geometry("650x400")
+        riassunto = f"{len(risultati)} risultati in {1000 * durata:.0f} ms"
+        if len(risultati) == MAX_RISULTATI_RICERCA:
+            riassunto += " (solo i più recenti)"
+        ttk.Label(finestra, text=riassunto).pack(anchor='w', padx=10, pady=5)
+        
+        frame_lista = ttk.Frame(finestra)
+        frame_lista.pack(fill='both', expand=True, padx=10, pady=(0, 10))
+        lista = tk.Listbox(frame_lista, font=('Arial', 9))
+        lista.pack(side='left', fill='both', expand=True)
+        scrollbar = ttk.Scrollbar(frame_lista, orient="vertical", command=lista.yview)
+        scrollbar.pack(side='right', fill='y')
+        lista.config(yscrollcommand=scrollbar.set)
+        
+        righe = []
+        for msg in risultati:
+            data = time.strftime("%d/%m/%Y", time.localtime(msg['creato']))
+            riga, _ = formatta_riga(msg)
+            righe.append(f"{data} {riga.rstrip()}")
+        if righe:
+            lista.insert(tk.END, *righe)
     
     def avvia(self):
         if hasattr(self, 'root'):  
@@ -543,6 +1606,8 @@ class MessengerClient:
     def on_closing(self):
         if self.connesso:
             self.disconnetti_server()
+        # la disconnessione è in coda nel thread di rete: le si lascia il tempo di partire
+        self.lavoratore.chiudi(3)
         self.root.destroy()
 
 if __name__ == "__main__":
@@ -0,0 +1,716 @@
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import atexit
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import profilo_lock
+
+# archivio condiviso: utenti, presenza e messaggi (anche per chi è offline) stanno in un database SQLite in modalità WAL,
+# così più processi server sulla stessa macchina servono gli stessi utenti.
+# ogni processo tiene in memoria solo i punti di attesa dei client collegati a lui e
+# riceve dagli altri processi, via UDP su loopback, le notifiche di messaggi nuovi e cambi di presenza.
+
+# secondi di attesa se un altro processo sta scrivendo nel database
+ATTESA_LOCK_DB = 10
+# ogni processo aggiorna la sua riga in 'processi' ogni tanti secondi...
+INTERVALLO_BATTITO = 5
+# ...e chi non lo fa da tanti secondi viene considerato morto
+SCADENZA_PROCESSO = 30
+# nickname per datagramma di notifica
+NOMI_PER_NOTIFICA = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS utenti (
+    nickname TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS presenza (
+    nickname TEXT PRIMARY KEY,
+    porta TEXT,
+    scadenza REAL NOT NULL,
+    sessione INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS presenza_scadenza ON presenza(scadenza);
+CREATE TABLE IF NOT EXISTS registro_presenza (
+    versione INTEGER PRIMARY KEY AUTOINCREMENT,
+    nickname TEXT NOT NULL,
+    entrato INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deposito (
+    destinatario TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    corpo TEXT NOT NULL,
+    byte INTEGER NOT NULL,
+    creato REAL NOT NULL,
+    PRIMARY KEY (destinatario, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS deposito_creato ON deposito(creato);
+CREATE TABLE IF NOT EXISTS sequenze (
+    destinatario TEXT PRIMARY KEY,
+    ultimo INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS invii (
+    mittente TEXT NOT NULL,
+    id TEXT NOT NULL,
+    destinatario TEXT NOT NULL,
+    esito TEXT NOT NULL,
+    creato REAL NOT NULL,
+    PRIMARY KEY (mittente, id, destinatario)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS invii_creato ON invii(creato);
+CREATE TABLE IF NOT EXISTS processi (
+    porta INTEGER PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    visto REAL NOT NULL
+);
+"""
+
+
+class CasellaCondivisa:
+    # la parte locale di una casella: lock, condition e ascoltatori di chi aspetta in questo processo.
+    # i messaggi stanno nella tabella deposito; profondita() è diversa da zero se lì c'è qualcosa da leggere
+    def __init__(self, nickname, sessione):
+        self.nickname = nickname
+        # la sessione è la versione di presenza dell'entrata: distingue un rientro dal collegamento precedente
+        self.sessione = sessione
+        self.novita = 0
+        # ultimo seq di cui si ha notizia, per gli stream con cursore: novita la azzera chi legge per primo
+        self.ultimo_seq = 0
+        self.lock = profilo_lock.crea_lock('casella')
+        self.condizione = threading.Condition(self.lock)
+        self.ascoltatori = set()
+        self.attiva = True
+
+    def sveglia(self):
+        self.condizione.notify_all()
+        for ascoltatore in self.ascoltatori:
+            ascoltatore()
+
+    def profondita(self):
+        return self.novita
+
+    def ha_dopo(self, cursore):
+        return self.ultimo_seq > cursore
+
+
+class MessengerServerSQLite:
+    # stessa interfaccia di MessengerServer (vedi crea_server in server.py)
+    def __init__(self, modulo):
+        # modulo è server.py: costanti, Messaggio e il percorso dei dati
+        self.modulo = modulo
+        self.locale = threading.local()
+        # nickname -> CasellaCondivisa dei client che aspettano in questo processo
+        self.caselle = {}
+        self.lock_caselle = profilo_lock.crea_lock('caselle')
+        self.stream_attivi = {}
+        self.lock_presenza = profilo_lock.crea_lock('presenza')
+
+        cartella = modulo.MessengerServer.get_data_file_path(self).parent
+        self.file_db = Path(os.environ.get('MESSENGER_DB') or cartella / 'messenger.db')
+        print(f"Database condiviso: {self.file_db}", file=sys.stderr)
+        self.crea_database(cartella / 'users.json')
+        self.versione_presenza = self.leggi_versione(self.db())
+
+        self.avvia_notifiche()
+        self.avvia_thread_pulizia()
+
+    # database
+
+    def db(self, durevole=False):
+        # una connessione per thread; le registrazioni usano la connessione con fsync a ogni commit
+        chiave = 'durevole' if durevole else 'normale'
+        connessione = getattr(self.locale, chiave, None)
+        if connessione is None:
+            connessione = sqlite3.connect(self.file_db, timeout=ATTESA_LOCK_DB, isolation_level=None)
+            # NORMAL in WAL: un commit sopravvive al crash del processo, non a quello della macchina
+            connessione.execute('PRAGMA synchronous=' + ('FULL' if durevole else 'NORMAL'))
+            setattr(self.locale, chiave, connessione)
+        return connessione
+
+    @contextmanager
+    def transazione(self, durevole=False):
+        # IMMEDIATE prende subito il lock di scrittura: niente deadlock tra lettura e scrittura
+        connessione = self.db(durevole)
+        connessione.execute('BEGIN IMMEDIATE')
+        # anche un COMMIT fallito (database occupato, disco pieno) lascia la transazione aperta: si annulla
+        try:
+            yield connessione
+            connessione.execute('COMMIT')
+        except BaseException:
+            connessione.execute('ROLLBACK')
+            raise
+
+    def crea_database(self, file_utenti):
+        connessione = self.db()
+        # prima delle tabelle: la compattazione del deposito restituisce spazio al disco
+        connessione.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        connessione.execute('PRAGMA journal_mode=WAL')
+        connessione.executescript(SCHEMA)
+        with self.transazione(durevole=True) as db:
+            if db.execute('SELECT 1 FROM utenti LIMIT 1').fetchone() is None:
+                self.importa_utenti(db, file_utenti)
+
+    def importa_utenti(self, db, file_utenti):
+        # primo avvio con un archivio in memoria già usato: snapshot e journal passano nel database
+        utenti = {}
+        if file_utenti.exists():
+            with open(file_utenti, 'r', encoding='utf-8') as f:
+                utenti = json.load(f)
+        for percorso in (file_utenti.with_suffix('.log.old'), file_utenti.with_suffix('.log')):
+            if percorso.exists():
+                with open(percorso, 'r', encoding='utf-8') as f:
+                    for riga in f:
+                        try:
+                            record = json.loads(riga)
+                        except ValueError:
+                            continue
+                        utenti[record.pop('nickname')] = record
+        db.executemany(
+            'INSERT OR IGNORE INTO utenti (nickname, password, created_at) VALUES (?, ?, ?)',
+            ((nickname, r['password'], r.get('created_at', '')) for nickname, r in utenti.items())
+        )
+        if utenti:
+            print(f"Importati {len(utenti)} utenti da {file_utenti}", file=sys.stderr)
+
+    def leggi_versione(self, db):
+        return db.execute('SELECT COALESCE(MAX(versione), 0) FROM registro_presenza').fetchone()[0]
+
+    # notifiche tra processi
+
+    def avvia_notifiche(self):
+        self.socket_notifiche = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket_notifiche.bind(('127.0.0.1', 0))
+        self.porta_notifiche = self.socket_notifiche.getsockname()[1]
+        self.altri_processi = []
+        self.ultimo_battito = 0
+        self.ultima_compattazione = time.time()
+        self.battito()
+        atexit.register(self.esci)
+
+        def ricevi():
+            while True:
+                dati = self.socket_notifiche.recv(65535)
+                try:
+                    self.gestisci_notifica(json.loads(dati))
+                except Exception as e:
+                    print(f"Notifica ignorata: {e}", file=sys.stderr)
+
+        threading.Thread(target=ricevi, daemon=True).start()
+        # chi è già attivo deve sapere subito di questo processo
+        self.notifica({'w': self.porta_notifiche})
+
+    def battito(self):
+        adesso = time.time()
+        with self.transazione() as db:
+            db.execute('INSERT OR REPLACE INTO processi (porta, pid, visto) VALUES (?, ?, ?)',
+                       (self.porta_notifiche, os.getpid(), adesso))
+            db.execute('DELETE FROM processi WHERE visto < ?', (adesso - SCADENZA_PROCESSO,))
+        self.ultimo_battito = adesso
+        self.aggiorna_processi()
+
+    def aggiorna_processi(self):
+        righe = self.db().execute('SELECT porta FROM processi WHERE porta != ?', (self.porta_notifiche,))
+        self.altri_processi = [porta for (porta,) in righe]
+
+    def esci(self):
+        try:
+            with self.transazione() as db:
+                db.execute('DELETE FROM processi WHERE porta = ?', (self.porta_notifiche,))
+        except sqlite3.Error:
+            pass
+
+    def notifica(self, dati):
+        # solo dopo il commit: chi riceve la notifica deve già vedere i dati
+        if not self.altri_processi:
+            return
+        pacchetto = json.dumps(dati, ensure_ascii=False).encode('utf-8')
+        for porta in self.altri_processi:
+            try:
+                self.socket_notifiche.sendto(pacchetto, ('127.0.0.1', porta))
+            except OSError:
+                pass
+
+    def gestisci_notifica(self, dati):
+        if 'w' in dati:
+            self.aggiorna_processi()
+        for nickname, seq in dati.get('m', ()):
+            self.sveglia_locale(nickname, seq)
+        for nickname, sessione in dati.get('c', ()):
+            self.chiudi_locale(nickname, sessione)
+        if 'v' in dati:
+            self.aggiorna_versione(dati['v'])
+
+    def notifica_nomi(self, chiave, nomi, **altro):
+        # a pezzi, così ogni datagramma resta piccolo
+        for inizio in range(0, max(len(nomi), 1), NOMI_PER_NOTIFICA):
+            self.notifica({chiave: nomi[inizio:inizio + NOMI_PER_NOTIFICA], **altro})
+
+    # caselle locali
+
+    def casella_di(self, nickname):
+        # None se l'utente non è online; la casella locale si crea al primo client che aspetta qui
+        riga = self.db().execute('SELECT sessione FROM presenza WHERE nickname = ?', (nickname,)).fetchone()
+        with self.lock_caselle:
+            casella = self.caselle.get(nickname)
+            if riga is None:
+                vecchia, casella = casella, None
+                self.caselle.pop(nickname, None)
+            elif casella is None or casella.sessione != riga[0]:
+                vecchia, casella = casella, CasellaCondivisa(nickname, riga[0])
+                self.caselle[nickname] = casella
+            else:
+                vecchia = None
+        if vecchia is not None:
+            self.disattiva(vecchia)
+
+        if casella is not None:
+            # le notifiche arrivate quando qui non aspettava nessuno possono riguardare messaggi già letti
+            # altrove: conta quello che c'è davvero. letto con il lock preso, così una notifica
+            # per un messaggio successivo incrementa dopo e non va persa
+            with casella.lock:
+                ultimo = self.db().execute(
+                    'SELECT MAX(seq) FROM deposito WHERE destinatario = ?', (nickname,)
+                ).fetchone()[0]
+                casella.novita = int(ultimo is not None)
+                casella.ultimo_seq = max(casella.ultimo_seq, ultimo or 0)
+        return casella
+
+    def sveglia_locale(self, nickname, seq):
+        casella = self.caselle.get(nickname)
+        if casella is not None:
+            with casella.lock:
+                casella.novita += 1
+                casella.ultimo_seq = max(casella.ultimo_seq, seq)
+                casella.sveglia()
+
+    def chiudi_locale(self, nickname, sessione):
+        with self.lock_caselle:
+            casella = self.caselle.get(nickname)
+            if casella is None or casella.sessione != sessione:
+                return
+            del self.caselle[nickname]
+        self.disattiva(casella)
+
+    def disattiva(self, casella):
+        with casella.lock:
+            casella.attiva = False
+            # sveglia eventuali long-poll in attesa, risponderanno 401
+            casella.sveglia()
+
+    def aggiorna_versione(self, versione):
+        with self.lock_presenza:
+            if versione <= self.versione_presenza:
+                return
+            self.versione_presenza = versione
+        self.notifica_presenza()
+
+    def notifica_presenza(self):
+        with self.lock_presenza:
+            caselle = list(self.stream_attivi.values())
+
+        for casella in caselle:
+            with casella.lock:
+                casella.sveglia()
+
+    def apri_stream(self, nickname, dopo=None):
+        if dopo is not None:
+            self.conferma_messaggi(nickname, dopo)
+        casella = self.casella_di(nickname)
+        if casella is not None:
+            with self.lock_presenza:
+                self.stream_attivi[nickname] = casella
+        return casella
+
+    def chiudi_stream(self, nickname, casella):
+        with self.lock_presenza:
+            if self.stream_attivi.get(nickname) is casella:
+                del self.stream_attivi[nickname]
+
+    # presenza
+
+    def avvia_thread_pulizia(self):
+        def pulisci_utenti_inattivi():
+            while True:
+                time.sleep(self.modulo.PRECISIONE_PRESENZA)
+                inizio = time.perf_counter()
+                try:
+                    self.pulisci(time.time())
+                except sqlite3.Error as e:
+                    print(f"Errore nella pulizia della presenza: {e}", file=sys.stderr)
+                self.modulo.metriche.durata_pulizia.osserva(time.perf_counter() - inizio)
+
+        threading.Thread(target=pulisci_utenti_inattivi, daemon=True).start()
+
+    def pulisci(self, adesso):
+        # ogni processo fa la sua passata: il database fa in modo che ogni utente scada una volta sola
+        scaduti = self.db().execute(
+            'SELECT nickname, sessione FROM presenza WHERE scadenza < ?', (adesso,)
+        ).fetchall()
+        if scaduti:
+            with self.transazione() as db:
+                scaduti = [(n, s) for n, s in scaduti if self.stacca_utente(db, n, s, adesso)]
+                versione = self.leggi_versione(db)
+            if scaduti:
+                for nickname, sessione in scaduti:
+                    self.chiudi_locale(nickname, sessione)
+                self.notifica_nomi('c', [list(s) for s in scaduti], v=versione)
+                self.aggiorna_versione(versione)
+
+        if adesso - self.ultimo_battito >= INTERVALLO_BATTITO:
+            self.battito()
+            with self.transazione() as db:
+                db.execute('DELETE FROM registro_presenza WHERE versione <= ?',
+                           (self.leggi_versione(db) - self.modulo.MAX_REGISTRO_PRESENZA,))
+
+        if adesso - self.ultima_compattazione >= self.modulo.INTERVALLO_COMPATTAMENTO_DEPOSITO:
+            self.compatta_deposito(adesso)
+
+    def compatta_deposito(self, adesso):
+        # anche qui ogni processo fa la sua passata, quelle dopo la prima non trovano niente
+        self.ultima_compattazione = adesso
+        with self.transazione() as db:
+            scaduti = db.execute('DELETE FROM deposito WHERE creato < ?',
+                                 (adesso - self.modulo.RITENZIONE_DEPOSITO,)).rowcount
+            # gli id dei messaggi già consegnati si ricordano per RICORDA_INVII
+            db.execute('DELETE FROM invii WHERE creato < ?', (adesso - self.modulo.RICORDA_INVII,))
+        self.db().execute('PRAGMA incremental_vacuum')
+        if scaduti:
+            print(f"Deposito messaggi compattato: {scaduti} scaduti", file=sys.stderr)
+
+    def stacca_utente(self, db, nickname, sessione, scaduto_prima=None):
+        # da chiamare dentro una transazione; False se un altro processo l'ha già staccato o ha pingato
+        condizione = 'nickname = ? AND sessione = ?'
+        parametri = (nickname, sessione)
+        if scaduto_prima is not None:
+            condizione += ' AND scadenza < ?'
+            parametri += (scaduto_prima,)
+        if db.execute(f'DELETE FROM presenza WHERE {condizione}', parametri).rowcount == 0:
+            return False
+        # i messaggi non letti restano nel deposito per il prossimo ingresso
+        db.execute('INSERT INTO registro_presenza (nickname, entrato) VALUES (?, 0)', (nickname,))
+        return True
+
+    def aggiungi_utente(self, nickname, porta):
+        with self.transazione() as db:
+            if db.execute('SELECT 1 FROM presenza WHERE nickname = ?', (nickname,)).fetchone():
+                return False
+            sessione = db.execute(
+                'INSERT INTO registro_presenza (nickname, entrato) VALUES (?, 1)', (nickname,)
+            ).lastrowid
+            db.execute(
+                'INSERT INTO presenza (nickname, porta, scadenza, sessione) VALUES (?, ?, ?, ?)',
+                (nickname, str(porta), time.time() + self.modulo.TIMEOUT_PRESENZA, sessione)
+            )
+
+        self.notifica({'v': sessione})
+        self.aggiorna_versione(sessione)
+        return True
+
+    def rimuovi_utente(self, nickname):
+        with self.transazione() as db:
+            riga = db.execute('SELECT sessione FROM presenza WHERE nickname = ?', (nickname,)).fetchone()
+            if riga is None:
+                return
+            self.stacca_utente(db, nickname, riga[0])
+            versione = self.leggi_versione(db)
+
+        self.chiudi_locale(nickname, riga[0])
+        self.notifica({'c': [[nickname, riga[0]]], 'v': versione})
+        self.aggiorna_versione(versione)
+
+    def aggiorna_ping(self, nickname):
+        aggiornate = self.db().execute(
+            'UPDATE presenza SET scadenza = ? WHERE nickname = ?',
+            (time.time() + self.modulo.TIMEOUT_PRESENZA, nickname)
+        ).rowcount
+        return aggiornate > 0
+
+    def conta_utenti_online(self):
+        return self.db().execute('SELECT COUNT(*) FROM presenza').fetchone()[0]
+
+    def stato_presenza(self, versione_nota=None):
+        # stesse risposte di MessengerServer.stato_presenza, lette in una sola transazione di lettura
+        db = self.db()
+        db.execute('BEGIN')
+        try:
+            versione = self.leggi_versione(db)
+            stato = {
+                'utenti_online': db.execute('SELECT COUNT(*) FROM presenza').fetchone()[0],
+                'versione_presenza': versione
+            }
+            if versione_nota == versione:
+                return stato
+
+            prima = db.execute('SELECT MIN(versione) FROM registro_presenza').fetchone()[0]
+            if (isinstance(versione_nota, int) and prima is not None
+                    and prima <= versione_nota + 1 and versione_nota < versione):
+                ultimo_evento = {}
+                for nickname, entrato in db.execute(
+                        'SELECT nickname, entrato FROM registro_presenza WHERE versione > ? ORDER BY versione',
+                        (versione_nota,)):
+                    ultimo_evento[nickname] = bool(entrato)
+                stato['entrati'] = [n for n, entrato in ultimo_evento.items() if entrato]
+                stato['usciti'] = [n for n, entrato in ultimo_evento.items() if not entrato]
+            else:
+                stato['utenti'] = [n for (n,) in db.execute('SELECT nickname FROM presenza')]
+            return stato
+        finally:
+            db.execute('COMMIT')
+
+    # caselle
+
+    def accoda_messaggio(self, destinatario, messaggio):
+        return self.accoda_messaggi([(destinatario, messaggio)])[0]
+
+    def accoda_messaggi(self, consegne):
+        # stessi esiti di MessengerServer.accoda_messaggi: i messaggi vanno tutti nel deposito,
+        # 'differito' se il destinatario è registrato ma non online.
+        # una sola transazione per tutto il batch; lo stesso messaggio viene serializzato una volta sola
+        per_destinatario = {}
+        for indice, (destinatario, messaggio) in enumerate(consegne):
+            per_destinatario.setdefault(destinatario, []).append(indice)
+
+        serializzati = {}
+        esiti = ['non_trovato'] * len(consegne)
+        svegliare = []
+        ultimi = {}
+        adesso = time.time()
+        with self.transazione() as db:
+            for destinatario, indici in per_destinatario.items():
+                if db.execute('SELECT 1 FROM presenza WHERE nickname = ?', (destinatario,)).fetchone():
+                    esito = 'ok'
+                    svegliare.append(destinatario)
+                elif db.execute('SELECT 1 FROM utenti WHERE nickname = ?', (destinatario,)).fetchone():
+                    esito = 'differito'
+                else:
+                    continue
+
+                primo, ultimo_presente = db.execute(
+                    'SELECT MIN(seq), MAX(seq) FROM deposito WHERE destinatario = ?', (destinatario,)
+                ).fetchone()
+                riga = db.execute('SELECT ultimo FROM sequenze WHERE destinatario = ?', (destinatario,)).fetchone()
+                ultimo = riga[0] if riga else 0
+                quanti = 0 if primo is None else ultimo_presente - primo + 1
+
+                for indice in indici:
+                    messaggio = consegne[indice][1]
+                    if id(messaggio) not in serializzati:
+                        serializzati[id(messaggio)] = self.modulo.corpo_messaggio(messaggio)
+                    corpo, dimensione = serializzati[id(messaggio)], messaggio.dimensione
+
+                    if quanti >= self.modulo.MAX_MESSAGGI_DEPOSITO:
+                        if self.modulo.POLITICA_CASELLA_PIENA != 'scarta_vecchi':
+                            esiti[indice] = 'piena'
+                            continue
+                        db.execute('DELETE FROM deposito WHERE destinatario = ? AND seq = ?', (destinatario, primo))
+                        primo += 1
+                        quanti -= 1
+
+                    ultimo += 1
+                    primo = ultimo if primo is None else primo
+                    db.execute('INSERT INTO deposito (destinatario, seq, corpo, byte, creato) VALUES (?, ?, ?, ?, ?)',
+                               (destinatario, ultimo, corpo, dimensione, adesso))
+                    quanti += 1
+                    esiti[indice] = esito
+
+                db.execute('INSERT OR REPLACE INTO sequenze (destinatario, ultimo) VALUES (?, ?)',
+                           (destinatario, ultimo))
+                ultimi[destinatario] = ultimo
+
+        # con l'ultimo seq: gli stream con cursore capiscono da soli se c'è qualcosa dopo il loro
+        svegliare = [[destinatario, ultimi[destinatario]] for destinatario in svegliare]
+        for destinatario, ultimo in svegliare:
+            self.sveglia_locale(destinatario, ultimo)
+        if svegliare:
+            self.notifica_nomi('m', svegliare)
+        return esiti
+
+    def prenota_invii(self, chiavi):
+        # come MessengerServer.prenota_invii, con le prenotazioni nel database: valgono anche tra processi
+        adesso = time.time()
+        duplicati = {}
+        with self.transazione() as db:
+            for indice, chiave in enumerate(chiavi):
+                if chiave is None:
+                    continue
+                riga = db.execute('SELECT esito, creato FROM invii WHERE mittente = ? AND id = ? AND destinatario = ?',
+                                  chiave).fetchone()
+                if riga is not None and self.modulo.invio_valido(riga[0], riga[1], adesso):
+                    duplicati[indice] = riga[0]
+                else:
+                    db.execute('INSERT OR REPLACE INTO invii (mittente, id, destinatario, esito, creato) '
+                               'VALUES (?, ?, ?, ?, ?)', chiave + ('in_corso', adesso))
+        return duplicati
+
+    def ricorda_invii(self, esiti):
+        adesso = time.time()
+        with self.transazione() as db:
+            for chiave, esito in esiti:
+                if esito == 'piena':
+                    db.execute('DELETE FROM invii WHERE mittente = ? AND id = ? AND destinatario = ?', chiave)
+                else:
+                    db.execute('UPDATE invii SET esito = ?, creato = ? WHERE mittente = ? AND id = ? AND destinatario = ?',
+                               (esito, adesso) + chiave)
+
+    def attendi_deposito(self, casella):
+        # qui il deposito è il database: quello che c'è si legge già
+        pass
+
+    def svuota_casella(self, casella):
+        # da chiamare con il lock della casella preso; una pagina alla volta, come gli arretrati in memoria
+        with self.transazione() as db:
+            riga = db.execute('SELECT sessione FROM presenza WHERE nickname = ?', (casella.nickname,)).fetchone()
+            if riga is None or riga[0] != casella.sessione:
+                # l'utente è uscito da un altro processo e la notifica non è ancora arrivata
+                casella.attiva = False
+                casella.novita = 0
+                return []
+
+            righe = db.execute(
+                'SELECT seq, corpo FROM deposito WHERE destinatario = ? ORDER BY seq LIMIT ?',
+                (casella.nickname, self.modulo.PAGINA_ARRETRATI + 1)
+            ).fetchall()
+            # se ne resta anche uno solo la casella rimane "non vuota" e il prossimo poll torna subito
+            casella.novita = int(len(righe) > self.modulo.PAGINA_ARRETRATI)
+            righe = righe[:self.modulo.PAGINA_ARRETRATI]
+            if righe:
+                db.execute('DELETE FROM deposito WHERE destinatario = ? AND seq <= ?',
+                           (casella.nickname, righe[-1][0]))
+        return [self.modulo.messaggio_numerato(seq, self.modulo.messaggio_da_corpo(corpo))
+                for seq, corpo in righe]
+
+    def pagina_casella(self, casella, dopo, limite):
+        # da chiamare con il lock della casella preso: i primi messaggi dopo il cursore, senza toglierli
+        righe = self.righe_dopo(casella, dopo, limite)
+        # restano nel deposito finché non vengono confermati: la casella è vuota solo se non c'era niente
+        casella.novita = len(righe)
+        return [self.modulo.messaggio_numerato(seq, self.modulo.messaggio_da_corpo(corpo))
+                for seq, corpo in righe]
+
+    def pagina_stream(self, casella, dopo):
+        # come MessengerServer.pagina_stream: una riga in più dice se resta altro oltre la pagina
+        righe = self.righe_dopo(casella, dopo, self.modulo.MAX_PAGINA_MESSAGGI + 1)
+        casella.novita = int(len(righe) > self.modulo.MAX_PAGINA_MESSAGGI)
+        righe = righe[:self.modulo.MAX_PAGINA_MESSAGGI]
+        if not righe:
+            return [], dopo
+        return [self.modulo.messaggio_numerato(seq, self.modulo.messaggio_da_corpo(corpo))
+                for seq, corpo in righe], righe[-1][0]
+
+    def righe_dopo(self, casella, dopo, limite):
+        # [(seq, corpo)] dopo il cursore; [] e casella disattivata se l'utente nel frattempo è uscito
+        db = self.db()
+        db.execute('BEGIN')
+        try:
+            riga = db.execute('SELECT sessione FROM presenza WHERE nickname = ?', (casella.nickname,)).fetchone()
+            if riga is None or riga[0] != casella.sessione:
+                casella.attiva = False
+                casella.novita = 0
+                return []
+            return db.execute(
+                'SELECT seq, corpo FROM deposito WHERE destinatario = ? AND seq > ? ORDER BY seq LIMIT ?',
+                (casella.nickname, dopo, limite)
+            ).fetchall()
+        finally:
+            db.execute('COMMIT')
+
+    def conferma_messaggi(self, nickname, seq):
+        # il client ha ricevuto tutto fino a seq compreso; la transazione di scrittura solo se c'è da cancellare
+        if not self.db().execute('SELECT 1 FROM deposito WHERE destinatario = ? AND seq <= ? LIMIT 1',
+                                 (nickname, seq)).fetchone():
+            return
+        with self.transazione() as db:
+            db.execute('DELETE FROM deposito WHERE destinatario = ? AND seq <= ? '
+                       'AND EXISTS (SELECT 1 FROM presenza WHERE nickname = ?)', (nickname, seq, nickname))
+
+    def conta_arretrati(self, nickname):
+        return self.db().execute('SELECT COUNT(*) FROM deposito WHERE destinatario = ?', (nickname,)).fetchone()[0]
+
+    def preleva_messaggi(self, nickname, attesa=0):
+        # None se l'utente non è online
+        casella = self.casella_di(nickname)
+        if casella is None:
+            return None
+        return self.attendi_e_leggi(casella, attesa, lambda: self.svuota_casella(casella))
+
+    def leggi_messaggi(self, nickname, dopo, limite, attesa=0):
+        # stesse risposte di MessengerServer.leggi_messaggi
+        self.conferma_messaggi(nickname, dopo)
+        casella = self.casella_di(nickname)
+        if casella is None:
+            return None
+        # una riga in più dice se ne restano altri
+        messaggi = self.attendi_e_leggi(casella, attesa, lambda: self.pagina_casella(casella, dopo, limite + 1))
+        if messaggi is None:
+            return None
+        return messaggi[:limite], len(messaggi) > limite
+
+    def attendi_e_leggi(self, casella, attesa, leggi):
+        # long-poll su una casella condivisa: None se l'utente è uscito, altrimenti quello che restituisce leggi()
+        scadenza = time.time() + attesa
+        with casella.lock:
+            while True:
+                rimanente = scadenza - time.time()
+                if rimanente > 0 and not casella.profondita() and casella.attiva:
+                    casella.condizione.wait_for(
+                        lambda: casella.profondita() or not casella.attiva,
+                        timeout=rimanente
+                    )
+                if not casella.attiva:
+                    return None
+
+                messaggi = leggi()
+                if not casella.attiva:
+                    return None
+                # una notifica può arrivare per messaggi già letti: in quel caso si torna ad aspettare
+                if messaggi or scadenza - time.time() <= 0:
+                    return messaggi
+
+    def statistiche_caselle(self):
+        righe = self.db().execute(
+            'SELECT p.nickname, COUNT(d.seq), COALESCE(SUM(d.byte), 0) FROM presenza p '
+            'LEFT JOIN deposito d ON d.destinatario = p.nickname GROUP BY p.nickname'
+        ).fetchall()
+        destinatari, messaggi = self.db().execute(
+            'SELECT COUNT(DISTINCT destinatario), COUNT(*) FROM deposito'
+        ).fetchone()
+        return {
+            'byte_totali': sum(byte for _, _, byte in righe),
+            'budget_byte': self.modulo.BUDGET_MEMORIA_CASELLE,
+            'caselle': {
+                nickname: {'messaggi': quanti, 'byte': byte, 'su_disco': quanti, 'arretrati': quanti}
+                for nickname, quanti, byte in righe
+            },
+            'deposito': {'destinatari': destinatari, 'messaggi': messaggi}
+        }
+
+    def profondita_caselle(self):
+        # (totale, massimo) per /metrics con una sola query sulla chiave primaria
+        return tuple(self.db().execute(
+            'SELECT COALESCE(SUM(quanti), 0), COALESCE(MAX(quanti), 0) '
+            'FROM (SELECT COUNT(*) AS quanti FROM deposito GROUP BY destinatario)'
+        ).fetchone())
+
+    # utenti
+
+    def register_new_user(self, nickname, password_hash):
+        with self.transazione(durevole=True) as db:
+            return db.execute(
+                'INSERT OR IGNORE INTO utenti (nickname, password, created_at) VALUES (?, ?, ?)',
+                (nickname, password_hash, datetime.utcnow().isoformat())
+            ).rowcount > 0
+
+    def verify_credentials(self, nickname, password_hash):
+        riga = self.db().execute('SELECT password FROM utenti WHERE nickname = ?', (nickname,)).fetchone()
+        return riga is not None and riga[0] == password_hash
+
+    def utente_registrato(self, nickname):
+        return self.db().execute('SELECT 1 FROM utenti WHERE nickname = ?', (nickname,)).fetchone() is not None
@@ -0,0 +1,868 @@
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # windows: niente RLIMIT_NOFILE da alzare
+    resource = None
+
+# descrittori oltre a un socket per connessione: database, log, socket in ascolto, pipe
+MARGINE_DESCRITTORI = 256
+
+
+def carica_server():
+    # i dati del benchmark vanno in una home temporanea, così non si tocca ~/.messenger_data
+    home = tempfile.mkdtemp(prefix='messenger_bench_')
+    os.environ['HOME'] = home
+    os.environ['USERPROFILE'] = home
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    return server
+
+
+def registra_utenti(client, nicknames):
+    # nickname -> header con il token di sessione
+    header = {}
+    for nickname in nicknames:
+        client.post('/registra_utente', json={'nickname': nickname, 'password': 'x'})
+        token = client.post('/login', json={'nickname': nickname, 'password': 'x'}).json['token']
+        header[nickname] = {'Authorization': f"Bearer {token}"}
+        client.post('/registra', json={'nickname': nickname, 'porta': 1}, headers=header[nickname])
+    return header
+
+
+def bench_lock(args):
+    # throughput di invio+ricezione al crescere dei thread, ogni thread parla con il suo "gemello".
+    # con --profilo-lock ogni risultato ha anche i punti di chiamata che aspettano di più
+    if args.profilo_lock:
+        os.environ['MESSENGER_PROFILO_LOCK'] = '1'
+    srv = carica_server()
+    risultati = []
+
+    for num_thread in args.thread:
+        prefisso = f"t{num_thread}_"
+        nicknames = [f"{prefisso}{i}" for i in range(num_thread)]
+        header = registra_utenti(srv.app.test_client(), nicknames)
+
+        stop_registrazioni = threading.Event()
+        registrazioni = [0]
+
+        def registra_in_continuo():
+            client = srv.app.test_client()
+            i = 0
+            while not stop_registrazioni.is_set():
+                client.post('/registra_utente', json={'nickname': f"{prefisso}reg{i}", 'password': 'x'})
+                i += 1
+            registrazioni[0] = i
+
+        def lavoratore(indice):
+            client = srv.app.test_client()
+            mittente = nicknames[indice]
+            destinatario = nicknames[indice]
+            for _ in range(args.messaggi):
+                client.post('/invia_messaggio', json={
+                    'mittente': mittente,
+                    'destinatario': destinatario,
+                    'messaggio': 'ciao'
+                }, headers=header[mittente])
+                client.get(f'/messaggi/{mittente}', headers=header[mittente])
+
+        if args.registrazioni:
+            thread_registrazioni = threading.Thread(target=registra_in_continuo, daemon=True)
+            thread_registrazioni.start()
+
+        threads = [threading.Thread(target=lavoratore, args=(i,)) for i in range(num_thread)]
+        inizio = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        durata = time.perf_counter() - inizio
+
+        stop_registrazioni.set()
+        if args.registrazioni:
+            thread_registrazioni.join()
+
+        risultati.append({
+            'thread': num_thread,
+            'messaggi_al_secondo': round(num_thread * args.messaggi / durata, 1),
+            'registrazioni_concorrenti': registrazioni[0]
+        })
+        if args.profilo_lock:
+            risultati[-1]['lock'] = srv.profilo_lock.rapporto()['punti'][:args.punti]
+            srv.profilo_lock.azzera()
+
+    return risultati
+
+
+def bench_registrazioni(args):
+    # latenza media di una registrazione man mano che cresce il numero di utenti registrati
+    srv = carica_server()
+    risultati = []
+    per_thread = args.passo // args.thread
+    registrati = 0
+
+    def lavoratore(base, latenze):
+        for i in range(per_thread):
+            inizio = time.perf_counter()
+            srv.server.register_new_user(f"r{base + i}", 'x')
+            latenze.append(time.perf_counter() - inizio)
+
+    while registrati < args.utenti:
+        latenze = []
+        threads = [
+            threading.Thread(target=lavoratore, args=(registrati + t * per_thread, latenze))
+            for t in range(args.thread)
+        ]
+        inizio = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        durata = time.perf_counter() - inizio
+        registrati += per_thread * args.thread
+
+        risultati.append({
+            'utenti_registrati': registrati,
+            'latenza_media_ms': round(1000 * sum(latenze) / len(latenze), 3),
+            'registrazioni_al_secondo': round(len(latenze) / durata, 1)
+        })
+
+    return risultati
+
+
+def bench_scadenze(args):
+    # 100k utenti online: costo di un ping e di un tick di pulizia, scansione completa contro timer wheel
+    srv = carica_server()
+    adesso = time.time()
+    timeout = srv.TIMEOUT_PRESENZA
+    nicknames = [f"u{i}" for i in range(args.utenti)]
+    # una piccola parte degli utenti ha smesso di pingare e deve scadere al prossimo tick
+    scaduti = set(nicknames[:args.scaduti])
+
+    def ping_iniziale(nickname):
+        return adesso - timeout - 5 if nickname in scaduti else adesso
+
+    # prima: dizionario nickname -> ultimo ping, scansionato per intero
+    ultimo_ping = {nickname: ping_iniziale(nickname) for nickname in nicknames}
+    inizio = time.perf_counter()
+    for nickname in nicknames:
+        ultimo_ping[nickname] = adesso
+    ping_scansione = (time.perf_counter() - inizio) / args.utenti
+    ultimo_ping.update({nickname: adesso - timeout - 5 for nickname in scaduti})
+
+    inizio = time.perf_counter()
+    da_rimuovere = [n for n, t in ultimo_ping.items() if adesso - t > timeout]
+    tick_scansione = time.perf_counter() - inizio
+    assert len(da_rimuovere) == args.scaduti
+
+    # dopo: timer wheel
+    ruota = srv.RuotaScadenze(srv.PRECISIONE_PRESENZA)
+    ruota.prossimo_slot = int((adesso - timeout - 10) / ruota.precisione)
+    for nickname in nicknames:
+        ruota.aggiorna(nickname, ping_iniziale(nickname) + timeout)
+    ruota.scadute(adesso - timeout - 2)
+
+    vivi = nicknames[args.scaduti:]
+    inizio = time.perf_counter()
+    for nickname in vivi:
+        ruota.aggiorna(nickname, adesso + timeout)
+    ping_ruota = (time.perf_counter() - inizio) / len(vivi)
+
+    inizio = time.perf_counter()
+    da_rimuovere = ruota.scadute(adesso)
+    tick_ruota = time.perf_counter() - inizio
+    assert len(da_rimuovere) == args.scaduti
+
+    return {
+        'utenti_online': args.utenti,
+        'scaduti_nel_tick': args.scaduti,
+        'scansione': {
+            'ping_ns': round(ping_scansione * 1e9),
+            'tick_ms': round(tick_scansione * 1000, 3)
+        },
+        'timer_wheel': {
+            'ping_ns': round(ping_ruota * 1e9),
+            'tick_ms': round(tick_ruota * 1000, 3)
+        }
+    }
+
+
+def bench_deposito(args):
+    # messaggi al secondo verso utenti offline: group commit del deposito contro un commit per messaggio
+    srv = carica_server()
+    destinatari = [f"off{i}" for i in range(args.destinatari)]
+    for nickname in destinatari:
+        srv.server.register_new_user(nickname, 'x')
+    risultati = {}
+    # i commit (uno con fsync per batch) si contano intorno ad applica
+    deposito = srv.server.deposito
+    applica = deposito.applica
+    commit = [0]
+
+    def applica_contando(batch):
+        commit[0] += 1
+        applica(batch)
+    deposito.applica = applica_contando
+
+    def lavoratore(indice):
+        for i in range(args.messaggi):
+            esito = srv.server.accoda_messaggio(destinatari[(indice + i) % len(destinatari)],
+                                                srv.Messaggio(f"t{indice}", f"messaggio {i}", time.time()))
+            assert esito == 'differito', esito
+
+    threads = [threading.Thread(target=lavoratore, args=(i,)) for i in range(args.thread)]
+    inizio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    durata = time.perf_counter() - inizio
+    risultati['group_commit'] = {
+        'thread': args.thread,
+        'messaggi_al_secondo': round(args.thread * args.messaggi / durata, 1),
+        'messaggi_per_commit': round(args.thread * args.messaggi / commit[0], 1)
+    }
+
+    # stesso schema e stesso fsync, ma una transazione per messaggio sotto un lock
+    percorso = os.path.join(tempfile.mkdtemp(prefix='messenger_bench_'), 'singoli.db')
+    db = srv.sqlite3.connect(percorso, check_same_thread=False, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=FULL')
+    db.execute('CREATE TABLE messaggi (destinatario TEXT, seq INTEGER, corpo TEXT, creato REAL, '
+               'PRIMARY KEY (destinatario, seq)) WITHOUT ROWID')
+    lock = threading.Lock()
+    contatore = [0]
+
+    def singolo(indice):
+        for i in range(args.messaggi):
+            with lock:
+                contatore[0] += 1
+                db.execute('BEGIN')
+                db.execute('INSERT INTO messaggi VALUES (?, ?, ?, ?)',
+                           (destinatari[(indice + i) % len(destinatari)], contatore[0], 'x' * 40, time.time()))
+                db.execute('COMMIT')
+
+    threads = [threading.Thread(target=singolo, args=(i,)) for i in range(args.thread)]
+    inizio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    durata = time.perf_counter() - inizio
+    risultati['commit_per_messaggio'] = {
+        'thread': args.thread,
+        'messaggi_al_secondo': round(args.thread * args.messaggi / durata, 1),
+        'messaggi_per_commit': 1
+    }
+    return risultati
+
+
+def bench_token(args):
+    # costo del controllo d'identità, da solo e dentro ogni route calda. 'lock' è l'appartenenza agli utenti
+    # online sotto lock_presenza (archivio in memoria), 'sqlite' la stessa domanda alla tabella presenza
+    # (archivio condiviso), 'token' la verifica dell'HMAC, che non tocca niente di condiviso
+    srv = carica_server()
+    client = srv.app.test_client()
+    header = registra_utenti(client, ['tok_a'])['tok_a']
+    autorizzazione = header['Authorization']
+
+    def controllo_lock(intestazione, nickname):
+        with srv.server.lock_presenza:
+            presente = nickname in srv.server.utenti
+        return None if presente else (401, 'Utente non trovato')
+
+    percorso = os.path.join(tempfile.mkdtemp(prefix='messenger_bench_'), 'presenza.db')
+    db = srv.sqlite3.connect(percorso, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE presenza (nickname TEXT PRIMARY KEY, scadenza REAL)')
+    db.executemany('INSERT INTO presenza VALUES (?, 0)', [(f"u{i}",) for i in range(args.utenti)] + [('tok_a',)])
+    db.close()
+    connessioni = threading.local()
+
+    def controllo_sqlite(intestazione, nickname):
+        if not hasattr(connessioni, 'db'):
+            connessioni.db = srv.sqlite3.connect(percorso, isolation_level=None)
+        riga = connessioni.db.execute('SELECT 1 FROM presenza WHERE nickname = ?', (nickname,)).fetchone()
+        return None if riga else (401, 'Utente non trovato')
+
+    controlli = {'lock': controllo_lock, 'sqlite': controllo_sqlite, 'token': srv.controlla_token}
+    risultati = {'controllo_ns': {}, 'route_us': {}}
+
+    for nome, controllo in controlli.items():
+        misure = {}
+        for num_thread in args.thread:
+            def lavoratore():
+                for _ in range(args.controlli):
+                    assert controllo(autorizzazione, 'tok_a') is None
+            threads = [threading.Thread(target=lavoratore) for _ in range(num_thread)]
+            inizio = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            durata = time.perf_counter() - inizio
+            # tempo di parete per controllo, con tutti i thread insieme
+            misure[f"{num_thread}_thread"] = round(1e9 * durata / (num_thread * args.controlli))
+        risultati['controllo_ns'][nome] = misure
+
+    # le route in sequenza, un messaggio inviato e poi letto a ogni giro così la casella non si riempie;
+    # le varianti si alternano a ogni giro, così risentono allo stesso modo del rumore della macchina
+    route = {
+        'ping': lambda: client.post('/ping', json={'nickname': 'tok_a'}, headers=header),
+        'invia_messaggio': lambda: client.post('/invia_messaggio', json={
+            'mittente': 'tok_a', 'destinatario': 'tok_a', 'messaggio': 'ciao'}, headers=header),
+        'messaggi': lambda: client.get('/messaggi/tok_a', headers=header),
+        'sync': lambda: client.post('/sync', json={'nickname': 'tok_a'}, headers=header)
+    }
+    varianti = {'nessuno': lambda intestazione, nickname: None, 'lock': controllo_lock, 'token': srv.controlla_token}
+    tempi = {variante: dict.fromkeys(route, 0.0) for variante in varianti}
+    for _ in range(args.richieste):
+        for variante, controllo in varianti.items():
+            srv.controlla_token = controllo
+            for nome_route, chiama in route.items():
+                inizio = time.perf_counter()
+                risposta = chiama()
+                tempi[variante][nome_route] += time.perf_counter() - inizio
+                assert risposta.status_code == 200, (nome_route, risposta.status_code)
+    srv.controlla_token = varianti['token']
+    for variante, per_route in tempi.items():
+        risultati['route_us'][variante] = {r: round(1e6 * t / args.richieste, 1) for r, t in per_route.items()}
+    return risultati
+
+
+def bench_metriche(args):
+    # quanto costa registrare una richiesta nelle metriche: il middleware attorno a un'app che non fa niente,
+    # e /ping dal test client con e senza middleware (alternati a ogni giro)
+    srv = carica_server()
+    client = srv.app.test_client()
+    header = registra_utenti(client, ['met_a'])['met_a']
+    risultati = {'registrazione_ns': {}}
+
+    def vuota(environ, start_response):
+        start_response('200 OK', [])
+        return [b'']
+
+    def start_response(stato, header, exc_info=None):
+        pass
+
+    misurata = srv.misura_richieste(vuota)
+    environ = {'PATH_INFO': '/ping'}
+    for num_thread in args.thread:
+        tempi = {}
+        for nome, applicazione in (('senza', vuota), ('con', misurata)):
+            def lavoratore():
+                for _ in range(args.richieste):
+                    applicazione(environ, start_response)
+            threads = [threading.Thread(target=lavoratore) for _ in range(num_thread)]
+            inizio = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            tempi[nome] = (time.perf_counter() - inizio) / (num_thread * args.richieste)
+        risultati['registrazione_ns'][f"{num_thread}_thread"] = round(1e9 * (tempi['con'] - tempi['senza']))
+
+    misurata = srv.app.wsgi_app
+    grezza = type(srv.app).wsgi_app.__get__(srv.app)
+    tempi = {'senza': 0.0, 'con': 0.0}
+    for _ in range(args.richieste // 10):
+        for nome, applicazione in (('senza', grezza), ('con', misurata)):
+            srv.app.wsgi_app = applicazione
+            inizio = time.perf_counter()
+            risposta = client.post('/ping', json={'nickname': 'met_a'}, headers=header)
+            tempi[nome] += time.perf_counter() - inizio
+            assert risposta.status_code == 200
+    srv.app.wsgi_app = misurata
+    risultati['ping_us'] = {nome: round(1e6 * t / (args.richieste // 10), 1) for nome, t in tempi.items()}
+
+    inizio = time.perf_counter()
+    testo = srv.metriche.testo()
+    risultati['metrics_ms'] = round(1e3 * (time.perf_counter() - inizio), 2)
+    risultati['metrics_righe'] = testo.count('\n')
+    return risultati
+
+
+def bench_memoria(args):
+    # byte per messaggio in attesa nelle caselle: memoria allocata da Python (tracemalloc) dopo aver
+    # accodato args.messaggi messaggi, tutti diversi, con /invia_messaggio verso utenti online che non li leggono
+    import gc
+    import tracemalloc
+    srv = carica_server()
+    # nessun ping durante la misura: gli utenti non devono scadere
+    srv.TIMEOUT_PRESENZA = 24 * 3600
+    client = srv.app.test_client()
+    destinatari = [f"mem{i}" for i in range(args.utenti)]
+    header = registra_utenti(client, ['mem_mittente'] + destinatari)['mem_mittente']
+
+    def invia(indice):
+        risposta = client.post('/invia_messaggio', json={
+            'mittente': 'mem_mittente',
+            'destinatario': destinatari[indice % len(destinatari)],
+            'messaggio': f"messaggio di prova numero {indice}"
+        }, headers=header)
+        assert risposta.status_code == 200, risposta.status_code
+
+    # un giro a vuoto: cache di Flask, metriche e percorsi del codice già pronti
+    for indice in range(len(destinatari)):
+        invia(indice)
+    for nickname in destinatari:
+        srv.server.conferma_messaggi(nickname, 1)
+
+    gc.collect()
+    tracemalloc.start()
+    prima = tracemalloc.get_traced_memory()[0]
+    for indice in range(args.messaggi):
+        invia(indice)
+    gc.collect()
+    dopo = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    in_attesa = sum(srv.server.messaggi[nickname].profondita() for nickname in destinatari)
+    assert in_attesa == args.messaggi, in_attesa
+    return {
+        'messaggi': args.messaggi,
+        'byte_per_messaggio': round((dopo - prima) / args.messaggi, 1),
+        # il testo di ogni messaggio è una stringa a sé, compresa nei byte per messaggio
+        'lunghezza_media_testo': round(sum(len(f"messaggio di prova numero {i}")
+                                           for i in range(args.messaggi)) / args.messaggi, 1)
+    }
+
+
+def bench_svuotamento(args):
+    # CPU per messaggio quando un client svuota con /messaggi una casella di args.messaggi messaggi.
+    # 'singolo': ogni messaggio a un destinatario; 'multicast': ogni messaggio a tutti gli args.destinatari.
+    # accodamento_us è la creazione del messaggio più l'accodamento, per messaggio accettato;
+    # svuotamento_us la richiesta di svuotamento, per messaggio consegnato
+    srv = carica_server()
+    srv.TIMEOUT_PRESENZA = 24 * 3600
+    client = srv.app.test_client()
+    destinatari = [f"svu{i}" for i in range(args.destinatari)]
+    header = registra_utenti(client, destinatari)
+    risultati = {}
+
+    for modo in ('singolo', 'multicast'):
+        riceventi = destinatari[:1] if modo == 'singolo' else destinatari
+        accodamento = svuotamento = 0.0
+        consegnati = 0
+        for _ in range(args.giri):
+            inizio = time.perf_counter()
+            for i in range(args.messaggi):
+                messaggio = srv.Messaggio('svu_mittente', f"messaggio di prova numero {i}", time.time())
+                srv.server.accoda_messaggi([(destinatario, messaggio) for destinatario in riceventi])
+            accodamento += time.perf_counter() - inizio
+
+            for destinatario in riceventi:
+                inizio = time.perf_counter()
+                risposta = client.get(f'/messaggi/{destinatario}', headers=header[destinatario])
+                corpo = risposta.get_data()
+                svuotamento += time.perf_counter() - inizio
+                messaggi = json.loads(corpo)['messaggi']
+                assert len(messaggi) == args.messaggi, len(messaggi)
+                consegnati += len(messaggi)
+        risultati[modo] = {
+            'accodamento_us': round(1e6 * accodamento / (args.giri * args.messaggi), 2),
+            'svuotamento_us': round(1e6 * svuotamento / consegnati, 2),
+            'ms_per_svuotamento': round(1e3 * svuotamento / (args.giri * len(riceventi)), 2)
+        }
+    return risultati
+
+
+async def richiesta_http(porta, metodo, percorso, corpo=None, token=None):
+    # una richiesta su una connessione nuova: il server di sviluppo di Flask non tiene il keep-alive.
+    # restituisce (stato, corpo della risposta)
+    reader, writer = await asyncio.open_connection('127.0.0.1', porta)
+    dati = json.dumps(corpo).encode('utf-8') if corpo is not None else b''
+    autorizzazione = f"Authorization: Bearer {token}\r\n" if token else ""
+    writer.write(
+        f"{metodo} {percorso} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n{autorizzazione}"
+        f"Content-Type: application/json\r\nContent-Length: {len(dati)}\r\n\r\n".encode('latin-1') + dati
+    )
+    await writer.drain()
+    try:
+        risposta = await reader.read()
+    finally:
+        writer.close()
+    intestazione, _, corpo_risposta = risposta.partition(b'\r\n\r\n')
+    return int(intestazione.split(b' ', 2)[1]), corpo_risposta
+
+
+def stato_processo(pid):
+    stato = {}
+    with open(f"/proc/{pid}/status") as f:
+        for riga in f:
+            nome, _, valore = riga.partition(':')
+            stato[nome] = valore.strip()
+    return {
+        'rss_mb': round(int(stato['VmRSS'].split()[0]) / 1024, 1),
+        'thread': int(stato['Threads'])
+    }
+
+
+async def tieni_connessioni(args, porta, pid):
+    inizio = time.perf_counter()
+    token = []
+    for i in range(args.connessioni):
+        await richiesta_http(porta, 'POST', '/registra_utente', {'nickname': f"c{i}", 'password': 'x'})
+        _, corpo = await richiesta_http(porta, 'POST', '/login', {'nickname': f"c{i}", 'password': 'x'})
+        token.append(json.loads(corpo)['token'])
+        await richiesta_http(porta, 'POST', '/registra', {'nickname': f"c{i}", 'porta': 1}, token[i])
+    durata_registrazione = time.perf_counter() - inizio
+
+    def long_poll(i):
+        return asyncio.ensure_future(
+            richiesta_http(porta, 'GET', f"/messaggi/c{i}?wait={args.attesa}", token=token[i]))
+
+    # ogni utente tiene una connessione aperta, ferma in long-poll sulla propria casella
+    attese = [long_poll(i) for i in range(args.connessioni)]
+    await asyncio.sleep(args.connessioni / 1000 + 2)
+    risorse = stato_processo(pid)
+
+    # latenza di consegna mentre gli altri aspettano: invio a cN e fine del long-poll di cN
+    latenze = []
+    for n in range(args.sonde):
+        i = n % args.connessioni
+        inizio = time.perf_counter()
+        await richiesta_http(porta, 'POST', '/invia_messaggio',
+                             {'mittente': 'c0', 'destinatario': f"c{i}", 'messaggio': 'ping'}, token[0])
+        await attese[i]
+        latenze.append(time.perf_counter() - inizio)
+        attese[i] = long_poll(i)
+
+    for attesa in attese:
+        attesa.cancel()
+    latenze.sort()
+    return {
+        'connessioni': args.connessioni,
+        'registrazione_s': round(durata_registrazione, 2),
+        'server_con_long_poll_aperti': risorse,
+        'consegna_media_ms': round(1000 * sum(latenze) / len(latenze), 2),
+        'consegna_p99_ms': round(1000 * latenze[min(len(latenze) - 1, int(len(latenze) * 0.99))], 2)
+    }
+
+
+def avvia_server_locale(motore, porta, archivio='memoria'):
+    # server.py in un processo a parte, con una home temporanea; ritorna quando la porta accetta connessioni
+    home = tempfile.mkdtemp(prefix='messenger_bench_')
+    ambiente = dict(os.environ, HOME=home, USERPROFILE=home, MESSENGER_ARCHIVIO=archivio)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    processo = subprocess.Popen(
+        [sys.executable, script, '--motore', motore, '--porta', str(porta)],
+        env=ambiente, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', porta), timeout=1).close()
+            return processo
+        except OSError:
+            if processo.poll() is not None:
+                break
+            time.sleep(0.1)
+    processo.terminate()
+    raise RuntimeError(f"Il server non risponde sulla porta {porta}")
+
+
+def alza_limite_file(connessioni):
+    # il benchmark e il server, che eredita il limite, tengono aperto un socket per connessione:
+    # con il limite di default (spesso 1024) le connessioni oltre fallirebbero a metà misura
+    if resource is None:
+        return
+    necessari = connessioni + MARGINE_DESCRITTORI
+    morbido, rigido = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if morbido == resource.RLIM_INFINITY or morbido >= necessari:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (necessari, rigido))
+    except (ValueError, OSError):
+        sys.exit(f"{connessioni} connessioni richiedono {necessari} file aperti, ma il limite è {morbido} "
+                 f"e non si può alzare oltre {rigido}: alza ulimit -n o usa meno --connessioni")
+
+
+def bench_connessioni(args):
+    # molte connessioni aperte e ferme in long-poll: memoria, thread e latenza di consegna del server
+    alza_limite_file(args.connessioni)
+    processo = avvia_server_locale(args.motore, args.porta)
+    try:
+        risultato = asyncio.run(tieni_connessioni(args, args.porta, processo.pid))
+        risultato['motore'] = args.motore
+        return risultato
+    finally:
+        processo.terminate()
+        processo.wait()
+
+
+def percentili(valori):
+    ordinati = sorted(valori)
+    if not ordinati:
+        return {}
+    def al(p):
+        return round(1000 * ordinati[min(len(ordinati) - 1, int(len(ordinati) * p / 100))], 2)
+    return {'p50_ms': al(50), 'p95_ms': al(95), 'p99_ms': al(99), 'max_ms': round(1000 * ordinati[-1], 2)}
+
+
+def trasporto_processo(srv):
+    # richieste al server nello stesso processo, con il test client di Flask (uno per utente simulato)
+    client = srv.app.test_client()
+
+    def richiesta(metodo, percorso, corpo=None, header=None):
+        risposta = client.open(percorso, method=metodo, json=corpo, headers=header)
+        return risposta.status_code, risposta.get_json(silent=True) or {}
+    return richiesta
+
+
+def trasporto_rete(porta, timeout):
+    # richieste in loopback su una connessione per utente simulato, riaperta se il server la chiude
+    connessione = http.client.HTTPConnection('127.0.0.1', porta, timeout=timeout)
+
+    def richiesta(metodo, percorso, corpo=None, header=None):
+        dati = json.dumps(corpo).encode('utf-8') if corpo is not None else None
+        intestazioni = dict(header or {}, **({'Content-Type': 'application/json'} if dati else {}))
+        try:
+            connessione.request(metodo, percorso, body=dati, headers=intestazioni)
+            risposta = connessione.getresponse()
+            contenuto = risposta.read()
+        except (OSError, http.client.HTTPException):
+            connessione.close()
+            raise
+        try:
+            return risposta.status, json.loads(contenuto)
+        except ValueError:
+            return risposta.status, {}
+    return richiesta
+
+
+def simula_utente(indice, args, trasporto, misure, pronti, inizio_traffico):
+    # un utente: registrazione, login, ingresso, poi per args.durata secondi long-poll con cursore,
+    # un /ping ogni args.intervallo_ping secondi e in media args.messaggi_al_secondo invii a utenti a caso
+    casuale = random.Random(args.seme * 100003 + indice)
+    nickname = f"carico{indice}"
+
+    def chiama(nome, metodo, percorso, corpo=None, header=None):
+        inizio = time.perf_counter()
+        try:
+            stato, dati = trasporto(metodo, percorso, corpo, header)
+        except Exception:
+            stato, dati = 0, {}
+        misure['latenze'].setdefault(nome, []).append(time.perf_counter() - inizio)
+        if not 200 <= stato < 300:
+            chiave = f"{nome}_{stato or 'errore_di_rete'}"
+            misure['errori'][chiave] = misure['errori'].get(chiave, 0) + 1
+        return stato, dati
+
+    chiama('registra_utente', 'POST', '/registra_utente', {'nickname': nickname, 'password': 'x' * 64})
+    stato, dati = chiama('login', 'POST', '/login', {'nickname': nickname, 'password': 'x' * 64})
+    header = {'Authorization': f"Bearer {dati.get('token', '')}"}
+    stato, _ = chiama('registra', 'POST', '/registra', {'nickname': nickname, 'porta': 1}, header)
+    try:
+        pronti.wait()
+    except threading.BrokenBarrierError:
+        return
+    if stato != 200:
+        return
+
+    inizio = inizio_traffico[0]
+    fine = inizio + args.durata
+    prossimo_ping = inizio + casuale.uniform(0, args.intervallo_ping)
+    prossimo_invio = inizio + casuale.expovariate(args.messaggi_al_secondo)
+    ultimo_seq = 0
+    while True:
+        adesso = time.perf_counter()
+        if adesso >= fine:
+            break
+        if adesso >= prossimo_ping:
+            chiama('ping', 'POST', '/ping', {'nickname': nickname}, header)
+            prossimo_ping += args.intervallo_ping
+        if adesso >= prossimo_invio:
+            destinatario = f"carico{casuale.randrange(args.utenti)}"
+            # l'istante di invio viaggia nel testo: chi riceve misura la consegna da capo a capo
+            stato, _ = chiama('invia_messaggio', 'POST', '/invia_messaggio', {
+                'mittente': nickname, 'destinatario': destinatario, 'messaggio': repr(time.perf_counter())
+            }, header)
+            if stato == 200:
+                misure['inviati'] += 1
+            prossimo_invio += casuale.expovariate(args.messaggi_al_secondo)
+
+        # si aspetta nel long-poll fino al prossimo impegno, così ogni utente tiene sempre una richiesta aperta
+        attesa = max(0.0, min(prossimo_ping, prossimo_invio, fine, adesso + args.attesa_poll) - time.perf_counter())
+        stato, dati = chiama('messaggi_long_poll', 'GET', f"/messaggi/{nickname}?after={ultimo_seq}&wait={attesa:.3f}",
+                             header=header)
+        arrivo = time.perf_counter()
+        for messaggio in dati.get('messaggi', []):
+            if messaggio['seq'] > ultimo_seq:
+                ultimo_seq = messaggio['seq']
+                misure['consegne'].append(arrivo - float(messaggio['messaggio']))
+
+
+def bench_carico(args):
+    # N utenti simulati contro il server intero: richieste al secondo, latenze per route,
+    # consegna da capo a capo e memoria del server. ogni utente è un thread con il suo trasporto
+    processo = None
+    if args.modalita == 'processo':
+        os.environ['MESSENGER_ARCHIVIO'] = args.archivio
+        srv = carica_server()
+        nuovo_trasporto = lambda: trasporto_processo(srv)
+    else:
+        processo = avvia_server_locale(args.motore, args.porta, args.archivio)
+        nuovo_trasporto = lambda: trasporto_rete(args.porta, args.attesa_poll + 30)
+
+    # le liste si riempiono da più thread: append è atomico, i contatori sono solo indicativi di errori
+    misure = {'latenze': {}, 'errori': {}, 'consegne': [], 'inviati': 0}
+    inizio_traffico = [0.0]
+    registrazione = [0.0]
+    inizio_registrazione = time.perf_counter()
+
+    def al_via():
+        # chiamata una volta sola, quando tutti gli utenti sono entrati
+        inizio_traffico[0] = time.perf_counter()
+        registrazione[0] = inizio_traffico[0] - inizio_registrazione
+
+    pronti = threading.Barrier(args.utenti, action=al_via)
+    # memoria e thread del server, il massimo visto durante la prova; in modalità processo
+    # comprendono anche i thread del carico
+    picco = {'rss_mb': 0, 'thread': 0}
+    finito = threading.Event()
+
+    def campiona():
+        while not finito.wait(0.5):
+            for chiave, valore in stato_processo(processo.pid if processo else os.getpid()).items():
+                picco[chiave] = max(picco[chiave], valore)
+    threading.Thread(target=campiona, daemon=True).start()
+    threads = [
+        threading.Thread(target=simula_utente, args=(i, args, nuovo_trasporto(), misure, pronti, inizio_traffico),
+                         daemon=True)
+        for i in range(args.utenti)
+    ]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        durata = time.perf_counter() - inizio_traffico[0]
+    finally:
+        finito.set()
+        if processo is not None:
+            processo.terminate()
+            processo.wait()
+
+    traffico = ('ping', 'invia_messaggio', 'messaggi_long_poll')
+    richieste = sum(len(misure['latenze'].get(nome, [])) for nome in traffico)
+    route = {}
+    for nome, latenze in misure['latenze'].items():
+        route[nome] = {'richieste': len(latenze), **percentili(latenze)}
+        if nome in traffico:
+            route[nome]['al_secondo'] = round(len(latenze) / durata, 1)
+    return {
+        'parametri': {chiave: valore for chiave, valore in vars(args).items() if chiave != 'funzione'},
+        'python': sys.version.split()[0],
+        'registrazione_s': round(registrazione[0], 2),
+        'durata_s': round(durata, 2),
+        'richieste_al_secondo': round(richieste / durata, 1),
+        'route': route,
+        'errori': misure['errori'],
+        'consegna': {
+            'inviati': misure['inviati'],
+            'ricevuti': len(misure['consegne']),
+            **percentili(misure['consegne'])
+        },
+        'server_picco': picco
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del server Messenger")
+    parser.add_argument('--uscita', help="scrive il risultato JSON anche in questo file, per confrontare le prove")
+    sotto = parser.add_subparsers(dest='comando', required=True)
+
+    p_lock = sotto.add_parser('lock', help="invio/ricezione al crescere dei thread")
+    p_lock.add_argument('--thread', type=int, nargs='+', default=[1, 2, 4, 8])
+    p_lock.add_argument('--messaggi', type=int, default=500, help="messaggi per thread")
+    p_lock.add_argument('--registrazioni', action='store_true',
+                        help="registra nuovi utenti in parallelo durante la misura")
+    p_lock.add_argument('--profilo-lock', action='store_true', help="attiva il profilo dei lock (MESSENGER_PROFILO_LOCK)")
+    p_lock.add_argument('--punti', type=int, default=8, help="punti di chiamata da riportare con --profilo-lock")
+    p_lock.set_defaults(funzione=bench_lock)
+
+    p_reg = sotto.add_parser('registrazioni', help="costo di una registrazione al crescere degli utenti")
+    p_reg.add_argument('--utenti', type=int, default=100000)
+    p_reg.add_argument('--passo', type=int, default=10000, help="registrazioni per misura")
+    p_reg.add_argument('--thread', type=int, default=8)
+    p_reg.set_defaults(funzione=bench_registrazioni)
+
+    p_scad = sotto.add_parser('scadenze', help="ping e pulizia della presenza con molti utenti online")
+    p_scad.add_argument('--utenti', type=int, default=100000)
+    p_scad.add_argument('--scaduti', type=int, default=100)
+    p_scad.set_defaults(funzione=bench_scadenze)
+
+    p_dep = sotto.add_parser('deposito', help="messaggi al secondo verso utenti offline")
+    p_dep.add_argument('--thread', type=int, default=16)
+    p_dep.add_argument('--messaggi', type=int, default=500, help="messaggi per thread")
+    p_dep.add_argument('--destinatari', type=int, default=1000)
+    p_dep.set_defaults(funzione=bench_deposito)
+
+    p_tok = sotto.add_parser('token', help="controllo d'identità: token firmato contro lookup sotto lock")
+    p_tok.add_argument('--thread', type=int, nargs='+', default=[1, 8])
+    p_tok.add_argument('--controlli', type=int, default=200000, help="controlli per thread")
+    p_tok.add_argument('--utenti', type=int, default=10000, help="utenti nella tabella presenza")
+    p_tok.add_argument('--richieste', type=int, default=2000, help="richieste per route")
+    p_tok.set_defaults(funzione=bench_token)
+
+    p_met = sotto.add_parser('metriche', help="costo per richiesta della registrazione delle metriche")
+    p_met.add_argument('--thread', type=int, nargs='+', default=[1, 8])
+    p_met.add_argument('--richieste', type=int, default=200000, help="richieste per thread")
+    p_met.set_defaults(funzione=bench_metriche)
+
+    p_mem = sotto.add_parser('memoria', help="byte occupati da ogni messaggio in attesa in una casella")
+    p_mem.add_argument('--messaggi', type=int, default=50000)
+    p_mem.add_argument('--utenti', type=int, default=100, help="caselle in cui si dividono i messaggi")
+    p_mem.set_defaults(funzione=bench_memoria)
+
+    p_svu = sotto.add_parser('svuotamento', help="CPU per messaggio consegnato svuotando caselle piene")
+    p_svu.add_argument('--messaggi', type=int, default=1000, help="messaggi per casella (al più MAX_MESSAGGI_CASELLA)")
+    p_svu.add_argument('--destinatari', type=int, default=10, help="destinatari di ogni messaggio in multicast")
+    p_svu.add_argument('--giri', type=int, default=20)
+    p_svu.set_defaults(funzione=bench_svuotamento)
+
+    p_conn = sotto.add_parser('connessioni', help="molte connessioni aperte in long-poll su un server vero")
+    p_conn.add_argument('--motore', choices=['flask', 'asyncio'], default='asyncio')
+    p_conn.add_argument('--connessioni', type=int, default=10000)
+    p_conn.add_argument('--attesa', type=int, default=30, help="secondi di long-poll per connessione")
+    p_conn.add_argument('--sonde', type=int, default=200, help="messaggi usati per misurare la latenza")
+    p_conn.add_argument('--porta', type=int, default=5099)
+    p_conn.set_defaults(funzione=bench_connessioni)
+
+    p_car = sotto.add_parser('carico', help="molti utenti simulati: richieste al secondo, latenze per route, "
+                                             "consegna e memoria del server")
+    p_car.add_argument('--modalita', choices=['processo', 'rete'], default='processo',
+                       help="processo: test client di Flask; rete: server.py in un altro processo, in loopback")
+    p_car.add_argument('--motore', choices=['flask', 'asyncio'], default='asyncio', help="solo con --modalita rete")
+    p_car.add_argument('--archivio', choices=['memoria', 'sqlite'], default='memoria')
+    p_car.add_argument('--utenti', type=int, default=1000)
+    p_car.add_argument('--durata', type=float, default=30, help="secondi di traffico dopo l'ingresso di tutti")
+    p_car.add_argument('--messaggi-al-secondo', type=float, default=0.1, help="invii medi per utente")
+    p_car.add_argument('--intervallo-ping', type=float, default=30)
+    p_car.add_argument('--attesa-poll', type=float, default=25, help="secondi massimi di un long-poll")
+    p_car.add_argument('--seme', type=int, default=1, help="stesso seme, stessa sequenza di invii")
+    p_car.add_argument('--porta', type=int, default=5098)
+    p_car.set_defaults(funzione=bench_carico)
+
+    args = parser.parse_args()
+    risultato = json.dumps(args.funzione(args), indent=2)
+    print(risultato)
+    if args.uscita:
+        with open(args.uscita, 'w', encoding='utf-8') as f:
+            f.write(risultato + '\n')
+
+
+if __name__ == '__main__':
+    main()
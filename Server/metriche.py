@@ -0,0 +1,113 @@
+import bisect
+import threading
+
+# metriche del server nel formato testuale di Prometheus, servite da /metrics.
+# registrare costa un bisect e un lock per metrica: resta sempre acceso. i valori sono del singolo processo
+
+# limiti in secondi degli istogrammi: richieste HTTP e operazioni di manutenzione
+LIMITI_RICHIESTE = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LIMITI_OPERAZIONI = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+REGISTRO = []
+
+
+def formatta_etichette(nomi, valori, altre=''):
+    coppie = [f'{nome}="{valore}"' for nome, valore in zip(nomi, valori)]
+    if altre:
+        coppie.append(altre)
+    return '{' + ','.join(coppie) + '}' if coppie else ''
+
+
+class Contatore:
+    def __init__(self, nome, aiuto, etichette=()):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = etichette
+        # valori delle etichette (tupla) -> conteggio
+        self.valori = {}
+        self.lock = threading.Lock()
+        REGISTRO.append(self)
+
+    def incrementa(self, quanto=1, *etichette):
+        with self.lock:
+            self.valori[etichette] = self.valori.get(etichette, 0) + quanto
+
+    def righe(self):
+        with self.lock:
+            valori = list(self.valori.items())
+        yield f"# HELP {self.nome} {self.aiuto}"
+        yield f"# TYPE {self.nome} counter"
+        for etichette, valore in sorted(valori):
+            yield f"{self.nome}{formatta_etichette(self.etichette, etichette)} {valore}"
+
+
+class Istogramma:
+    def __init__(self, nome, aiuto, limiti, etichette=()):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.limiti = limiti
+        self.etichette = etichette
+        # valori delle etichette -> [conteggi per intervallo (l'ultimo è +Inf), somma]
+        self.serie = {}
+        self.lock = threading.Lock()
+        REGISTRO.append(self)
+
+    def osserva(self, valore, *etichette):
+        indice = bisect.bisect_left(self.limiti, valore)
+        with self.lock:
+            serie = self.serie.get(etichette)
+            if serie is None:
+                serie = self.serie[etichette] = [[0] * (len(self.limiti) + 1), 0.0]
+            serie[0][indice] += 1
+            serie[1] += valore
+
+    def righe(self):
+        with self.lock:
+            serie = [(etichette, list(conteggi), somma) for etichette, (conteggi, somma) in self.serie.items()]
+        yield f"# HELP {self.nome} {self.aiuto}"
+        yield f"# TYPE {self.nome} histogram"
+        for etichette, conteggi, somma in sorted(serie):
+            # nel formato di Prometheus i bucket sono cumulativi
+            cumulato = 0
+            for limite, conteggio in zip(self.limiti + ('+Inf',), conteggi):
+                cumulato += conteggio
+                le = 'le="%s"' % limite
+                yield f"{self.nome}_bucket{formatta_etichette(self.etichette, etichette, le)} {cumulato}"
+            yield f"{self.nome}_sum{formatta_etichette(self.etichette, etichette)} {somma}"
+            yield f"{self.nome}_count{formatta_etichette(self.etichette, etichette)} {cumulato}"
+
+
+class Indicatore:
+    # gauge letto solo quando qualcuno chiede /metrics: funzione() restituisce il valore
+    def __init__(self, nome, aiuto, funzione):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.funzione = funzione
+        REGISTRO.append(self)
+
+    def righe(self):
+        yield f"# HELP {self.nome} {self.aiuto}"
+        yield f"# TYPE {self.nome} gauge"
+        yield f"{self.nome} {self.funzione()}"
+
+
+def testo():
+    righe = []
+    for metrica in REGISTRO:
+        righe.extend(metrica.righe())
+    return '\n'.join(righe) + '\n'
+
+
+richieste = Contatore('messenger_richieste_total', "Richieste HTTP per route e codice di stato", ('route', 'codice'))
+durata_richieste = Istogramma('messenger_durata_richiesta_seconds', "Durata delle richieste HTTP per route",
+                              LIMITI_RICHIESTE, ('route',))
+messaggi_accodati = Contatore('messenger_messaggi_accodati_total',
+                              "Consegne accettate (online o in deposito per chi è offline)")
+messaggi_consegnati = Contatore('messenger_messaggi_consegnati_total',
+                                "Messaggi inviati ai client da /messaggi, /sync e /stream")
+invii_duplicati = Contatore('messenger_invii_duplicati_total',
+                             "Consegne rispedite con un id già visto, non ripetute")
+durata_pulizia = Istogramma('messenger_durata_pulizia_seconds', "Durata di un giro di pulizia della presenza",
+                            LIMITI_OPERAZIONI)
+durata_salvataggio = Istogramma('messenger_durata_salvataggio_utenti_seconds',
+                                "Durata della scrittura dello snapshot degli utenti", LIMITI_OPERAZIONI)
@@ -0,0 +1,152 @@
+import json
+import os
+import sys
+import threading
+import time
+
+# profilo dei lock del server, solo se MESSENGER_PROFILO_LOCK=1: per ogni lock e punto di chiamata
+# acquisizioni, attesa per prenderlo, tempo in cui resta preso e thread già in coda all'arrivo.
+# spento, crea_lock e crea_condizione restituiscono i lock normali di threading: nessun costo
+
+ATTIVO = os.environ.get('MESSENGER_PROFILO_LOCK', '') not in ('', '0')
+
+# (lock, punto di chiamata) -> [acquisizioni, contese, attesa totale, attesa max,
+#                               possesso totale, possesso max, thread in coda (somma), thread in coda (max)]
+STATISTICHE = {}
+LOCK_STATISTICHE = threading.Lock()
+
+# i frame di questi file non sono punti di chiamata: Condition prende il lock da dentro threading
+FILE_INTERNI = {threading.__file__, __file__}
+
+
+def punto_di_chiamata():
+    # "chiamante > funzione": la funzione che ha preso il lock e chi l'ha chiamata (la route, il thread...)
+    frame = sys._getframe(2)
+    while frame.f_code.co_filename in FILE_INTERNI:
+        frame = frame.f_back
+    chiamante = frame.f_back
+    if chiamante is None:
+        return frame.f_code.co_name
+    return f"{chiamante.f_code.co_name} > {frame.f_code.co_name}"
+
+
+class LockProfilato:
+    def __init__(self, nome):
+        self.nome = nome
+        self.lock = threading.Lock()
+        # thread fermi in acquire, e i dati dell'acquisizione in corso (li tocca solo chi ha il lock)
+        self.in_coda = 0
+        self.punto = None
+        self.preso = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        punto = punto_di_chiamata()
+        if self.lock.acquire(False):
+            attesa, in_coda = 0.0, -1
+        elif not blocking:
+            return False
+        else:
+            inizio = time.perf_counter()
+            with LOCK_STATISTICHE:
+                in_coda = self.in_coda
+                self.in_coda += 1
+            preso = self.lock.acquire(True, timeout)
+            with LOCK_STATISTICHE:
+                self.in_coda -= 1
+            if not preso:
+                return False
+            attesa = time.perf_counter() - inizio
+
+        self.punto = punto
+        self.preso = time.perf_counter()
+        with LOCK_STATISTICHE:
+            voce = STATISTICHE.get((self.nome, punto))
+            if voce is None:
+                voce = STATISTICHE[(self.nome, punto)] = [0, 0, 0.0, 0.0, 0.0, 0.0, 0, 0]
+            voce[0] += 1
+            if in_coda >= 0:
+                voce[1] += 1
+                voce[2] += attesa
+                voce[3] = max(voce[3], attesa)
+                voce[6] += in_coda
+                voce[7] = max(voce[7], in_coda)
+        return True
+
+    def release(self):
+        possesso = time.perf_counter() - self.preso
+        punto = self.punto
+        self.lock.release()
+        with LOCK_STATISTICHE:
+            # la voce manca se le statistiche sono state azzerate mentre il lock era preso:
+            # quel possesso è cominciato prima e non conta
+            voce = STATISTICHE.get((self.nome, punto))
+            if voce is not None:
+                voce[4] += possesso
+                voce[5] = max(voce[5], possesso)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *errore):
+        self.release()
+
+    # usati da threading.Condition: durante wait() il lock è libero e quel tempo non è né attesa né possesso
+    def _release_save(self):
+        self.release()
+
+    def _acquire_restore(self, stato):
+        self.lock.acquire()
+        self.preso = time.perf_counter()
+
+    def _is_owned(self):
+        return self.lock.locked()
+
+
+def crea_lock(nome):
+    return LockProfilato(nome) if ATTIVO else threading.Lock()
+
+
+def crea_condizione(nome):
+    # condition con il suo lock, come threading.Condition(); per un lock già creato basta Condition(lock)
+    return threading.Condition(LockProfilato(nome)) if ATTIVO else threading.Condition()
+
+
+def rapporto():
+    # punti di chiamata ordinati per attesa totale: prima chi aspetta di più
+    with LOCK_STATISTICHE:
+        voci = [(chiave, list(voce)) for chiave, voce in STATISTICHE.items()]
+    righe = []
+    for (nome, punto), (acquisizioni, contese, attesa, attesa_max, possesso, possesso_max,
+                        in_coda, in_coda_max) in voci:
+        righe.append({
+            'lock': nome,
+            'punto': punto,
+            'acquisizioni': acquisizioni,
+            'contese': contese,
+            'attesa_totale_ms': round(1e3 * attesa, 3),
+            'attesa_media_us': round(1e6 * attesa / contese, 1) if contese else 0.0,
+            'attesa_max_ms': round(1e3 * attesa_max, 3),
+            'possesso_totale_ms': round(1e3 * possesso, 3),
+            'possesso_medio_us': round(1e6 * possesso / acquisizioni, 1) if acquisizioni else 0.0,
+            'possesso_max_ms': round(1e3 * possesso_max, 3),
+            'in_coda_medio': round(in_coda / contese, 2) if contese else 0.0,
+            'in_coda_max': in_coda_max
+        })
+    righe.sort(key=lambda riga: (riga['attesa_totale_ms'], riga['possesso_totale_ms']), reverse=True)
+    return {'attivo': ATTIVO, 'punti': righe}
+
+
+def azzera():
+    with LOCK_STATISTICHE:
+        STATISTICHE.clear()
+
+
+def stampa_rapporto(*segnale):
+    # per SIGUSR1: scrive su stderr da un thread a parte, il gestore del segnale può arrivare
+    # mentre il thread principale tiene LOCK_STATISTICHE
+    def stampa():
+        print(json.dumps(rapporto(), indent=2), file=sys.stderr, flush=True)
+    threading.Thread(target=stampa, daemon=True).start()
@@ -1,27 +1,542 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import threading
 import time
 from datetime import datetime
 import json
 import os
 import sys
+import argparse
+import subprocess
 from pathlib import Path
 import tempfile
+import hashlib
+import hmac
+import binascii
+import itertools
+import signal
+import sqlite3
+from collections import deque, OrderedDict
+import metriche
+import profilo_lock
 
 app = Flask(__name__)
 
+# attesa massima (secondi) concessa a un long-poll su /messaggi/<nickname>
+MAX_ATTESA_POLL = 30
+# ogni quanti secondi lo stream SSE manda un keepalive se non c'è altro da inviare
+INTERVALLO_KEEPALIVE_STREAM = 15
+# il journal delle registrazioni viene compattato nello snapshot dopo tanti record...
+SOGLIA_COMPATTAMENTO_JOURNAL = 10000
+# ...o comunque ogni tanti secondi se non è vuoto
+INTERVALLO_COMPATTAMENTO_JOURNAL = 300
+# un utente senza ping per più di TIMEOUT_PRESENZA secondi viene disconnesso...
+TIMEOUT_PRESENZA = 90
+# ...con al massimo PRECISIONE_PRESENZA secondi di ritardo
+PRECISIONE_PRESENZA = 1.0
+# limiti di ogni casella, in numero di messaggi e in byte
+MAX_MESSAGGI_CASELLA = 1000
+MAX_BYTE_CASELLA = 1024 * 1024
+# cosa fare con una casella piena: 'rifiuta' (429), 'scarta_vecchi' oppure 'su_disco'
+POLITICA_CASELLA_PIENA = 'rifiuta'
+# memoria complessiva concessa ai messaggi in coda in tutte le caselle
+BUDGET_MEMORIA_CASELLE = 256 * 1024 * 1024
+# il budget è diviso in tante quote, ognuna con il suo lock; le caselle sono assegnate a turno alle quote
+QUOTE_MEMORIA = 64
+# secondi suggeriti al mittente con il 429
+RIPROVA_CASELLA_PIENA = 5
+# consegne (messaggi x destinatari) accettate in una sola richiesta a /invia_messaggi
+MAX_CONSEGNE_BATCH = 500
+# messaggi con l'id scelto dal client: per tanti secondi una consegna rispedita con lo stesso id non si ripete...
+RICORDA_INVII = 24 * 3600
+# ...(con l'archivio in memoria al massimo per tante consegne)...
+MAX_INVII_RICORDATI = 100000
+# ...e una consegna ancora in corso dopo tanti secondi si considera fallita
+SCADENZA_PRENOTAZIONE_INVIO = 60
+# lunghezza massima dell'id di un messaggio
+MAX_LUNGHEZZA_ID = 64
+# letture con cursore (?after=<seq>): messaggi per pagina se il client non indica limit, e massimo concesso
+PAGINA_MESSAGGI = 100
+MAX_PAGINA_MESSAGGI = 1000
+# entrate/uscite ricordate per rispondere con i soli cambiamenti; chi è più indietro riceve la lista intera
+MAX_REGISTRO_PRESENZA = 1000
+# messaggi per utenti offline: ogni pagina consegnata a chi rientra ne contiene al massimo tanti...
+PAGINA_ARRETRATI = 200
+# ...e ogni destinatario ne può avere in deposito al massimo tanti (oltre vale POLITICA_CASELLA_PIENA)
+MAX_MESSAGGI_DEPOSITO = 10000
+# i messaggi non consegnati entro tanti secondi vengono cancellati
+RITENZIONE_DEPOSITO = 30 * 24 * 3600
+# ogni quanti secondi si cancellano i messaggi scaduti e si restituisce lo spazio al disco
+INTERVALLO_COMPATTAMENTO_DEPOSITO = 3600
+# durata in secondi dei token di sessione rilasciati da /login (il client li rinnova prima della scadenza)
+DURATA_TOKEN = 12 * 3600
+# dove stanno utenti, presenza e caselle: 'memoria' (un solo processo) oppure 'sqlite'
+# (database condiviso, per più processi server sulla stessa macchina)
+ARCHIVIO = os.environ.get('MESSENGER_ARCHIVIO', 'memoria')
+
+# caratteri di timestamp_str (HH:MM:SS), contati nella dimensione come quando era salvato nel messaggio
+LUNGHEZZA_TIMESTAMP = 8
+# risposte con più messaggi di così si mandano a blocchi, senza costruire tutto il corpo in memoria
+SOGLIA_RISPOSTA_A_BLOCCHI = 200
+# da dove si possono chiamare le route di amministrazione (azzerare il profilo dei lock)
+INDIRIZZI_LOCALI = {'127.0.0.1', '::1'}
+
+# (secondo, HH:MM:SS) dell'ultimo timestamp formattato: i messaggi dello stesso secondo lo riusano
+ultimo_timestamp = (None, '')
+
+class Messaggio:
+    # un messaggio accettato, già in JSON: i campi che riceve il client (mittente, messaggio, timestamp_str)
+    # senza graffe e senza il seq, che è per destinatario. si codifica una volta sola, quando il server
+    # lo accetta, anche se va a più destinatari: consegnarlo è concatenare byte
+    __slots__ = ('frammento', 'dimensione')
+    
+    def __init__(self, mittente, testo, creato):
+        # come json.dumps(..., ensure_ascii=False) ma senza creare un encoder per ogni messaggio
+        self.frammento = ('"mittente":%s,"messaggio":%s,"timestamp_str":"%s"' % (
+            json.encoder.encode_basestring(mittente), json.encoder.encode_basestring(testo),
+            formatta_timestamp(creato))).encode('utf-8')
+        # stima dei byte occupati per i limiti delle caselle: somma dei campi in utf-8
+        self.dimensione = len(mittente.encode('utf-8')) + len(testo.encode('utf-8')) + LUNGHEZZA_TIMESTAMP
+
+def messaggio_da_frammento(frammento):
+    # per i messaggi riletti da disco, che non tornano in una casella in memoria: la dimensione non serve
+    messaggio = Messaggio.__new__(Messaggio)
+    messaggio.frammento = frammento
+    messaggio.dimensione = len(frammento)
+    return messaggio
+
+def corpo_messaggio(messaggio):
+    # come si salva nel deposito: l'oggetto JSON completo, senza seq
+    return '{' + messaggio.frammento.decode('utf-8') + '}'
+
+def messaggio_da_corpo(corpo):
+    if '"timestamp_str"' in corpo:
+        return messaggio_da_frammento(corpo.strip()[1:-1].encode('utf-8'))
+    # depositato con l'istante di invio al posto del timestamp formattato
+    dati = json.loads(corpo)
+    return Messaggio(dati['mittente'], dati['messaggio'], dati['creato'])
+
+def formatta_timestamp(creato):
+    global ultimo_timestamp
+    secondo = int(creato)
+    # una tupla sola, letta una volta: un altro thread può sostituirla tra il confronto e il return
+    ultimo = ultimo_timestamp
+    if ultimo[0] != secondo:
+        ultimo = ultimo_timestamp = (secondo, time.strftime("%H:%M:%S", time.localtime(secondo)))
+    return ultimo[1]
+
+def messaggio_numerato(seq, messaggio):
+    # il JSON che ricevono i client, in byte; il seq è per destinatario, il frammento resta condiviso
+    return b'{"seq":%d,%s}' % (seq, messaggio.frammento)
+
+class Casella:
+    # casella di un utente online, con il suo lock: utenti diversi non si contendono niente
+    # i metodi vanno chiamati con il lock preso
+    def __init__(self, nickname, file_disco, arretrati=0, ultimo_seq=0, quota=None):
+        self.nickname = nickname
+        # (seq, messaggio) non ancora confermati dal client, in ordine di seq
+        self.messaggi = deque()
+        self.byte = 0
+        # la QuotaMemoria da cui prende i byte dei suoi messaggi
+        self.quota = quota
+        # ultimo seq assegnato: riparte da quello del deposito, così gli arretrati vengono prima
+        self.ultimo_seq = ultimo_seq
+        # messaggi che aspettano nel deposito da prima dell'ingresso: finché ce ne sono,
+        # anche i nuovi vanno nel deposito e si consegnano a pagine, così l'ordine resta giusto
+        self.arretrati = arretrati
+        # messaggi riversati su disco con la politica 'su_disco', sempre più recenti di quelli in memoria:
+        # hanno i seq consecutivi da primo_su_disco a ultimo_seq
+        self.file_disco = file_disco
+        self.su_disco = 0
+        self.primo_su_disco = 0
+        self.lock = profilo_lock.crea_lock('casella')
+        # così invia_messaggio sveglia solo il destinatario
+        self.condizione = threading.Condition(self.lock)
+        # callback da chiamare insieme alla condition (le usa il motore asyncio)
+        self.ascoltatori = set()
+        self.attiva = True
+
+    def sveglia(self):
+        self.condizione.notify_all()
+        for ascoltatore in self.ascoltatori:
+            ascoltatore()
+
+    def profondita(self):
+        return len(self.messaggi) + self.su_disco + self.arretrati
+
+    def ha_dopo(self, cursore):
+        # per lo stream con cursore: i messaggi già inviati restano fino alla conferma e non contano
+        return self.ultimo_seq > cursore
+
+    def piena(self, dimensione):
+        return (len(self.messaggi) >= MAX_MESSAGGI_CASELLA
+                or self.byte + dimensione > MAX_BYTE_CASELLA)
+
+    def aggiungi(self, messaggio, dimensione):
+        self.ultimo_seq += 1
+        self.messaggi.append((self.ultimo_seq, messaggio))
+        self.byte += dimensione
+
+    def scarta_piu_vecchio(self):
+        dimensione = self.messaggi.popleft()[1].dimensione
+        self.byte -= dimensione
+        return dimensione
+
+    def riversa_su_disco(self, messaggio):
+        self.ultimo_seq += 1
+        if not self.su_disco:
+            self.file_disco.parent.mkdir(exist_ok=True)
+            self.primo_su_disco = self.ultimo_seq
+        # il primo messaggio riversato tronca eventuali avanzi di un'esecuzione precedente
+        with open(self.file_disco, 'ab' if self.su_disco else 'wb') as f:
+            f.write(b'%d %s\n' % (self.ultimo_seq, messaggio.frammento))
+        self.su_disco += 1
+
+    def leggi_disco(self, limite=None, dopo=0):
+        # [(seq, messaggio)] ancora da confermare sul disco; le righe già confermate restano nel file fino alla fine
+        primo = max(self.primo_su_disco, dopo + 1)
+        with open(self.file_disco, 'rb') as f:
+            # una riga per messaggio: seq, spazio, frammento JSON (che non contiene mai un a capo)
+            righe = (riga.rstrip(b'\n').split(b' ', 1) for riga in f)
+            return [(int(seq), messaggio_da_frammento(frammento)) for seq, frammento in itertools.islice(
+                (riga for riga in righe if int(riga[0]) >= primo), limite)]
+
+    def pagina(self, limite, dopo=0):
+        # i primi messaggi non confermati con seq oltre dopo, [(seq, messaggio)], senza toglierli
+        messaggi = list(itertools.islice((voce for voce in self.messaggi if voce[0] > dopo), limite))
+        if self.su_disco and len(messaggi) < limite:
+            messaggi.extend(self.leggi_disco(limite - len(messaggi), dopo))
+        return messaggi
+
+    def conferma(self, seq):
+        # toglie i messaggi fino a seq compreso, che il client ha ricevuto; restituisce i byte liberati
+        liberati = 0
+        while self.messaggi and self.messaggi[0][0] <= seq:
+            liberati += self.messaggi.popleft()[1].dimensione
+        self.byte -= liberati
+        
+        if self.su_disco and seq >= self.primo_su_disco:
+            if seq >= self.ultimo_seq:
+                self.rimuovi_file_disco()
+            else:
+                self.su_disco = self.ultimo_seq - seq
+                self.primo_su_disco = seq + 1
+        return liberati
+
+    def svuota(self):
+        # restituisce i messaggi in ordine di arrivo, [(seq, messaggio)], e i byte di memoria liberati
+        messaggi = list(self.messaggi)
+        liberati = self.byte
+        self.messaggi.clear()
+        self.byte = 0
+        
+        if self.su_disco:
+            messaggi.extend(self.leggi_disco())
+            self.rimuovi_file_disco()
+        return messaggi, liberati
+
+    def rimuovi_file_disco(self):
+        if self.su_disco:
+            self.file_disco.unlink(missing_ok=True)
+            self.su_disco = 0
+
+class QuotaMemoria:
+    # una parte del budget delle caselle: caselle su quote diverse non si contendono il lock della memoria
+    __slots__ = ('lock', 'byte')
+    
+    def __init__(self):
+        self.lock = profilo_lock.crea_lock('memoria')
+        self.byte = 0
+
+class RuotaScadenze:
+    # timer wheel: spostare una scadenza è O(1) e ogni tick guarda solo gli slot già scaduti
+    def __init__(self, precisione):
+        self.precisione = precisione
+        # indice slot -> chiavi che scadono in quello slot
+        self.slot = {}
+        self.slot_di = {}
+        self.prossimo_slot = int(time.time() / precisione)
+
+    def aggiorna(self, chiave, scadenza):
+        # mai in uno slot già passato, altrimenti non verrebbe più visitato
+        indice = max(int(scadenza / self.precisione), self.prossimo_slot)
+        vecchio = self.slot_di.get(chiave)
+        if vecchio == indice:
+            return
+        if vecchio is not None:
+            self.togli_da_slot(chiave, vecchio)
+        
+        self.slot.setdefault(indice, set()).add(chiave)
+        self.slot_di[chiave] = indice
+
+    def rimuovi(self, chiave):
+        indice = self.slot_di.pop(chiave, None)
+        if indice is not None:
+            self.togli_da_slot(chiave, indice)
+
+    def togli_da_slot(self, chiave, indice):
+        chiavi = self.slot[indice]
+        chiavi.discard(chiave)
+        if not chiavi:
+            del self.slot[indice]
+
+    def scadute(self, adesso):
+        # uno slot è scaduto quando è finito per intero, quindi non si scade mai in anticipo
+        ultimo = int(adesso / self.precisione)
+        scadute = []
+        while self.prossimo_slot < ultimo:
+            chiavi = self.slot.pop(self.prossimo_slot, None)
+            if chiavi:
+                for chiave in chiavi:
+                    del self.slot_di[chiave]
+                scadute.extend(chiavi)
+            self.prossimo_slot += 1
+        return scadute
+
+    def __len__(self):
+        return len(self.slot_di)
+
+class DepositoMessaggi:
+    # messaggi in attesa di un destinatario offline (o che ha ancora arretrati), in SQLite indicizzati
+    # per (destinatario, seq). le scritture passano da un solo thread: un commit con fsync per batch
+    def __init__(self, percorso):
+        self.lock = profilo_lock.crea_lock('deposito')
+        # destinatario -> ultimo seq assegnato, e primo seq ancora nel deposito per chi ne ha
+        self.ultimo_seq = {}
+        self.primo_seq = {}
+        # operazioni in coda per il thread di scrittura, come per il journal degli utenti
+        self.operazioni = []
+        self.accodate = 0
+        self.scritte = 0
+        self.condizione = profilo_lock.crea_condizione('deposito_coda')
+        self.ultima_compattazione = time.time()
+        
+        self.scrittura = sqlite3.connect(percorso, check_same_thread=False, isolation_level=None)
+        # auto_vacuum va scelto prima di creare le tabelle, serve a restituire spazio nella compattazione
+        self.scrittura.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.scrittura.execute('PRAGMA journal_mode=WAL')
+        self.scrittura.execute('PRAGMA synchronous=FULL')
+        self.scrittura.executescript("""
+            CREATE TABLE IF NOT EXISTS messaggi (
+                destinatario TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                corpo TEXT NOT NULL,
+                creato REAL NOT NULL,
+                PRIMARY KEY (destinatario, seq)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS messaggi_creato ON messaggi(creato);
+            CREATE TABLE IF NOT EXISTS sequenze (
+                destinatario TEXT PRIMARY KEY,
+                ultimo INTEGER NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        # le letture hanno la loro connessione: non vedono mai un batch a metà
+        self.lettura = sqlite3.connect(percorso, check_same_thread=False, isolation_level=None)
+        self.lock_lettura = profilo_lock.crea_lock('deposito_lettura')
+        
+        self.ultimo_seq.update(self.scrittura.execute('SELECT destinatario, ultimo FROM sequenze'))
+        self.primo_seq.update(self.scrittura.execute(
+            'SELECT destinatario, MIN(seq) FROM messaggi GROUP BY destinatario'))
+        threading.Thread(target=self.scrivi, daemon=True).start()
+
+    def quanti(self, destinatario):
+        with self.lock:
+            primo = self.primo_seq.get(destinatario)
+            return 0 if primo is None else self.ultimo_seq[destinatario] - primo + 1
+
+    def ultimo(self, destinatario):
+        with self.lock:
+            return self.ultimo_seq.get(destinatario, 0)
+
+    def accoda(self, destinatario, messaggio, forza=False):
+        # il seq assegnato, None se il deposito del destinatario è pieno e la politica è 'rifiuta'
+        # forza: i messaggi di una casella chiusa entrano comunque, i limiti li rimette a posto la compattazione
+        with self.lock:
+            ultimo = self.ultimo_seq.get(destinatario, 0)
+            primo = self.primo_seq.get(destinatario, ultimo + 1)
+            operazioni = []
+            if ultimo - primo + 1 >= MAX_MESSAGGI_DEPOSITO and not forza:
+                if POLITICA_CASELLA_PIENA != 'scarta_vecchi':
+                    return None
+                operazioni.append(('-', destinatario, primo))
+                primo += 1
+            
+            seq = ultimo + 1
+            self.ultimo_seq[destinatario] = seq
+            self.primo_seq[destinatario] = primo
+            operazioni.append(('+', destinatario, seq, corpo_messaggio(messaggio), time.time()))
+            # dentro self.lock: le operazioni finiscono in coda nello stesso ordine dei seq
+            self.metti_in_coda(operazioni)
+        return seq
+
+    def rimuovi_fino(self, destinatario, seq):
+        with self.lock:
+            # niente da togliere: nessuna scrittura, ogni poll con cursore passa di qui
+            if seq < self.primo_seq.get(destinatario, seq + 1):
+                return
+            if self.ultimo_seq.get(destinatario, 0) <= seq:
+                self.primo_seq.pop(destinatario, None)
+            elif destinatario in self.primo_seq:
+                self.primo_seq[destinatario] = max(self.primo_seq[destinatario], seq + 1)
+            self.metti_in_coda([('-', destinatario, seq)])
+
+    def metti_in_coda(self, operazioni):
+        with self.condizione:
+            self.operazioni.extend(operazioni)
+            self.accodate += len(operazioni)
+            self.condizione.notify_all()
+
+    def attendi_scritture(self):
+        # aspetta che tutto quello che è in coda adesso sia su disco
+        with self.condizione:
+            numero = self.accodate
+            self.condizione.wait_for(lambda: self.scritte >= numero)
+
+    def pagina(self, destinatario, limite, dopo=0):
+        # i primi messaggi ancora da consegnare con seq oltre dopo, in ordine: [(seq, messaggio)]. solo quelli
+        # già scritti: chi vuole anche gli ultimi accodati chiama prima attendi_scritture, senza lock di casella presi
+        with self.lock:
+            primo = self.primo_seq.get(destinatario)
+        if primo is None:
+            return []
+        with self.lock_lettura:
+            righe = self.lettura.execute(
+                'SELECT seq, corpo FROM messaggi WHERE destinatario = ? AND seq >= ? ORDER BY seq LIMIT ?',
+                (destinatario, max(primo, dopo + 1), limite)
+            ).fetchall()
+        return [(seq, messaggio_da_corpo(corpo)) for seq, corpo in righe]
+
+    def scrivi(self):
+        while True:
+            with self.condizione:
+                self.condizione.wait_for(lambda: self.operazioni, timeout=INTERVALLO_COMPATTAMENTO_DEPOSITO)
+                # tutto quello che si è accumulato durante il commit precedente va in un solo batch
+                batch = self.operazioni
+                self.operazioni = []
+                ultima = self.accodate
+            
+            try:
+                if batch:
+                    self.applica(batch)
+                if time.time() - self.ultima_compattazione >= INTERVALLO_COMPATTAMENTO_DEPOSITO:
+                    self.compatta()
+            except Exception as e:
+                print(f"Errore nella scrittura del deposito messaggi: {e}", file=sys.stderr)
+            
+            with self.condizione:
+                self.scritte = ultima
+                self.condizione.notify_all()
+
+    def applica(self, batch):
+        db = self.scrittura
+        sequenze = {}
+        db.execute('BEGIN')
+        try:
+            for operazione in batch:
+                if operazione[0] == '+':
+                    db.execute('INSERT OR REPLACE INTO messaggi (destinatario, seq, corpo, creato) VALUES (?, ?, ?, ?)',
+                               operazione[1:])
+                    sequenze[operazione[1]] = operazione[2]
+                else:
+                    db.execute('DELETE FROM messaggi WHERE destinatario = ? AND seq <= ?', operazione[1:])
+            # l'ultimo seq sopravvive al riavvio anche quando il deposito del destinatario è vuoto
+            db.executemany('INSERT OR REPLACE INTO sequenze (destinatario, ultimo) VALUES (?, ?)',
+                           sequenze.items())
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def compatta(self):
+        # gira nel thread di scrittura: cancella i messaggi scaduti e quelli oltre il limite per destinatario
+        self.ultima_compattazione = time.time()
+        db = self.scrittura
+        db.execute('BEGIN')
+        try:
+            scaduti = db.execute('DELETE FROM messaggi WHERE creato < ? RETURNING destinatario, seq',
+                                 (self.ultima_compattazione - RITENZIONE_DEPOSITO,)).fetchall()
+            with self.lock:
+                oltre = [(d, self.ultimo_seq[d] - MAX_MESSAGGI_DEPOSITO)
+                         for d, primo in self.primo_seq.items()
+                         if self.ultimo_seq[d] - primo + 1 > MAX_MESSAGGI_DEPOSITO]
+            db.executemany('DELETE FROM messaggi WHERE destinatario = ? AND seq <= ?', oltre)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        
+        # i messaggi cancellati sono sempre i più vecchi di ogni destinatario
+        with self.lock:
+            for destinatario, seq in scaduti + oltre:
+                if destinatario in self.primo_seq:
+                    if seq >= self.ultimo_seq[destinatario]:
+                        del self.primo_seq[destinatario]
+                    else:
+                        self.primo_seq[destinatario] = max(self.primo_seq[destinatario], seq + 1)
+        
+        db.execute('PRAGMA incremental_vacuum')
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        if scaduti or oltre:
+            print(f"Deposito messaggi compattato: {len(scaduti)} scaduti, {len(oltre)} destinatari oltre il limite",
+                  file=sys.stderr)
+
+    def statistiche(self):
+        with self.lock:
+            return {
+                'destinatari': len(self.primo_seq),
+                'messaggi': sum(self.ultimo_seq[d] - p + 1 for d, p in self.primo_seq.items())
+            }
+
 class MessengerServer:
     def __init__(self):
+        # presenza: utenti, scadenze dei ping, stream_attivi e l'insieme delle caselle
         self.utenti = {}
+        self.scadenze = RuotaScadenze(PRECISIONE_PRESENZA)
+        # nickname -> casella degli stream SSE aperti, da svegliare quando cambiano gli utenti online
+        self.stream_attivi = {}
+        # cresce a ogni entrata o uscita, così i client sanno se la loro lista è ancora buona
+        self.versione_presenza = 0
+        # (versione, nickname, entrato) per le ultime MAX_REGISTRO_PRESENZA variazioni
+        self.registro_presenza = deque(maxlen=MAX_REGISTRO_PRESENZA)
+        self.lock_presenza = profilo_lock.crea_lock('presenza')
+        # nickname -> Casella, si legge senza lock e si modifica con lock_presenza
         self.messaggi = {}
-        self.ultimo_ping = {}
-        self.lock = threading.Lock()
+        # byte dei messaggi in memoria in tutte le caselle, divisi per quota: la somma si confronta con
+        # BUDGET_MEMORIA_CASELLE
+        self.quote_memoria = [QuotaMemoria() for _ in range(QUOTE_MEMORIA)]
+        self.prossima_quota = itertools.count()
+        # (mittente, id del client, destinatario) -> (esito, istante) delle consegne con id, dalla più vecchia
+        self.invii_recenti = OrderedDict()
+        self.lock_invii = profilo_lock.crea_lock('invii')
+        # elenco degli utenti registrati
         self.registered_users = {}
+        self.lock_utenti = profilo_lock.crea_lock('utenti')
+        # serializza le scritture dello snapshot, fuori da lock_utenti
+        self.lock_salvataggio = profilo_lock.crea_lock('salvataggio')
+        
+        # journal delle registrazioni: record in coda, group commit con un solo fsync per batch
+        self.journal_in_attesa = []
+        self.journal_accodati = 0
+        self.journal_scritti = 0
+        self.condizione_journal = profilo_lock.crea_condizione('journal_coda')
+        # protegge il file del journal tra il thread di scrittura e la compattazione
+        self.lock_journal = profilo_lock.crea_lock('journal')
+        self.record_nel_journal = 0
+        self.richiesta_compattazione = threading.Event()
         
         # start percorso file
         self.users_file = self.get_data_file_path()
+        # users.log contiene le registrazioni successive allo snapshot users.json
+        self.journal_file = self.users_file.with_suffix('.log')
+        # durante una compattazione il journal corrente viene spostato qui
+        self.journal_vecchio = self.users_file.with_suffix('.log.old')
+        # qui finiscono le caselle piene con la politica 'su_disco'
+        self.cartella_caselle = self.users_file.parent / 'caselle'
+        # messaggi per chi non è online, consegnati al prossimo ingresso
+        self.deposito = DepositoMessaggi(self.users_file.parent / 'messaggi.db')
         print(f"Percorso file utenti: {self.users_file}", file=sys.stderr)
         self.load_users()
+        self.apri_journal()
+        self.avvia_thread_journal()
         self.avvia_thread_pulizia()
 
     # 3 opzioni per la folder
@@ -61,28 +576,69 @@ class MessengerServer:
                 print(f"File utenti caricato da: {self.users_file}", file=sys.stderr)
             else:
                 self.registered_users = {}
-                self.save_users()
-                print(f"Creato nuovo file utenti in: {self.users_file}", file=sys.stderr)
+            
+            # snapshot + journal: riapplica le registrazioni non ancora compattate
+            riapplicati = 0
+            for percorso in (self.journal_vecchio, self.journal_file):
+                riapplicati += self.riapplica_journal(percorso)
+            
+            if riapplicati or not self.users_file.exists():
+                # compatta subito, così si riparte con journal vuoto
+                if self.save_users():
+                    for percorso in (self.journal_vecchio, self.journal_file):
+                        if percorso.exists():
+                            percorso.unlink()
+                else:
+                    self.record_nel_journal = riapplicati
+                print(f"Utenti salvati in: {self.users_file} ({riapplicati} dal journal)", file=sys.stderr)
                 
         except Exception as e:
             print(f"Errore nel caricamento degli utenti: {e}", file=sys.stderr)
             self.registered_users = {}
 
+    def riapplica_journal(self, percorso):
+        if not percorso.exists():
+            return 0
+        
+        riapplicati = 0
+        with open(percorso, 'r', encoding='utf-8') as f:
+            for riga in f:
+                try:
+                    record = json.loads(riga)
+                except ValueError:
+                    # riga troncata da un crash durante la scrittura
+                    print(f"Riga del journal ignorata in {percorso}", file=sys.stderr)
+                    continue
+                nickname = record.pop('nickname')
+                self.registered_users[nickname] = record
+                riapplicati += 1
+        return riapplicati
+
     def save_users(self):
+        with self.lock_salvataggio:
+            # la copia è fatta qui dentro, così un salvataggio più vecchio non sovrascrive uno più nuovo
+            with self.lock_utenti:
+                utenti = dict(self.registered_users)
+            return self.scrivi_file_utenti(utenti)
+
+    def scrivi_file_utenti(self, utenti):
+        inizio = time.perf_counter()
         try:
             # file temporaneo nella stessa directory del file finale
             temp_fd, temp_path = tempfile.mkstemp(dir=self.users_file.parent)
             try:
                 with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
-                    json.dump(self.registered_users, f, indent=4, ensure_ascii=False)
+                    # niente indent: con centinaia di migliaia di utenti conta l'encoder C di json
+                    json.dump(utenti, f, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
                 
-                # (windows) chiudi il file prima di rinominarlo
-                temp_path = Path(temp_path)
-                if self.users_file.exists():
-                    self.users_file.unlink()
-                temp_path.rename(self.users_file)
+                # os.replace è atomico anche su windows: non c'è mai un momento senza snapshot
+                os.replace(temp_path, self.users_file)
                 
+                metriche.durata_salvataggio.osserva(time.perf_counter() - inizio)
                 print(f"File utenti salvato con successo in: {self.users_file}", file=sys.stderr)
+                return True
                 
             except Exception as e:
                 # se errore, elimina il file temporaneo se esiste
@@ -98,58 +654,621 @@ class MessengerServer:
             try:
                 temp_path = Path(tempfile.gettempdir()) / 'messenger_users_emergency.json'
                 with open(temp_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.registered_users, f, indent=4, ensure_ascii=False)
+                    json.dump(utenti, f, ensure_ascii=False)
                 print(f"File utenti salvato nel percorso di emergenza: {temp_path}", file=sys.stderr)
             except Exception as e2:
                 print(f"Errore critico nel salvataggio degli utenti: {e2}", file=sys.stderr)
+            return False
+
+    def apri_journal(self):
+        self.journal = open(self.journal_file, 'a', encoding='utf-8')
+
+    def avvia_thread_journal(self):
+        def scrivi_journal():
+            while True:
+                with self.condizione_journal:
+                    self.condizione_journal.wait_for(lambda: self.journal_in_attesa)
+                    # tutto quello che si è accumulato durante l'fsync precedente va in un solo batch
+                    batch = self.journal_in_attesa
+                    self.journal_in_attesa = []
+                    ultimo = self.journal_accodati
+                
+                try:
+                    with self.lock_journal:
+                        for record in batch:
+                            self.journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+                        self.journal.flush()
+                        os.fsync(self.journal.fileno())
+                        self.record_nel_journal += len(batch)
+                        if self.record_nel_journal >= SOGLIA_COMPATTAMENTO_JOURNAL:
+                            self.richiesta_compattazione.set()
+                except Exception as e:
+                    print(f"Errore nella scrittura del journal utenti: {e}", file=sys.stderr)
+                
+                with self.condizione_journal:
+                    self.journal_scritti = ultimo
+                    self.condizione_journal.notify_all()
+        
+        def compatta_periodicamente():
+            while True:
+                self.richiesta_compattazione.wait(INTERVALLO_COMPATTAMENTO_JOURNAL)
+                self.richiesta_compattazione.clear()
+                self.compatta_journal()
+        
+        threading.Thread(target=scrivi_journal, daemon=True).start()
+        threading.Thread(target=compatta_periodicamente, daemon=True).start()
+
+    def compatta_journal(self):
+        with self.lock_salvataggio:
+            with self.lock_journal:
+                if self.record_nel_journal == 0:
+                    return
+                
+                # copia e rotazione insieme: tutto ciò che è nel journal ruotato è anche nella copia
+                with self.lock_utenti:
+                    utenti = dict(self.registered_users)
+                
+                self.journal.close()
+                if self.journal_vecchio.exists():
+                    # una compattazione precedente è fallita: il vecchio journal serve ancora
+                    with open(self.journal_vecchio, 'a', encoding='utf-8') as vecchio, \
+                         open(self.journal_file, 'r', encoding='utf-8') as corrente:
+                        vecchio.write(corrente.read())
+                    self.journal_file.unlink()
+                else:
+                    os.replace(self.journal_file, self.journal_vecchio)
+                self.apri_journal()
+                self.record_nel_journal = 0
+            
+            # la scrittura dello snapshot non blocca le nuove registrazioni
+            if self.scrivi_file_utenti(utenti):
+                self.journal_vecchio.unlink()
 
     def avvia_thread_pulizia(self):
         def pulisci_utenti_inattivi():
             while True:
-                time.sleep(60)
-                with self.lock:
-                    tempo_corrente = time.time()
-                    utenti_da_rimuovere = []
-                    
-                    for nickname, timestamp in self.ultimo_ping.items():
-                        if tempo_corrente - timestamp > 90:
-                            utenti_da_rimuovere.append(nickname)
-                    
-                    for nickname in utenti_da_rimuovere:
-                        self.rimuovi_utente(nickname)
+                time.sleep(PRECISIONE_PRESENZA)
+                inizio = time.perf_counter()
+                with self.lock_presenza:
+                    caselle = [self.stacca_utente(nickname)
+                               for nickname in self.scadenze.scadute(time.time())]
+                    caselle = [casella for casella in caselle if casella is not None]
+                
+                if caselle:
+                    for casella in caselle:
+                        self.chiudi_casella(casella)
+                    self.notifica_presenza()
+                metriche.durata_pulizia.osserva(time.perf_counter() - inizio)
         
         thread = threading.Thread(target=pulisci_utenti_inattivi, daemon=True)
         thread.start()
 
+    def aggiungi_utente(self, nickname, porta):
+        with self.lock_presenza:
+            # verifica che l'utente non sia online
+            if nickname in self.utenti:
+                return False
+            
+            self.utenti[nickname] = porta
+            # sotto lock_presenza: nessun messaggio può finire nel deposito tra il conteggio e la casella
+            self.messaggi[nickname] = Casella(nickname, self.file_casella(nickname),
+                                              self.deposito.quanti(nickname), self.deposito.ultimo(nickname),
+                                              self.quote_memoria[next(self.prossima_quota) % QUOTE_MEMORIA])
+            self.scadenze.aggiorna(nickname, time.time() + TIMEOUT_PRESENZA)
+            self.versione_presenza += 1
+            self.registro_presenza.append((self.versione_presenza, nickname, True))
+        
+        self.notifica_presenza()
+        return True
+
     def rimuovi_utente(self, nickname):
-        if nickname in self.utenti:
-            del self.utenti[nickname]
-        if nickname in self.ultimo_ping:
-            del self.ultimo_ping[nickname]
-        if nickname in self.messaggi:
-            del self.messaggi[nickname]
+        with self.lock_presenza:
+            casella = self.stacca_utente(nickname)
+        
+        if casella is not None:
+            self.chiudi_casella(casella)
+            self.notifica_presenza()
+
+    def stacca_utente(self, nickname):
+        # da chiamare con lock_presenza preso
+        if self.utenti.pop(nickname, None) is not None:
+            self.versione_presenza += 1
+            self.registro_presenza.append((self.versione_presenza, nickname, False))
+        self.scadenze.rimuovi(nickname)
+        casella = self.messaggi.pop(nickname, None)
+        
+        if casella is not None:
+            # quello che non è stato letto passa nel deposito, ancora sotto lock_presenza:
+            # un messaggio inviato da ora in poi va nel deposito dopo questi
+            # (anche quello già consegnato ma non confermato: al rientro il client riparte da capo)
+            with casella.lock:
+                casella.attiva = False
+                messaggi, liberati = casella.svuota()
+                self.libera_memoria(casella, liberati)
+                for _, messaggio in messaggi:
+                    self.deposito.accoda(nickname, messaggio, forza=True)
+        return casella
+
+    def file_casella(self, nickname):
+        # il nickname può contenere qualsiasi carattere, il nome del file no
+        return self.cartella_caselle / (hashlib.sha1(nickname.encode('utf-8')).hexdigest() + '.jsonl')
+
+    def chiudi_casella(self, casella):
+        with casella.lock:
+            casella.attiva = False
+            self.libera_memoria(casella, casella.byte)
+            casella.messaggi.clear()
+            casella.byte = 0
+            casella.rimuovi_file_disco()
+            # sveglia eventuali long-poll in attesa, risponderanno 401
+            casella.sveglia()
+
+    def notifica_presenza(self):
+        with self.lock_presenza:
+            caselle = list(self.stream_attivi.values())
+        
+        for casella in caselle:
+            with casella.lock:
+                casella.sveglia()
+
+    def apri_stream(self, nickname, dopo=None):
+        # None se l'utente non è online; con un cursore conferma prima tutto quello che il client ha già
+        with self.lock_presenza:
+            casella = self.messaggi.get(nickname)
+            if casella is not None:
+                self.stream_attivi[nickname] = casella
+        if casella is not None and dopo is not None:
+            self.conferma_messaggi(nickname, dopo)
+        return casella
+
+    def chiudi_stream(self, nickname, casella):
+        with self.lock_presenza:
+            if self.stream_attivi.get(nickname) is casella:
+                del self.stream_attivi[nickname]
+
+    def aggiorna_ping(self, nickname):
+        with self.lock_presenza:
+            if nickname not in self.utenti:
+                return False
+            self.scadenze.aggiorna(nickname, time.time() + TIMEOUT_PRESENZA)
+            return True
+
+    def conta_utenti_online(self):
+        return len(self.utenti)
+
+    def stato_presenza(self, versione_nota=None):
+        # conteggio e versione sempre; poi niente se il client è aggiornato,
+        # entrati/usciti se le sue variazioni mancanti sono nel registro, altrimenti la lista intera
+        with self.lock_presenza:
+            stato = {
+                'utenti_online': len(self.utenti),
+                'versione_presenza': self.versione_presenza
+            }
+            if versione_nota == self.versione_presenza:
+                return stato
+            
+            if (isinstance(versione_nota, int) and self.registro_presenza
+                    and self.registro_presenza[0][0] <= versione_nota + 1
+                    and versione_nota < self.versione_presenza):
+                # le versioni nel registro sono consecutive, si salta direttamente alla prima mancante
+                inizio = versione_nota + 1 - self.registro_presenza[0][0]
+                ultimo_evento = {}
+                for _, nickname, entrato in itertools.islice(self.registro_presenza, inizio, None):
+                    ultimo_evento[nickname] = entrato
+                stato['entrati'] = [n for n, entrato in ultimo_evento.items() if entrato]
+                stato['usciti'] = [n for n, entrato in ultimo_evento.items() if not entrato]
+            else:
+                stato['utenti'] = list(self.utenti.keys())
+            return stato
+
+    def riserva_memoria(self, casella, dimensione):
+        # prende solo il lock della quota della casella. una quota piena può andare oltre la sua parte
+        # finché c'è budget: le altre quote si sommano senza lock, può sforare di qualche messaggio in volo
+        quota = casella.quota
+        with quota.lock:
+            if (quota.byte + dimensione > BUDGET_MEMORIA_CASELLE // QUOTE_MEMORIA
+                    and self.byte_caselle() + dimensione > BUDGET_MEMORIA_CASELLE):
+                return False
+            quota.byte += dimensione
+            return True
+
+    def libera_memoria(self, casella, dimensione):
+        if dimensione:
+            with casella.quota.lock:
+                casella.quota.byte -= dimensione
+
+    def byte_caselle(self):
+        return sum(quota.byte for quota in self.quote_memoria)
+
+    def profondita_caselle(self):
+        # (totale, massimo) dei messaggi non letti in un solo giro, senza lock: serve solo a /metrics
+        totale = massimo = 0
+        for casella in list(self.messaggi.values()):
+            quanti = casella.profondita()
+            totale += quanti
+            if quanti > massimo:
+                massimo = quanti
+        return totale, massimo
+
+    def accoda_messaggio(self, destinatario, messaggio):
+        # 'ok', 'non_trovato' se il destinatario non è online, 'piena' se la casella non accetta altro
+        return self.accoda_messaggi([(destinatario, messaggio)])[0]
+
+    def accoda_messaggi(self, consegne):
+        # consegne: lista di (destinatario, messaggio), un esito per consegna nello stesso ordine:
+        # 'ok', 'differito' (utente registrato ma offline, va nel deposito), 'non_trovato' o 'piena'
+        # lo stesso Messaggio può andare a più destinatari: viene condiviso, non copiato
+        per_destinatario = {}
+        for indice, (destinatario, messaggio) in enumerate(consegne):
+            per_destinatario.setdefault(destinatario, []).append(indice)
+        
+        esiti = ['non_trovato'] * len(consegne)
+        nel_deposito = False
+        # un solo passaggio sulle caselle: ogni lock viene preso una volta sola
+        for destinatario, indici in per_destinatario.items():
+            casella = self.messaggi.get(destinatario)
+            while True:
+                if casella is None:
+                    casella = self.accoda_offline(destinatario, indici, consegne, esiti)
+                    if casella is None:
+                        break
+                
+                with casella.lock:
+                    if not casella.attiva:
+                        # appena uscito: i messaggi non letti sono già nel deposito, questi vanno dopo
+                        casella = None
+                        continue
+                    for indice in indici:
+                        messaggio = consegne[indice][1]
+                        esiti[indice] = self.inserisci_in_casella(casella, messaggio, messaggio.dimensione)
+                    nel_deposito |= casella.arretrati > 0
+                    casella.sveglia()
+                break
+        
+        # la risposta al mittente parte solo quando il deposito è su disco (group commit)
+        if nel_deposito or 'differito' in esiti:
+            self.deposito.attendi_scritture()
+        return esiti
+
+    def prenota_invii(self, chiavi):
+        # chiavi: (mittente, id, destinatario) o None per ogni consegna. restituisce indice -> esito per quelle
+        # già fatte ('in_corso' se la sta facendo un'altra richiesta); le altre restano prenotate fino a ricorda_invii
+        adesso = time.time()
+        duplicati = {}
+        with self.lock_invii:
+            for indice, chiave in enumerate(chiavi):
+                if chiave is None:
+                    continue
+                voce = self.invii_recenti.get(chiave)
+                if voce is not None and invio_valido(voce[0], voce[1], adesso):
+                    duplicati[indice] = voce[0]
+                else:
+                    self.invii_recenti[chiave] = ('in_corso', adesso)
+                    self.invii_recenti.move_to_end(chiave)
+        return duplicati
+
+    def ricorda_invii(self, esiti):
+        # esiti: (chiave, esito) delle consegne prenotate. una casella piena non ha consegnato niente:
+        # il client riproverà con lo stesso id
+        adesso = time.time()
+        with self.lock_invii:
+            for chiave, esito in esiti:
+                if esito == 'piena':
+                    self.invii_recenti.pop(chiave, None)
+                else:
+                    self.invii_recenti[chiave] = (esito, adesso)
+                    self.invii_recenti.move_to_end(chiave)
+            while self.invii_recenti:
+                istante = next(iter(self.invii_recenti.values()))[1]
+                if len(self.invii_recenti) <= MAX_INVII_RICORDATI and adesso - istante < RICORDA_INVII:
+                    break
+                self.invii_recenti.popitem(last=False)
+
+    def accoda_offline(self, destinatario, indici, consegne, esiti):
+        # deposita i messaggi per un utente registrato non online; se nel frattempo è rientrato
+        # restituisce la sua casella e non deposita niente
+        with self.lock_presenza:
+            casella = self.messaggi.get(destinatario)
+            if casella is not None:
+                return casella
+            if not self.utente_registrato(destinatario):
+                return None
+            
+            for indice in indici:
+                seq = self.deposito.accoda(destinatario, consegne[indice][1])
+                esiti[indice] = 'piena' if seq is None else 'differito'
+        return None
+
+    def inserisci_in_casella(self, casella, messaggio, dimensione):
+        # da chiamare con il lock della casella preso
+        if casella.arretrati:
+            seq = self.deposito.accoda(casella.nickname, messaggio)
+            if seq is None:
+                return 'piena'
+            casella.arretrati += 1
+            casella.ultimo_seq = seq
+        elif casella.su_disco:
+            # finché la casella non viene svuotata si continua su disco, così l'ordine resta giusto
+            casella.riversa_su_disco(messaggio)
+        elif not casella.piena(dimensione) and self.riserva_memoria(casella, dimensione):
+            casella.aggiungi(messaggio, dimensione)
+        elif POLITICA_CASELLA_PIENA == 'scarta_vecchi':
+            if not self.fai_spazio(casella, dimensione):
+                return 'piena'
+            casella.aggiungi(messaggio, dimensione)
+        elif POLITICA_CASELLA_PIENA == 'su_disco':
+            casella.riversa_su_disco(messaggio)
+        else:
+            return 'piena'
+        return 'ok'
 
-    def formatta_timestamp(self):
-        return datetime.now().strftime("%H:%M:%S")
+    def fai_spazio(self, casella, dimensione):
+        # scarta i messaggi più vecchi finché quello nuovo non rientra nei limiti
+        while casella.messaggi:
+            self.libera_memoria(casella, casella.scarta_piu_vecchio())
+            if not casella.piena(dimensione) and self.riserva_memoria(casella, dimensione):
+                return True
+        return False
+
+    def attendi_deposito(self, casella):
+        # prima di prendere il lock della casella: gli arretrati accodati fin qui diventano leggibili.
+        # uno accodato dopo si legge al giro successivo (la casella resta non vuota)
+        if casella.arretrati:
+            self.deposito.attendi_scritture()
+
+    def svuota_casella(self, casella):
+        # da chiamare con il lock della casella preso, dopo attendi_deposito
+        if casella.arretrati:
+            return self.preleva_arretrati(casella)
+        return self.svuota_memoria(casella)
+
+    def svuota_memoria(self, casella):
+        messaggi, liberati = casella.svuota()
+        self.libera_memoria(casella, liberati)
+        return [messaggio_numerato(seq, messaggio) for seq, messaggio in messaggi]
+
+    def preleva_arretrati(self, casella):
+        # una pagina alla volta: se ne restano, la casella resta "non vuota" e il prossimo poll torna subito
+        pagina = self.deposito.pagina(casella.nickname, PAGINA_ARRETRATI)
+        if pagina:
+            self.deposito.rimuovi_fino(casella.nickname, pagina[-1][0])
+        casella.arretrati = self.deposito.quanti(casella.nickname)
+        return [messaggio_numerato(seq, messaggio) for seq, messaggio in pagina]
+
+    def conferma_casella(self, casella, seq):
+        # da chiamare con il lock della casella preso: il client ha ricevuto tutto fino a seq compreso
+        if casella.arretrati:
+            self.deposito.rimuovi_fino(casella.nickname, seq)
+            casella.arretrati = self.deposito.quanti(casella.nickname)
+        self.libera_memoria(casella, casella.conferma(seq))
+
+    def pagina_casella(self, casella, limite):
+        # da chiamare con il lock della casella preso: (messaggi non confermati, se ne restano altri)
+        if casella.arretrati:
+            pagina = self.deposito.pagina(casella.nickname, limite)
+            altri = casella.arretrati > len(pagina)
+        else:
+            pagina = casella.pagina(limite)
+            altri = casella.profondita() > len(pagina)
+        return [messaggio_numerato(seq, messaggio) for seq, messaggio in pagina], altri
+
+    def pagina_stream(self, casella, dopo):
+        # da chiamare con il lock della casella preso, dopo attendi_deposito: (messaggi oltre il cursore dello
+        # stream, nuovo cursore). restano nella casella finché il client non li conferma
+        if casella.arretrati:
+            pagina = self.deposito.pagina(casella.nickname, MAX_PAGINA_MESSAGGI, dopo)
+        else:
+            pagina = casella.pagina(MAX_PAGINA_MESSAGGI, dopo)
+        if not pagina:
+            return [], dopo
+        return [messaggio_numerato(seq, messaggio) for seq, messaggio in pagina], pagina[-1][0]
+
+    def conta_arretrati(self, nickname):
+        return self.deposito.quanti(nickname)
+
+    def casella_di(self, nickname):
+        # None se l'utente non è online
+        return self.messaggi.get(nickname)
+
+    def preleva_messaggi(self, nickname, attesa=0):
+        # lettura distruttiva: la casella si svuota subito. None se l'utente non è online
+        casella = self.casella_di(nickname)
+        if casella is None:
+            return None
+        
+        self.attendi_deposito(casella)
+        with casella.lock:
+            if not self.attendi_casella(casella, attesa):
+                return None
+            return self.svuota_casella(casella)
+
+    def leggi_messaggi(self, nickname, dopo, limite, attesa=0):
+        # lettura con cursore: conferma fino a dopo e restituisce (pagina dei successivi, se ne restano altri);
+        # i messaggi restano nella casella finché un poll successivo non li conferma. None se l'utente non è online
+        casella = self.casella_di(nickname)
+        if casella is None:
+            return None
+        
+        self.attendi_deposito(casella)
+        with casella.lock:
+            self.conferma_casella(casella, dopo)
+            if not self.attendi_casella(casella, attesa):
+                return None
+            return self.pagina_casella(casella, limite)
+
+    def conferma_messaggi(self, nickname, seq):
+        # la conferma da sola, per il motore asyncio che la fa prima di mettersi in attesa
+        casella = self.casella_di(nickname)
+        if casella is not None:
+            with casella.lock:
+                self.conferma_casella(casella, seq)
+
+    def attendi_casella(self, casella, attesa):
+        # da chiamare con il lock della casella preso; False se nel frattempo l'utente è uscito
+        if attesa > 0 and not casella.profondita():
+            casella.condizione.wait_for(
+                lambda: casella.profondita() or not casella.attiva,
+                timeout=attesa
+            )
+        return casella.attiva
+
+    def statistiche_caselle(self):
+        # profondità e byte di ogni casella, letti senza lock: servono solo per il monitoraggio
+        caselle = {
+            nickname: {
+                'messaggi': casella.profondita(),
+                'byte': casella.byte,
+                'su_disco': casella.su_disco,
+                'arretrati': casella.arretrati
+            }
+            for nickname, casella in list(self.messaggi.items())
+        }
+        return {
+            'byte_totali': self.byte_caselle(),
+            'budget_byte': BUDGET_MEMORIA_CASELLE,
+            'caselle': caselle,
+            'deposito': self.deposito.statistiche()
+        }
 
     def register_new_user(self, nickname, password_hash):
-        with self.lock:
+        with self.lock_utenti:
             if nickname in self.registered_users:
                 return False
-            self.registered_users[nickname] = {
+            record = {
                 'password': password_hash,
                 'created_at': datetime.utcnow().isoformat()
             }
-            self.save_users()
-            return True
+            self.registered_users[nickname] = record
+        
+        # la scrittura su disco avviene fuori da lock_utenti: si aspetta solo il group commit
+        with self.condizione_journal:
+            self.journal_in_attesa.append({'nickname': nickname, **record})
+            self.journal_accodati += 1
+            numero = self.journal_accodati
+            self.condizione_journal.notify_all()
+            self.condizione_journal.wait_for(lambda: self.journal_scritti >= numero)
+        return True
 
     def verify_credentials(self, nickname, password_hash):
-        with self.lock:
+        with self.lock_utenti:
             if nickname not in self.registered_users:
                 return False
             return self.registered_users[nickname]['password'] == password_hash
 
-server = MessengerServer()
+    def utente_registrato(self, nickname):
+        with self.lock_utenti:
+            return nickname in self.registered_users
+
+def invio_valido(esito, istante, adesso):
+    # un esito ricordato vale RICORDA_INVII, una prenotazione SCADENZA_PRENOTAZIONE_INVIO
+    if esito == 'in_corso':
+        return adesso - istante < SCADENZA_PRENOTAZIONE_INVIO
+    return adesso - istante < RICORDA_INVII
+
+def crea_server():
+    # le route usano solo questi metodi, che ogni archivio deve avere:
+    # register_new_user, verify_credentials, utente_registrato,
+    # aggiungi_utente, rimuovi_utente, aggiorna_ping, conta_utenti_online, stato_presenza,
+    # accoda_messaggio, accoda_messaggi, prenota_invii, ricorda_invii,
+    # preleva_messaggi, leggi_messaggi, conferma_messaggi, attendi_deposito, svuota_casella, pagina_stream,
+    # conta_arretrati, statistiche_caselle, profondita_caselle,
+    # casella_di, apri_stream, chiudi_stream e l'attributo versione_presenza
+    if ARCHIVIO == 'sqlite':
+        import archivio_sqlite
+        return archivio_sqlite.MessengerServerSQLite(sys.modules[__name__])
+    return MessengerServer()
+
+server = crea_server()
+
+def carica_chiave_token(percorso):
+    # la chiave che firma i token: creata una volta sola e condivisa da tutti i processi con la stessa cartella dati
+    if percorso.exists():
+        return percorso.read_bytes()
+    temporaneo = percorso.with_name(f"{percorso.name}.{os.getpid()}")
+    temporaneo.write_bytes(os.urandom(32))
+    os.chmod(temporaneo, 0o600)
+    try:
+        # link fallisce se un altro processo l'ha già creata: vale la sua
+        os.link(temporaneo, percorso)
+    except FileExistsError:
+        pass
+    finally:
+        temporaneo.unlink()
+    return percorso.read_bytes()
+
+CHIAVE_TOKEN = carica_chiave_token(MessengerServer.get_data_file_path(server).parent / 'chiave_token')
+
+def prepara_hmac(chiave):
+    # HMAC-SHA256 (RFC 2104) con i due sha256 già avviati sulla chiave con ipad e opad:
+    # ogni firma costa due copie invece di ripartire da zero come hmac.digest
+    chiave = chiave.ljust(64, b'\0')
+    return (hashlib.sha256(bytes(b ^ 0x36 for b in chiave)),
+            hashlib.sha256(bytes(b ^ 0x5c for b in chiave)))
+
+HMAC_INTERNO, HMAC_ESTERNO = prepara_hmac(CHIAVE_TOKEN)
+
+def firma_token(corpo):
+    interno = HMAC_INTERNO.copy()
+    interno.update(corpo)
+    esterno = HMAC_ESTERNO.copy()
+    esterno.update(interno.digest())
+    return esterno.hexdigest().encode('ascii')
+
+def crea_token(nickname):
+    # <nickname in base64>.<scadenza>.<hmac>: si verifica senza lock e senza cercare niente
+    scadenza = int(time.time()) + DURATA_TOKEN
+    corpo = binascii.b2a_base64(nickname.encode('utf-8'), newline=False) + b'.%d' % scadenza
+    return (corpo + b'.' + firma_token(corpo)).decode('ascii'), scadenza
+
+def verifica_token(token):
+    # il nickname del token se la firma torna e non è scaduto, altrimenti None
+    corpo, _, firma = token.encode('latin-1').rpartition(b'.')
+    if not hmac.compare_digest(firma, firma_token(corpo)):
+        return None
+    nickname, _, scadenza = corpo.partition(b'.')
+    if int(scadenza) < time.time():
+        return None
+    return binascii.a2b_base64(nickname).decode('utf-8')
+
+def controlla_token(autorizzazione, nickname):
+    # None se l'header Authorization porta un token valido di nickname, altrimenti (stato HTTP, messaggio)
+    # lo usa anche il motore asyncio prima delle sue attese
+    if not autorizzazione.startswith('Bearer '):
+        return 401, 'Token di sessione mancante'
+    proprietario = verifica_token(autorizzazione[len('Bearer '):])
+    if proprietario is None:
+        return 401, 'Token di sessione non valido o scaduto'
+    if proprietario != nickname:
+        return 403, 'Token di sessione di un altro utente'
+    return None
+
+def errore_token(nickname):
+    # None se la richiesta è di nickname, altrimenti la risposta di errore da restituire
+    errore = controlla_token(request.headers.get('Authorization', ''), nickname)
+    if errore is None:
+        return None
+    stato, messaggio = errore
+    return jsonify({'messaggio': messaggio}), stato
+
+def testo_codificabile(valore):
+    # JSON ammette i surrogati isolati ("\ud800"), che non diventano UTF-8: niente messaggio, nome di file o token
+    if isinstance(valore, str):
+        try:
+            valore.encode('utf-8')
+        except UnicodeEncodeError:
+            return False
+        return True
+    if isinstance(valore, dict):
+        return all(testo_codificabile(chiave) and testo_codificabile(v) for chiave, v in valore.items())
+    if isinstance(valore, list):
+        return all(testo_codificabile(v) for v in valore)
+    return True
+
+@app.before_request
+def controlla_testo():
+    # una volta sola all'ingresso: le route e l'archivio possono codificare qualsiasi stringa ricevuta
+    if request.is_json and not testo_codificabile(request.get_json(silent=True)):
+        return jsonify({'messaggio': 'Testo non valido'}), 400
 
 @app.route('/registra_utente', methods=['POST'])
 def registra_nuovo_utente():
@@ -175,10 +1294,23 @@ def login():
         return jsonify({'messaggio': 'Nickname e password richiesti'}), 400
     
     if server.verify_credentials(nickname, password):
-        return jsonify({'messaggio': 'Login effettuato con successo'})
+        # le altre route chiedono questo token nell'header Authorization: Bearer <token>
+        token, scadenza = crea_token(nickname)
+        return jsonify({'messaggio': 'Login effettuato con successo', 'token': token, 'scadenza': scadenza})
     else:
         return jsonify({'messaggio': 'Credenziali non valide'}), 401
 
+@app.route('/rinnova_token', methods=['POST'])
+def rinnova_token():
+    # un token ancora valido ne ottiene uno nuovo, così una sessione lunga non deve rifare il login
+    autorizzazione = request.headers.get('Authorization', '')
+    nickname = verifica_token(autorizzazione[len('Bearer '):]) if autorizzazione.startswith('Bearer ') else None
+    if nickname is None:
+        return jsonify({'messaggio': 'Token di sessione non valido o scaduto'}), 401
+    
+    token, scadenza = crea_token(nickname)
+    return jsonify({'token': token, 'scadenza': scadenza})
+
 @app.route('/registra', methods=['POST'])
 def registra_utente():
     dati = request.json
@@ -188,32 +1320,32 @@ def registra_utente():
     if not nickname or not porta:
         return jsonify({'messaggio': 'Nickname e porta richiesti'}), 400
     
-    with server.lock:
-        # verifica che l'utente sia registrato
-        if nickname not in server.registered_users:
-            return jsonify({'messaggio': 'Utente non registrato'}), 401
-        
-        # verifica che l'utente non sia online
-        if nickname in server.utenti:
-            return jsonify({'messaggio': 'Utente già connesso'}), 409
-        
-        server.utenti[nickname] = porta
-        server.messaggi[nickname] = []
-        server.ultimo_ping[nickname] = time.time()
-        
-        return jsonify({
-            'messaggio': 'Registrazione completata',
-            'utenti_online': len(server.utenti)
-        })
+    # il token c'è solo per gli utenti registrati
+    errore = errore_token(nickname)
+    if errore:
+        return errore
+    
+    if not server.aggiungi_utente(nickname, porta):
+        return jsonify({'messaggio': 'Utente già connesso'}), 409
+    
+    # gli arretrati arrivano a pagine con i normali /messaggi, /sync o /stream
+    return jsonify({
+        'messaggio': 'Registrazione completata',
+        'utenti_online': server.conta_utenti_online(),
+        'arretrati': server.conta_arretrati(nickname)
+    })
 
 @app.route('/disconnetti', methods=['POST'])
 def disconnetti_utente():
     dati = request.json
     nickname = dati.get('nickname', '').strip()
     
-    with server.lock:
-        server.rimuovi_utente(nickname)
-        return jsonify({'messaggio': 'Disconnesso'})
+    errore = errore_token(nickname)
+    if errore:
+        return errore
+    
+    server.rimuovi_utente(nickname)
+    return jsonify({'messaggio': 'Disconnesso'})
 
 @app.route('/ping', methods=['POST'])
 def ping():
@@ -223,56 +1355,433 @@ def ping():
     if not nickname:
         return jsonify({'messaggio': 'Nickname richiesto'}), 400
     
-    with server.lock:
-        if nickname not in server.utenti:
-            return jsonify({'messaggio': 'Utente non trovato'}), 404
-        
-        server.ultimo_ping[nickname] = time.time()
-        return jsonify({
-            'messaggio': 'Pong',
-            'utenti_online': len(server.utenti)
-        })
+    errore = errore_token(nickname)
+    if errore:
+        return errore
+    
+    if not server.aggiorna_ping(nickname):
+        return jsonify({'messaggio': 'Utente non trovato'}), 404
+    
+    # "after": conferma dei messaggi arrivati con lo stream, che senza richieste di lettura non ne ha altre
+    dopo = converti_cursore(dati.get('after'))
+    if dopo is not None:
+        server.conferma_messaggi(nickname, dopo)
+    
+    return jsonify({
+        'messaggio': 'Pong',
+        'utenti_online': server.conta_utenti_online()
+    })
 
 @app.route('/invia_messaggio', methods=['POST'])
 def invia_messaggio():
     dati = request.json
     mittente = dati.get('mittente', '').strip()
     destinatario = dati.get('destinatario', '').strip()
-    messaggio = dati.get('messaggio', '').strip()
+    messaggio = dati.get('messaggio', '')
+    # il corpo è solo testo: un numero o un oggetto sono dati incompleti, non un errore del server
+    messaggio = messaggio.strip() if isinstance(messaggio, str) else ''
     
     if not mittente or not destinatario or not messaggio:
         return jsonify({'messaggio': 'Dati incompleti'}), 400
     
-    with server.lock:
-        if destinatario not in server.utenti:
-            return jsonify({'messaggio': 'Destinatario non trovato'}), 404
+    errore = errore_token(mittente)
+    if errore:
+        return errore
+    
+    nuovo_messaggio = Messaggio(mittente, messaggio, time.time())
+    
+    esito = server.accoda_messaggio(destinatario, nuovo_messaggio)
+    if esito in ('ok', 'differito'):
+        metriche.messaggi_accodati.incrementa()
+    if esito == 'non_trovato':
+        return jsonify({'messaggio': 'Destinatario non trovato'}), 404
+    elif esito == 'piena':
+        return risposta_casella_piena()
+    elif esito == 'differito':
+        return jsonify({'messaggio': 'Destinatario offline, messaggio consegnato al prossimo accesso', 'esito': esito})
+    
+    return jsonify({'messaggio': 'Messaggio inviato', 'esito': esito})
+
+@app.route('/invia_messaggi', methods=['POST'])
+def invia_messaggi():
+    # batch: {'mittente': ..., 'messaggi': [{'destinatari': [...] oppure 'destinatario': ..., 'messaggio': ...,
+    #                                       'id': ...}]}
+    # con l'id (facoltativo, scelto dal client) un messaggio rispedito non arriva due volte: le consegne già fatte
+    # restituiscono l'esito di allora, 'in_corso' se un'altra richiesta le sta ancora facendo
+    dati = request.json
+    mittente = dati.get('mittente', '').strip()
+    elementi = dati.get('messaggi')
+    
+    if not mittente or not isinstance(elementi, list):
+        return jsonify({'messaggio': 'Dati incompleti'}), 400
+    # come /invia_messaggio: un corpo che non è testo rifiuta tutta la richiesta, non si converte
+    if any(isinstance(elemento, dict) and not isinstance(elemento.get('messaggio', ''), str)
+           for elemento in elementi):
+        return jsonify({'messaggio': 'Dati incompleti'}), 400
+    
+    errore = errore_token(mittente)
+    if errore:
+        return errore
+    
+    adesso = time.time()
+    consegne = []
+    chiavi = []
+    esiti_per_consegna = []
+    risultati = []
+    for elemento in elementi:
+        if not isinstance(elemento, dict):
+            elemento = {}
+        messaggio = elemento.get('messaggio', '').strip()
+        destinatari = elemento.get('destinatari') or [elemento.get('destinatario', '')]
+        if isinstance(destinatari, str):
+            destinatari = [destinatari]
+        elif not isinstance(destinatari, list):
+            # un numero, un oggetto...: l'elemento conta come dati incompleti, non fa fallire la richiesta
+            destinatari = []
+        # senza duplicati, nell'ordine dato
+        destinatari = list(dict.fromkeys(str(d).strip() for d in destinatari if str(d).strip()))
         
-        nuovo_messaggio = {
-            'mittente': mittente,
-            'messaggio': messaggio,
-            'timestamp_str': server.formatta_timestamp()
-        }
+        id_messaggio = elemento.get('id')
+        
+        if not messaggio or not destinatari or (id_messaggio is not None and not (
+                isinstance(id_messaggio, str) and 0 < len(id_messaggio) <= MAX_LUNGHEZZA_ID)):
+            risultati.append({'esito': 'dati_incompleti'})
+            continue
         
-        server.messaggi[destinatario].append(nuovo_messaggio)
-        return jsonify({'messaggio': 'Messaggio inviato'})
+        # il corpo del messaggio è uno solo per tutti i destinatari
+        nuovo_messaggio = Messaggio(mittente, messaggio, adesso)
+        esiti = {}
+        risultati.append({'esiti': esiti})
+        for destinatario in destinatari:
+            consegne.append((destinatario, nuovo_messaggio))
+            chiavi.append(None if id_messaggio is None else (mittente, id_messaggio, destinatario))
+            esiti_per_consegna.append(esiti)
+    
+    if len(consegne) > MAX_CONSEGNE_BATCH:
+        return jsonify({'messaggio': f'Massimo {MAX_CONSEGNE_BATCH} consegne per richiesta'}), 400
+    
+    duplicati = {}
+    if any(chiavi):
+        duplicati = server.prenota_invii(chiavi)
+        metriche.invii_duplicati.incrementa(len(duplicati))
+    nuove = [indice for indice in range(len(consegne)) if indice not in duplicati]
+    esiti_nuove = server.accoda_messaggi([consegne[indice] for indice in nuove])
+    metriche.messaggi_accodati.incrementa(esiti_nuove.count('ok') + esiti_nuove.count('differito'))
+    if any(chiavi):
+        server.ricorda_invii([(chiavi[indice], esito) for indice, esito in zip(nuove, esiti_nuove)
+                              if chiavi[indice] is not None])
+    
+    esiti_consegne = [None] * len(consegne)
+    for indice, esito in duplicati.items():
+        esiti_consegne[indice] = esito
+    for indice, esito in zip(nuove, esiti_nuove):
+        esiti_consegne[indice] = esito
+    for esiti, (destinatario, _), esito in zip(esiti_per_consegna, consegne, esiti_consegne):
+        esiti[destinatario] = esito
+    
+    risposta = {'risultati': risultati}
+    if 'piena' in esiti_consegne:
+        risposta['riprova_tra'] = RIPROVA_CASELLA_PIENA
+    return jsonify(risposta)
+
+def risposta_casella_piena():
+    return jsonify({
+        'messaggio': 'Casella del destinatario piena',
+        'riprova_tra': RIPROVA_CASELLA_PIENA
+    }), 429, {'Retry-After': str(RIPROVA_CASELLA_PIENA)}
+
+def leggi_attesa(valore):
+    # il motore asyncio fa già l'attesa per conto suo prima di passare la richiesta a Flask
+    if request.environ.get('messenger.attesa_gestita'):
+        return 0
+    return converti_attesa(valore)
+
+def converti_attesa(valore):
+    try:
+        attesa = float(valore or 0)
+    except (TypeError, ValueError):
+        attesa = 0
+    return min(max(attesa, 0), MAX_ATTESA_POLL)
+
+def converti_cursore(valore):
+    # None se il client non usa il cursore
+    try:
+        return max(int(valore), 0) if valore is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def converti_limite(valore):
+    try:
+        limite = int(valore) if valore is not None else PAGINA_MESSAGGI
+    except (TypeError, ValueError):
+        limite = PAGINA_MESSAGGI
+    return min(max(limite, 1), MAX_PAGINA_MESSAGGI)
+
+def preleva_per_client(nickname, attesa, dopo, limite):
+    # {'messaggi': [JSON dei messaggi, in byte]} per /messaggi e /sync, None se l'utente non è online.
+    # senza cursore la casella si svuota come sempre; con il cursore si aggiunge 'altri'
+    cursore = converti_cursore(dopo)
+    if cursore is None:
+        messaggi = server.preleva_messaggi(nickname, attesa)
+        risposta = None if messaggi is None else {'messaggi': messaggi}
+    else:
+        risultato = server.leggi_messaggi(nickname, cursore, converti_limite(limite), attesa)
+        risposta = None if risultato is None else {'messaggi': risultato[0], 'altri': risultato[1]}
+    
+    if risposta is not None and risposta['messaggi']:
+        metriche.messaggi_consegnati.incrementa(len(risposta['messaggi']))
+    return risposta
 
 @app.route('/messaggi/<nickname>', methods=['GET'])
 def recupera_messaggi(nickname):
-    with server.lock:
-        if nickname not in server.utenti:
-            return jsonify({'messaggio': 'Utente non autorizzato'}), 401
-        
-        messaggi = server.messaggi[nickname]
-        server.messaggi[nickname] = []
-        
-        return jsonify({'messaggi': messaggi})
+    # ?wait=<secondi> -> long-poll: resta in attesa finché arriva un messaggio o scade il timeout
+    # ?after=<seq>&limit=<n> -> conferma i messaggi fino a seq e restituisce al massimo n dei successivi
+    # senza toglierli: se la risposta va persa, il prossimo poll con lo stesso after li riceve di nuovo
+    errore = errore_token(nickname)
+    if errore:
+        return errore
+    
+    attesa = leggi_attesa(request.args.get('wait'))
+    
+    risposta = preleva_per_client(nickname, attesa, request.args.get('after'), request.args.get('limit'))
+    if risposta is None:
+        return jsonify({'messaggio': 'Utente non autorizzato'}), 401
+    
+    messaggi = risposta.pop('messaggi')
+    return risposta_con_messaggi(risposta, messaggi)
+
+@app.route('/sync', methods=['POST'])
+def sincronizza():
+    # un solo giro: rinnova il ping, legge la casella (anche in long-poll, anche con after/limit) e riporta la presenza
+    dati = request.json
+    nickname = dati.get('nickname', '').strip()
+    attesa = leggi_attesa(dati.get('wait'))
+    
+    if not nickname:
+        return jsonify({'messaggio': 'Nickname richiesto'}), 400
+    
+    errore = errore_token(nickname)
+    if errore:
+        return errore
+    
+    if not server.aggiorna_ping(nickname):
+        return jsonify({'messaggio': 'Utente non autorizzato'}), 401
+    
+    messaggi = preleva_per_client(nickname, attesa, dati.get('after'), dati.get('limit'))
+    if messaggi is None:
+        return jsonify({'messaggio': 'Utente non autorizzato'}), 401
+    
+    risposta = server.stato_presenza(dati.get('versione_presenza'))
+    risposta.update(messaggi)
+    return risposta_con_messaggi(risposta, risposta.pop('messaggi'))
+
+def risposta_con_messaggi(dati, messaggi):
+    # l'oggetto JSON dati con in più 'messaggi': i messaggi sono già in JSON e si concatenano così come sono
+    testa = b'{"messaggi":['
+    coda = b']' + (b',' + json.dumps(dati, ensure_ascii=False).encode('utf-8')[1:] if dati else b'}')
+    if len(messaggi) <= SOGLIA_RISPOSTA_A_BLOCCHI:
+        return Response(testa + b','.join(messaggi) + coda, mimetype='application/json')
+    
+    def blocchi():
+        yield testa
+        for inizio in range(0, len(messaggi), SOGLIA_RISPOSTA_A_BLOCCHI):
+            yield (b',' if inizio else b'') + b','.join(messaggi[inizio:inizio + SOGLIA_RISPOSTA_A_BLOCCHI])
+        yield coda
+    return Response(blocchi(), mimetype='application/json')
+
+def formatta_evento(evento, dati):
+    return b"event: %s\ndata: %s\n\n" % (evento.encode('ascii'), json.dumps(dati, ensure_ascii=False).encode('utf-8'))
+
+def cursore_stream(ultimo_evento, dopo):
+    # Last-Event-ID (lo rimanda il client che si ricollega) o ?after=; None: stream distruttivo come prima
+    cursore = converti_cursore(ultimo_evento or None)
+    return cursore if cursore is not None else converti_cursore(dopo)
+
+def stream_pronto(casella, versione_nota, cursore=None):
+    if cursore is None:
+        pronta = casella.profondita()
+    else:
+        pronta = casella.ha_dopo(cursore)
+    return pronta or not casella.attiva or server.versione_presenza != versione_nota
+
+def eventi_stream(nickname, casella, versione_nota, cursore=None):
+    # un giro dello stream senza attese sul lock: (byte da inviare, nuova versione nota, nuovo cursore),
+    # None a casella chiusa. con il cursore i messaggi restano nella casella finché il client non li conferma
+    server.attendi_deposito(casella)
+    with casella.lock:
+        if not casella.attiva:
+            return None, versione_nota, cursore
+        if cursore is None:
+            messaggi = server.svuota_casella(casella)
+        else:
+            messaggi, cursore = server.pagina_stream(casella, cursore)
+    
+    # lo stream aperto vale come ping
+    server.aggiorna_ping(nickname)
+    
+    eventi = []
+    if messaggi:
+        metriche.messaggi_consegnati.incrementa(len(messaggi))
+        # l'id è il seq dell'ultimo messaggio: il client lo rimanda come Last-Event-ID quando si ricollega
+        identificativo = b'id: %d\n' % cursore if cursore is not None else b''
+        eventi.append(identificativo + b'event: messaggi\ndata: {"messaggi":[' + b','.join(messaggi) + b']}\n\n')
+    if server.versione_presenza != versione_nota:
+        presenza = server.stato_presenza(versione_nota)
+        versione_nota = presenza['versione_presenza']
+        eventi.append(formatta_evento('utenti_online', presenza))
+    if not eventi:
+        eventi.append(formatta_evento('keepalive', {}))
+    return b''.join(eventi), versione_nota, cursore
+
+@app.route('/stream/<nickname>', methods=['GET'])
+def stream_eventi(nickname):
+    # una sola risposta aperta per client: messaggi, utenti online e keepalive arrivano come eventi SSE.
+    # con Last-Event-ID o ?after=<seq> i messaggi restano nella casella finché il client non li conferma
+    # (riaprendo lo stream o con /ping e "after"): uno stream caduto a metà non ne perde nessuno
+    errore = errore_token(nickname)
+    if errore:
+        return errore
+    
+    cursore = cursore_stream(request.headers.get('Last-Event-ID'), request.args.get('after'))
+    casella = server.apri_stream(nickname, cursore)
+    if casella is None:
+        return jsonify({'messaggio': 'Utente non autorizzato'}), 401
+    
+    def genera():
+        versione_nota = None
+        cursore_inviato = cursore
+        try:
+            while True:
+                with casella.lock:
+                    casella.condizione.wait_for(
+                        lambda: stream_pronto(casella, versione_nota, cursore_inviato),
+                        timeout=INTERVALLO_KEEPALIVE_STREAM
+                    )
+                
+                testo, versione_nota, cursore_inviato = eventi_stream(nickname, casella, versione_nota,
+                                                                      cursore_inviato)
+                if testo is None:
+                    break
+                yield testo
+            
+            yield formatta_evento('disconnesso', {})
+        finally:
+            server.chiudi_stream(nickname, casella)
+    
+    return Response(genera(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def richiesta_locale():
+    # solo dalla macchina del server e non attraverso un proxy, che farebbe sembrare locale qualsiasi client
+    return request.remote_addr in INDIRIZZI_LOCALI and 'X-Forwarded-For' not in request.headers
+
+@app.route('/statistiche_caselle', methods=['GET'])
+def statistiche_caselle():
+    # elenca tutti i nickname con la loro casella: niente accesso dall'esterno
+    if not richiesta_locale():
+        return jsonify({'messaggio': 'Consentito solo dalla macchina del server'}), 403
+    return jsonify(server.statistiche_caselle())
 
 @app.route('/utenti_online', methods=['GET'])
 def lista_utenti():
-    with server.lock:
-        return jsonify({'utenti': list(server.utenti.keys())})
+    # ?since=<versione> -> solo entrati/usciti da quella versione, se ancora nel registro
+    return jsonify(server.stato_presenza(request.args.get('since', type=int)))
+
+@app.route('/metrics', methods=['GET'])
+def metriche_prometheus():
+    return Response(metriche.testo(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/profilo_lock', methods=['GET'])
+def profilo_dei_lock():
+    # con MESSENGER_PROFILO_LOCK=1: attese e possesso per lock e punto di chiamata. solo lettura
+    return jsonify(profilo_lock.rapporto())
+
+@app.route('/profilo_lock/azzera', methods=['POST'])
+def azzera_profilo_lock():
+    # restituisce il rapporto fino a qui e riparte da zero
+    if not richiesta_locale():
+        return jsonify({'messaggio': 'Consentito solo dalla macchina del server'}), 403
+    rapporto = profilo_lock.rapporto()
+    profilo_lock.azzera()
+    return jsonify(rapporto)
+
+# i due indicatori sulle caselle escono nello stesso /metrics: un solo giro delle caselle per entrambi
+DURATA_PROFONDITA = 1.0
+ultima_profondita = (0.0, (0, 0))
+
+def profondita_caselle():
+    global ultima_profondita
+    istante, valori = ultima_profondita
+    adesso = time.monotonic()
+    if adesso - istante >= DURATA_PROFONDITA:
+        valori = server.profondita_caselle()
+        ultima_profondita = (adesso, valori)
+    return valori
+
+metriche.Indicatore('messenger_utenti_online', "Utenti online", server.conta_utenti_online)
+metriche.Indicatore('messenger_messaggi_in_casella', "Messaggi non ancora letti in tutte le caselle",
+                    lambda: profondita_caselle()[0])
+metriche.Indicatore('messenger_messaggi_in_casella_max', "Messaggi nella casella più piena",
+                    lambda: profondita_caselle()[1])
+
+def misura_richieste(applicazione):
+    # middleware WSGI: codice e durata di ogni richiesta, per route (la prima parte del percorso, se è una route).
+    # con il motore asyncio la durata parte da quando la richiesta è arrivata, attesa del long-poll compresa
+    route_note = {regola.rule.split('/')[1] for regola in app.url_map.iter_rules()}
+    
+    def misura(environ, start_response):
+        inizio = environ.get('messenger.inizio') or time.perf_counter()
+        codice = ['000']
+        
+        def start(stato, header, exc_info=None):
+            codice[0] = stato[:3]
+            return start_response(stato, header, exc_info)
+        
+        try:
+            return applicazione(environ, start)
+        finally:
+            route = environ.get('PATH_INFO', '/').split('/', 2)[1]
+            if route not in route_note:
+                route = 'altro'
+            metriche.richieste.incrementa(1, route, codice[0])
+            metriche.durata_richieste.osserva(time.perf_counter() - inizio, route)
+    return misura
+
+app.wsgi_app = misura_richieste(app.wsgi_app)
 
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=5001, debug=False, threaded=True)
+    parser = argparse.ArgumentParser(description="Server Messenger")
+    parser.add_argument('--motore', choices=['flask', 'asyncio'], default='flask',
+                        help="flask: un thread per richiesta; asyncio: un solo event loop, adatto a molte connessioni aperte")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=5001)
+    parser.add_argument('--processi', type=int, default=1,
+                        help="processi server sulla stessa porta (richiede MESSENGER_ARCHIVIO=sqlite e --motore asyncio)")
+    args = parser.parse_args()
+    
+    if args.processi > 1 and (ARCHIVIO != 'sqlite' or args.motore != 'asyncio'):
+        parser.error("--processi richiede MESSENGER_ARCHIVIO=sqlite e --motore asyncio")
+    
+    if profilo_lock.ATTIVO and hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 <pid> scrive il profilo dei lock su stderr
+        signal.signal(signal.SIGUSR1, profilo_lock.stampa_rapporto)
+    
+    if args.motore == 'asyncio':
+        import server_async
+        # gli altri processi sono copie di questo, con lo stesso ambiente
+        figli = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), '--motore', 'asyncio',
+                              '--host', args.host, '--porta', str(args.porta)])
+            for _ in range(args.processi - 1)
+        ]
+        try:
+            server_async.avvia(sys.modules[__name__], args.host, args.porta, riusa_porta=ARCHIVIO == 'sqlite')
+        finally:
+            for figlio in figli:
+                figlio.terminate()
+    else:
+        app.run(host=args.host, port=args.porta, debug=False, threaded=True)
 
 # Lo so che gli appunti li metteva meglio mio nonno però attualmente non ho molto tempo, prometto che nel prossimo rilascio metto i commenti meglio :)
@@ -0,0 +1,327 @@
+import asyncio
+import io
+import json
+import socket
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, parse_qs
+
+# motore asyncio: un solo event loop tiene tutte le connessioni, anche quelle ferme in long-poll o stream.
+# le attese (long-poll, /sync, stream SSE) si fanno qui senza occupare thread;
+# tutto il resto passa alle route Flask su un piccolo pool di thread, così la logica resta una sola.
+# sul loop non si chiama niente che prenda il lock di una casella o tocchi il database: anche i giri
+# dello stream e la preparazione delle attese passano dal pool.
+
+# limiti di una richiesta
+MAX_HEADER = 100
+MAX_CORPO = 1024 * 1024
+# una connessione keep-alive senza richieste viene chiusa dopo tanti secondi
+TIMEOUT_INATTIVITA = 300
+# thread per le route Flask, che fanno solo lavoro breve (al massimo un fsync del journal)
+THREAD_LAVORO = 32
+# per le risposte che il motore scrive da sé, senza passare da Flask
+DESCRIZIONI_STATO = {401: 'UNAUTHORIZED', 403: 'FORBIDDEN', 503: 'SERVICE UNAVAILABLE'}
+
+
+class Richiesta:
+    def __init__(self, metodo, percorso, query, protocollo, header, corpo):
+        self.metodo = metodo
+        # già in UTF-8 per i controlli del motore (nickname e token); a Flask va come vuole WSGI, in latin-1
+        self.percorso = unquote(percorso)
+        self.percorso_wsgi = unquote(percorso, encoding='latin-1')
+        self.query = query
+        self.protocollo = protocollo
+        self.header = header
+        self.corpo = corpo
+
+    def tieni_aperta(self):
+        connessione = self.header.get('connection', '').lower()
+        if self.protocollo == 'HTTP/1.1':
+            return connessione != 'close'
+        return connessione == 'keep-alive'
+
+
+class MotoreAsync:
+    def __init__(self, modulo, host, porta, riusa_porta=False):
+        # modulo è server.py già caricato: app Flask, istanza MessengerServer e funzioni dello stream
+        self.modulo = modulo
+        self.app = modulo.app
+        self.server = modulo.server
+        self.host = host
+        self.porta = porta
+        # con l'archivio condiviso più processi ascoltano sulla stessa porta e il kernel divide le connessioni
+        self.riusa_porta = riusa_porta and hasattr(socket, 'SO_REUSEPORT')
+        self.esecutore = ThreadPoolExecutor(THREAD_LAVORO)
+        self.connessioni = 0
+
+    async def servi(self):
+        self.loop = asyncio.get_running_loop()
+        server_tcp = await asyncio.start_server(self.gestisci_connessione, self.host, self.porta,
+                                                backlog=4096, reuse_port=self.riusa_porta or None)
+        print(f"Motore asyncio in ascolto su {self.host}:{self.porta}", file=sys.stderr)
+        async with server_tcp:
+            await server_tcp.serve_forever()
+
+    async def gestisci_connessione(self, reader, writer):
+        self.connessioni += 1
+        try:
+            while True:
+                richiesta = await asyncio.wait_for(self.leggi_richiesta(reader), TIMEOUT_INATTIVITA)
+                if richiesta is None:
+                    break
+                if not await self.rispondi(richiesta, writer):
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connessioni -= 1
+            writer.close()
+
+    async def leggi_richiesta(self, reader):
+        riga = await reader.readline()
+        if not riga:
+            return None
+
+        metodo, destinazione, protocollo = riga.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        header = {}
+        for _ in range(MAX_HEADER):
+            riga = await reader.readline()
+            if riga in (b'\r\n', b'\n', b''):
+                break
+            nome, _, valore = riga.decode('latin-1').partition(':')
+            header[nome.strip().lower()] = valore.strip()
+        else:
+            raise ValueError("Troppi header")
+
+        lunghezza = int(header.get('content-length', 0))
+        if lunghezza > MAX_CORPO:
+            raise ValueError("Corpo della richiesta troppo grande")
+        corpo = await reader.readexactly(lunghezza) if lunghezza else b''
+
+        percorso, _, query = destinazione.partition('?')
+        return Richiesta(metodo, percorso, query, protocollo, header, corpo)
+
+    async def rispondi(self, richiesta, writer):
+        # True se la connessione resta aperta per la prossima richiesta
+        if richiesta.metodo == 'GET' and richiesta.percorso.startswith('/stream/'):
+            await self.stream(richiesta, richiesta.percorso[len('/stream/'):], writer)
+            return False
+
+        environ = self.crea_environ(richiesta, writer)
+        # le metriche contano anche l'attesa fatta qui
+        environ['messenger.inizio'] = time.perf_counter()
+        nickname, attesa, dopo = self.attesa_richiesta(richiesta)
+        # senza un token valido niente attesa né conferma: l'errore lo restituisce la route Flask
+        if attesa > 0 and self.modulo.controlla_token(richiesta.header.get('authorization', ''), nickname) is None:
+            try:
+                await self.attendi_casella(nickname, attesa, dopo)
+            except sqlite3.Error:
+                # database occupato: niente attesa, la route Flask risponde con il suo errore
+                pass
+            environ['messenger.attesa_gestita'] = True
+
+        stato, header, corpo = await self.loop.run_in_executor(self.esecutore, self.chiama_app, environ)
+        tieni_aperta = richiesta.tieni_aperta()
+        self.scrivi_risposta(writer, stato, header, corpo, tieni_aperta)
+        await writer.drain()
+        return tieni_aperta
+
+    def attesa_richiesta(self, richiesta):
+        # (nickname, secondi, cursore o None) per le richieste in long-poll, altrimenti (None, 0, None)
+        if richiesta.metodo == 'GET' and richiesta.percorso.startswith('/messaggi/'):
+            parametri = parse_qs(richiesta.query)
+            return (richiesta.percorso[len('/messaggi/'):],
+                    self.modulo.converti_attesa(parametri.get('wait', [0])[0]),
+                    self.modulo.converti_cursore(parametri.get('after', [None])[0]))
+
+        if richiesta.metodo == 'POST' and richiesta.percorso == '/sync':
+            try:
+                dati = json.loads(richiesta.corpo)
+                return (str(dati.get('nickname', '')).strip(), self.modulo.converti_attesa(dati.get('wait')),
+                        self.modulo.converti_cursore(dati.get('after')))
+            except (ValueError, AttributeError):
+                pass
+        return None, 0, None
+
+    def registra_ascoltatore(self):
+        evento = asyncio.Event()
+
+        def sveglia():
+            # chiamata da qualsiasi thread, con il lock della casella preso
+            self.loop.call_soon_threadsafe(evento.set)
+
+        return evento, sveglia
+
+    async def nel_pool(self, funzione, *argomenti):
+        return await self.loop.run_in_executor(self.esecutore, funzione, *argomenti)
+
+    def prepara_attesa(self, nickname, dopo, sveglia):
+        # gira nel pool: la casella su cui aspettare con sveglia già registrata, None se non c'è da aspettare
+        if dopo is not None:
+            # prima la conferma: i messaggi già ricevuti dal client non devono far finire l'attesa
+            self.server.conferma_messaggi(nickname, dopo)
+        casella = self.server.casella_di(nickname)
+        if casella is None or not self.aggiungi_ascoltatore(casella, sveglia, solo_se_vuota=True):
+            return None
+        return casella
+
+    def aggiungi_ascoltatore(self, casella, sveglia, solo_se_vuota=False):
+        # gira nel pool; False se c'è già qualcosa da leggere
+        with casella.lock:
+            if solo_se_vuota and (casella.profondita() or not casella.attiva):
+                return False
+            casella.ascoltatori.add(sveglia)
+            return True
+
+    def togli_ascoltatore(self, casella, sveglia, nickname=None):
+        # gira nel pool, senza che il loop ne aspetti la fine: una sveglia in ritardo non fa danni
+        with casella.lock:
+            casella.ascoltatori.discard(sveglia)
+        if nickname is not None:
+            self.server.chiudi_stream(nickname, casella)
+
+    async def attendi_casella(self, nickname, attesa, dopo=None):
+        evento, sveglia = self.registra_ascoltatore()
+        casella = await self.nel_pool(self.prepara_attesa, nickname, dopo, sveglia)
+        if casella is None:
+            return
+        try:
+            await asyncio.wait_for(evento.wait(), attesa)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.esecutore.submit(self.togli_ascoltatore, casella, sveglia)
+
+    def misura_stream(self, inizio, codice):
+        # lo stream non passa dal middleware di Flask: come lì, conta fino all'invio degli header
+        self.modulo.metriche.richieste.incrementa(1, 'stream', codice)
+        self.modulo.metriche.durata_richieste.osserva(time.perf_counter() - inizio, 'stream')
+
+    async def stream(self, richiesta, nickname, writer):
+        inizio = time.perf_counter()
+        errore = self.modulo.controlla_token(richiesta.header.get('authorization', ''), nickname)
+        casella = None
+        # come la route Flask: con Last-Event-ID o ?after= lo stream legge dal cursore senza togliere niente
+        cursore = self.modulo.cursore_stream(richiesta.header.get('last-event-id'),
+                                             parse_qs(richiesta.query).get('after', [None])[0])
+        if errore is None:
+            try:
+                casella = await self.nel_pool(self.server.apri_stream, nickname, cursore)
+            except sqlite3.Error:
+                errore = 503, 'Archivio non disponibile, riprova tra poco'
+        if casella is None:
+            stato, messaggio = errore or (401, 'Utente non autorizzato')
+            corpo = json.dumps({'messaggio': messaggio}).encode('utf-8')
+            self.scrivi_risposta(writer, f"{stato} {DESCRIZIONI_STATO[stato]}",
+                                 [('Content-Type', 'application/json')], corpo, False)
+            self.misura_stream(inizio, str(stato))
+            await writer.drain()
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"X-Accel-Buffering: no\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        self.misura_stream(inizio, '200')
+
+        evento, sveglia = self.registra_ascoltatore()
+        try:
+            await self.nel_pool(self.aggiungi_ascoltatore, casella, sveglia)
+            versione_nota = None
+            while True:
+                # prima si azzera l'evento e poi si controlla: una sveglia nel mezzo non va persa.
+                # stream_pronto legge solo contatori, si può chiamare dal loop
+                evento.clear()
+                if not self.modulo.stream_pronto(casella, versione_nota, cursore):
+                    try:
+                        await asyncio.wait_for(evento.wait(), self.modulo.INTERVALLO_KEEPALIVE_STREAM)
+                    except asyncio.TimeoutError:
+                        pass
+
+                blocco, versione_nota, cursore = await self.nel_pool(self.modulo.eventi_stream, nickname, casella,
+                                                                     versione_nota, cursore)
+                if blocco is None:
+                    break
+                await self.scrivi_blocco(writer, blocco)
+
+            await self.scrivi_blocco(writer, self.modulo.formatta_evento('disconnesso', {}))
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except sqlite3.Error as e:
+            # niente 'disconnesso', che per il client vuol dire uscire: chiude lo stream e il client si ricollega
+            print(f"Stream di {nickname} chiuso per un errore dell'archivio: {e}", file=sys.stderr)
+            writer.write(b"0\r\n\r\n")
+        except ConnectionError:
+            pass
+        finally:
+            self.esecutore.submit(self.togli_ascoltatore, casella, sveglia, nickname)
+
+    async def scrivi_blocco(self, writer, dati):
+        # un blocco chunked per evento: il client lo riceve appena arriva
+        writer.write(b"%x\r\n%s\r\n" % (len(dati), dati))
+        await writer.drain()
+
+    def crea_environ(self, richiesta, writer):
+        peer = writer.get_extra_info('peername') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': richiesta.metodo,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': richiesta.percorso_wsgi,
+            'QUERY_STRING': richiesta.query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.porta),
+            'SERVER_PROTOCOL': richiesta.protocollo,
+            'REMOTE_ADDR': peer[0],
+            'CONTENT_TYPE': richiesta.header.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(richiesta.corpo)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(richiesta.corpo),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for nome, valore in richiesta.header.items():
+            if nome not in ('content-type', 'content-length'):
+                environ['HTTP_' + nome.upper().replace('-', '_')] = valore
+        return environ
+
+    def chiama_app(self, environ):
+        # gira su un thread del pool
+        risposta = {}
+
+        def start_response(stato, header, exc_info=None):
+            risposta['stato'] = stato
+            risposta['header'] = header
+
+        corpo_iter = self.app(environ, start_response)
+        try:
+            corpo = b''.join(corpo_iter)
+        finally:
+            if hasattr(corpo_iter, 'close'):
+                corpo_iter.close()
+        return risposta['stato'], risposta['header'], corpo
+
+    def scrivi_risposta(self, writer, stato, header, corpo, tieni_aperta):
+        righe = [f"HTTP/1.1 {stato}"]
+        for nome, valore in header:
+            if nome.lower() not in ('content-length', 'connection'):
+                righe.append(f"{nome}: {valore}")
+        righe.append(f"Content-Length: {len(corpo)}")
+        righe.append("Connection: keep-alive" if tieni_aperta else "Connection: close")
+        writer.write(('\r\n'.join(righe) + '\r\n\r\n').encode('latin-1') + corpo)
+
+
+def avvia(modulo, host, porta, riusa_porta=False):
+    motore = MotoreAsync(modulo, host, porta, riusa_porta)
+    try:
+        asyncio.run(motore.servi())
+    except KeyboardInterrupt:
+        pass